@@ -32,6 +32,10 @@ export const getPublications = async (params: {
     hasNext: boolean;
     total: number;
     statistics: Record<number, number>;
+    facets: {
+      venue: Record<string, number>;
+      field: Record<string, number>;
+    };
   }>(env.BACKEND_URI, {
     params,
     timeout: 10000,
@@ -0,0 +1,26 @@
+from app.services import encoder_service, neo4j_service, reranker_service
+from app.utils.cache import cache_metrics
+from fastapi import APIRouter
+
+router = APIRouter()
+
+
+@router.get("/cache")
+def get_cache_metrics() -> dict[str, dict]:
+    return {
+        "results": cache_metrics(),
+        "s2ranker": s2ranker.cache_info() if (s2ranker := reranker_service.s2ranker_component.value) else None,
+    }
+
+
+@router.get("/embeddings")
+def get_embedding_metrics() -> dict[str, dict]:
+    return {
+        "batcher": encoder_service.batcher.info(),
+        "cache": encoder_service.embedding_cache.info() if encoder_service.embedding_cache else None,
+    }
+
+
+@router.get("/neo4j")
+def get_neo4j_metrics() -> dict[str, dict]:
+    return neo4j_service.pool_metrics()
@@ -1,14 +1,50 @@
-from fastapi import APIRouter
+import json
+from typing import AsyncIterator
 
 from app.services import neo4j_service
+from app.utils.env import NEO4J_STREAM_MAX_ROWS
+from fastapi import APIRouter, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 
 
 router = APIRouter()
 
+# the last line of a streamed page that has more rows after it
+NEXT_CURSOR_KEY = "__next_cursor__"
+
 @router.get("/health", response_model=bool)
 def health() -> bool:
     return neo4j_service.health_check_neo4j()
 
 @router.get("/query", response_model=list[dict[str, object]])
-def query(query_string: str) -> list[dict[str, object]]:
-    return neo4j_service.use_neo4j(query_string)
+async def query(query_string: str) -> list[dict[str, object]]:
+    return await neo4j_service.use_neo4j_async(query_string)
+
+@router.get("/query/stream")
+async def query_stream(query_string: str, max_rows: int = NEO4J_STREAM_MAX_ROWS,
+                       cursor: str | None = None) -> StreamingResponse:
+    """The rows of query_string as NDJSON, one JSON object per line, written
+    as they come from Neo4j. At most max_rows rows are sent; if there are
+    more, the last line is {"__next_cursor__": token}, and passing that
+    token as cursor (with the same query) continues after them. The query
+    runs unchanged, and again for every cursor, so a write is repeated too.
+    """
+    try:
+        offset = neo4j_service.read_cursor(query_string, cursor) if cursor else 0
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    max_rows = max(1, min(max_rows, NEO4J_STREAM_MAX_ROWS))
+
+    async def lines() -> AsyncIterator[str]:
+        n_rows = 0
+        # one row more than asked for tells whether there is a next page, the rest isn't sent
+        async for row in neo4j_service.stream_neo4j(query_string, skip=offset, limit=max_rows + 1):
+            if n_rows == max_rows:
+                next_cursor = neo4j_service.make_cursor(query_string, offset + max_rows)
+                yield json.dumps({NEXT_CURSOR_KEY: next_cursor}) + "\n"
+                break
+            n_rows += 1
+            yield json.dumps(jsonable_encoder(row)) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
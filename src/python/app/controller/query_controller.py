@@ -1,7 +1,7 @@
 from typing import Annotated
 
 from app.services import encoder_service, reranker_service
-from fastapi import APIRouter, Query
+from fastapi import APIRouter, Body, Query
 
 router = APIRouter()
 
@@ -43,3 +43,8 @@ def get_publication(
 def get_embeddings(query_string: str):
     result = encoder_service.get_embeddings(query_string)
     return result
+
+
+@router.post("/embeddings")
+def get_embeddings_batch(query_strings: Annotated[list[str], Body()]) -> list[list[float]]:
+    return encoder_service.get_embeddings_batch(query_strings)
@@ -0,0 +1,11 @@
+from app.utils import readiness
+from fastapi import APIRouter, Response, status
+
+router = APIRouter()
+
+
+@router.get("/ready")
+def ready(response: Response) -> dict[str, object]:
+    if not readiness.is_ready():
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"ready": readiness.is_ready(), "components": readiness.status()}
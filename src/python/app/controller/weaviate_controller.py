@@ -1,6 +1,9 @@
-from typing import Annotated
+from typing import Annotated, Literal
 
 from app.services import weaviate_service, weaviate_sync_service
+from app.utils.checkpoint import checkpoint_in_use
+from app.utils.env import (SYNC_CHECKPOINT_PATH, SYNC_FETCHERS, SYNC_MODE, SYNC_PAGE_SIZE, SYNC_QUEUE_SIZE,
+                           SYNC_UPLOADERS)
 from fastapi import APIRouter, BackgroundTasks, Query
 
 router = APIRouter()
@@ -11,12 +14,33 @@ def health() -> bool:
     return weaviate_service.health_check_weaviate()
 
 
+# a sync needs at least one of each, and a page of at least one row
 @router.post("/sync", response_model=str)
-def initiate_sync(background_tasks: BackgroundTasks):
-    background_tasks.add_task(weaviate_sync_service.start_sync)
+def initiate_sync(background_tasks: BackgroundTasks,
+                  fetchers: Annotated[int, Query(ge=1, le=64)] = SYNC_FETCHERS,
+                  uploaders: Annotated[int, Query(ge=1, le=64)] = SYNC_UPLOADERS,
+                  page_size: Annotated[int, Query(ge=1, le=10000)] = SYNC_PAGE_SIZE,
+                  queue_size: Annotated[int, Query(ge=1, le=1000)] = SYNC_QUEUE_SIZE,
+                  mode: Literal["full", "delta"] = SYNC_MODE,
+                  resume: bool = True):
+    if checkpoint_in_use(SYNC_CHECKPOINT_PATH):
+        return "Sync already running"
+    background_tasks.add_task(weaviate_sync_service.start_sync, fetchers=fetchers, uploaders=uploaders,
+                              page_size=page_size, queue_size=queue_size, mode=mode, resume=resume)
     return "Sync started"
 
 
+@router.get("/sync/status")
+def get_sync_status() -> dict[str, object] | None:
+    return weaviate_sync_service.sync_status()
+
+
+@router.get("/sync/metrics")
+def get_sync_metrics() -> dict[str, object] | None:
+    metrics = weaviate_sync_service.sync_metrics
+    return metrics.info() if metrics else None
+
+
 @router.get("/publications")
 def get_publication(query_string: str, 
                     limit: int = 10, 
@@ -1,19 +1,47 @@
 import logging
+from contextlib import asynccontextmanager
 
-from app.controller import query_controller, neo4j_controller, weaviate_controller
+from app.controller import query_controller, neo4j_controller, weaviate_controller, metrics_controller, ready_controller
 from app.middleware import time_middleware
-from fastapi import FastAPI
+from app.services import neo4j_service, reranker_service, weaviate_sync_service
+from app.utils import readiness
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 
 logging.config.fileConfig("logging.conf", disable_existing_loggers=False)
 logger = logging.getLogger(__name__)
 
-logger.info("Application Started")
 
-app = FastAPI(title="NLP-KG Retrieval API", docs_url="/")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the models load in the background, so the API answers (and /ready reports progress) right away,
+    # S2Ranker first. Its scoring workers start from a forkserver then, see rank.pool_context
+    readiness.start_loading(first=("s2ranker",))
+    weaviate_sync_service.resume_interrupted()
+    logger.info("Application Started")
+    yield
+    reranker_service.close()
+    neo4j_service.close()
+    await neo4j_service.close_async()
+
+
+app = FastAPI(title="NLP-KG Retrieval API", docs_url="/", lifespan=lifespan)
 
 app.add_middleware(time_middleware.TimeMiddleware)
 
+
+@app.exception_handler(readiness.NotReadyError)
+def not_ready(request: Request, error: readiness.NotReadyError) -> JSONResponse:
+    return JSONResponse(status_code=503, headers={"Retry-After": "5"}, content={
+        "detail": str(error),
+        "component": error.component,
+        "state": error.state,
+    })
+
+
+app.include_router(ready_controller.router, tags=["Health"])
 app.include_router(query_controller.router, prefix="/v1/query", tags=["Query"])
 app.include_router(neo4j_controller.router, prefix="/v1/neo4j", tags=["Neo4j"])
 app.include_router(weaviate_controller.router,
                    prefix="/v1/weaviate", tags=["Weaviate"])
+app.include_router(metrics_controller.router, prefix="/v1/metrics", tags=["Metrics"])
@@ -0,0 +1,195 @@
+import copy
+import logging
+import os
+import sys
+from time import perf_counter
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+# queries the backends are checked against the eager model with, like the searches we get
+CHECK_QUERIES = [
+    "bert",
+    "named entity recognition",
+    "transformer models for low-resource machine translation",
+    "How do large language models handle negation?",
+    "graph neural networks knowledge graph completion",
+    "sentiment analysis of code-mixed social media text",
+    "ACL 2020 question answering survey",
+    "retrieval augmented generation hallucination",
+    "word2vec",
+    "dependency parsing with biaffine attention for morphologically rich languages",
+]
+
+
+class EagerEncoder:
+    """The SPECTER2 model with its adapter as loaded, in fp32 PyTorch"""
+
+    name = "eager"
+
+    def __init__(self, model):
+        self.model = model
+
+    def encode(self, inputs) -> np.ndarray:
+        with torch.inference_mode():
+            output = self.model(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"])
+        # the first token of each query is its embedding
+        return output.last_hidden_state[:, 0, :].numpy()
+
+
+class Int8Encoder(EagerEncoder):
+    """The model with every Linear layer (the adapter's included) dynamically
+    quantized to int8: weights are stored as int8, activations are quantized
+    per batch. The bottleneck adapter can't be merged into the base weights,
+    so it stays a separate module and is quantized the same way.
+    """
+
+    name = "int8"
+
+    def __init__(self, model):
+        super().__init__(torch.ao.quantization.quantize_dynamic(
+            copy.deepcopy(model), {torch.nn.Linear}, dtype=torch.qint8))
+
+
+class _CLSEmbedding(torch.nn.Module):
+    """What the ONNX graph computes: token ids and mask in, first token out"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state[:, 0, :]
+
+
+class OnnxEncoder:
+    """The model (with its adapter active) exported to ONNX and run with
+    onnxruntime, optionally with int8 dynamic quantization of the graph.
+    The export is kept in onnx_dir and reused as long as it exists.
+
+    Arguments:
+        model -- the eager model to export
+        tokenizer -- to build example inputs for the export
+        onnx_dir {str} -- where the exported graphs are kept
+        quantize {bool} -- whether to run the int8 quantized graph
+    """
+
+    def __init__(self, model, tokenizer, onnx_dir: str, quantize: bool = True):
+        try:
+            import onnxruntime
+        except ImportError as error:
+            raise ImportError("ENCODER_BACKEND=onnx needs onnxruntime: pip install onnxruntime onnx") from error
+
+        self.name = "onnx-int8" if quantize else "onnx"
+        os.makedirs(onnx_dir, exist_ok=True)
+        fp32_path = os.path.join(onnx_dir, "specter2_adhoc_query.onnx")
+        path = os.path.join(onnx_dir, "specter2_adhoc_query.int8.onnx") if quantize else fp32_path
+
+        if not os.path.exists(fp32_path):
+            logger.info(f"Exporting the query encoder to {fp32_path}")
+            inputs = tokenizer(["an example query", "a longer example query for the export"], padding=True,
+                               return_tensors="pt", return_token_type_ids=False)
+            with torch.inference_mode():
+                torch.onnx.export(
+                    _CLSEmbedding(model).eval(),
+                    (inputs["input_ids"], inputs["attention_mask"]),
+                    fp32_path,
+                    input_names=["input_ids", "attention_mask"],
+                    output_names=["embedding"],
+                    dynamic_axes={"input_ids": {0: "batch", 1: "tokens"},
+                                  "attention_mask": {0: "batch", 1: "tokens"},
+                                  "embedding": {0: "batch"}},
+                    opset_version=17,
+                )
+        if quantize and not os.path.exists(path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            logger.info(f"Quantizing the query encoder to {path}")
+            quantize_dynamic(fp32_path, path, weight_type=QuantType.QInt8)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def encode(self, inputs) -> np.ndarray:
+        return self.session.run(["embedding"], {
+            "input_ids": inputs["input_ids"].numpy().astype(np.int64),
+            "attention_mask": inputs["attention_mask"].numpy().astype(np.int64),
+        })[0]
+
+
+def make_encoder(backend: str, model, tokenizer, onnx_dir: str):
+    """The encoder for ENCODER_BACKEND: eager, int8, onnx or onnx-int8"""
+    if backend == "eager":
+        return EagerEncoder(model)
+    if backend == "int8":
+        return Int8Encoder(model)
+    if backend in ("onnx", "onnx-int8"):
+        return OnnxEncoder(model, tokenizer, onnx_dir, quantize=backend == "onnx-int8")
+    raise ValueError(f"Unknown encoder backend {backend}, use eager, int8, onnx or onnx-int8")
+
+
+def load_encoder(backend: str, model, tokenizer, onnx_dir: str, min_cosine: float = 0.99):
+    """make_encoder, but an encoder whose embeddings of CHECK_QUERIES are
+    less similar than min_cosine to the eager model's falls back to eager
+    """
+    eager = EagerEncoder(model)
+    if backend == "eager":
+        return eager
+    encoder = make_encoder(backend, model, tokenizer, onnx_dir)
+    similarities = cosine_similarities(encoder, eager, tokenizer)
+    if similarities.min() < min_cosine:
+        logger.error(f"Query encoder {encoder.name}: cosine similarity to eager is as low as "
+                     f"{similarities.min():.5f}, using the eager model instead")
+        return eager
+    logger.info(f"Query encoder {encoder.name}: cosine similarity to eager min={similarities.min():.5f} "
+                f"mean={similarities.mean():.5f}")
+    return encoder
+
+
+def tokenize(tokenizer, query_strings: list[str]):
+    return tokenizer(
+        query_strings,
+        padding=True,
+        truncation=True,
+        max_length=tokenizer.model_max_length,
+        return_tensors="pt",
+        return_token_type_ids=False,
+    )
+
+
+def cosine_similarities(encoder, reference, tokenizer, queries: list[str] = CHECK_QUERIES) -> np.ndarray:
+    """Cosine similarity of the embeddings of encoder and of reference, per query"""
+    inputs = tokenize(tokenizer, queries)
+    a = np.asarray(encoder.encode(inputs), dtype=np.float64)
+    b = np.asarray(reference.encode(inputs), dtype=np.float64)
+    return np.sum(a * b, axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+
+
+def benchmark(encoder, tokenizer, batch_sizes=(1, 8, 32), repeat=10) -> dict[int, float]:
+    """Mean seconds per call of encoder.encode, per batch size"""
+    result = {}
+    for batch_size in batch_sizes:
+        inputs = tokenize(tokenizer, (CHECK_QUERIES * batch_size)[:batch_size])
+        encoder.encode(inputs)
+        t_start = perf_counter()
+        for _ in range(repeat):
+            encoder.encode(inputs)
+        result[batch_size] = (perf_counter() - t_start) / repeat
+    return result
+
+
+if __name__ == '__main__':
+    # accuracy check and benchmark: python -m app.services.encoder_backends int8 onnx-int8
+    from . import encoder_service
+
+    encoder_service.load_models()
+    model, tokenizer, onnx_dir = encoder_service.model, encoder_service.tokenizer, encoder_service.onnx_dir
+    eager = EagerEncoder(model)
+    print("eager", benchmark(eager, tokenizer))
+    for backend in sys.argv[1:]:
+        encoder = make_encoder(backend, model, tokenizer, onnx_dir)
+        similarities = cosine_similarities(encoder, eager, tokenizer)
+        print(backend, f"cosine min={similarities.min():.5f} mean={similarities.mean():.5f}",
+              benchmark(encoder, tokenizer))
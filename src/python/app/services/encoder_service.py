@@ -1,36 +1,92 @@
 from adapters import AutoAdapterModel
 from transformers import AutoTokenizer
+import atexit
 import logging
 from os.path import abspath
+from .encoder_backends import load_encoder, tokenize
+from ..utils import readiness
+from ..utils.batching import MicroBatcher
+from ..utils.embedding_cache import EmbeddingCache
+from ..utils.env import (EMBEDDING_MAX_BATCH_SIZE, EMBEDDING_MAX_WAIT_MS, EMBEDDING_CACHE_SIZE,
+                         EMBEDDING_CACHE_PATH, ENCODER_BACKEND, ENCODER_ONNX_DIR, ENCODER_MIN_COSINE,
+                         MODEL_WAIT_SECONDS)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.CRITICAL)
 
 encoder_data_path = abspath('/code/data/encoder_data')
 model_adapter_data_path = abspath('/code/data/model_adapter_data')
+onnx_dir = abspath(ENCODER_ONNX_DIR)
 
-tokenizer: AutoTokenizer
-model: AutoAdapterModel
+tokenizer: AutoTokenizer | None = None
+model: AutoAdapterModel | None = None
+encoder = None
+embedding_cache: EmbeddingCache | None = None
 
-tokenizer = AutoTokenizer.from_pretrained(encoder_data_path)
-model = AutoAdapterModel.from_pretrained(encoder_data_path)
+adapter_name = "allenai/specter2_adhoc_query"
 
-model.load_adapter(
-    model_adapter_data_path,
-    source="hf",
-    model_name="specter2_base",
-    load_as="allenai/specter2_adhoc_query",
-    set_active=True,
-)
 
-def get_embeddings(query_string: str) -> list[float]:
-    inputs = tokenizer(
-        query_string,
-        return_tensors="pt",
-        return_token_type_ids=False,
+def load_models() -> str:
+    """Load the tokenizer, model and adapter, and pick the encoder backend"""
+    global tokenizer, model, encoder, embedding_cache
+
+    tokenizer = AutoTokenizer.from_pretrained(encoder_data_path)
+    model = AutoAdapterModel.from_pretrained(encoder_data_path)
+
+    model.load_adapter(
+        model_adapter_data_path,
+        source="hf",
+        model_name="specter2_base",
+        load_as=adapter_name,
+        set_active=True,
     )
 
-    output = model(**inputs)
-    # take the first token in the batch as the embedding
-    target_embeddings = output.last_hidden_state[:, 0, :]
-    return target_embeddings.tolist()[0]
+    # the eager model, or a quantized/ONNX version of it that gives (nearly) the same embeddings
+    encoder = load_encoder(ENCODER_BACKEND, model, tokenizer, onnx_dir, min_cosine=ENCODER_MIN_COSINE)
+
+    # the same query embedded by the same model, adapter and backend always gives the same vector
+    model_identity = f"{encoder_data_path}:{model_adapter_data_path}:{adapter_name}:{encoder.name}"
+    embedding_cache = EmbeddingCache(model_identity, model.config.hidden_size,
+                                     capacity=EMBEDDING_CACHE_SIZE, path=EMBEDDING_CACHE_PATH or None)
+    atexit.register(embedding_cache.flush)
+    return encoder.name
+
+
+# loaded in the background after startup, see app.main
+encoder_component = readiness.register("encoder", load_models)
+
+
+def embed_batch(query_strings: list[str]) -> list[list[float]]:
+    """Embed a batch of queries with one forward pass, padded to the longest one"""
+    return encoder.encode(tokenize(tokenizer, query_strings)).tolist()
+
+
+# concurrent requests are embedded together, see MicroBatcher
+batcher = MicroBatcher(embed_batch, max_batch_size=EMBEDDING_MAX_BATCH_SIZE,
+                       max_wait=EMBEDDING_MAX_WAIT_MS / 1000, name="query-embeddings")
+
+
+def normalize_query(query_string: str) -> str:
+    """Queries that only differ in whitespace (or case, for an uncased
+    tokenizer) get the same embedding"""
+    query_string = " ".join(query_string.split())
+    return query_string.lower() if getattr(tokenizer, "do_lower_case", False) else query_string
+
+
+def get_embeddings(query_string: str) -> list[float]:
+    return get_embeddings_batch([query_string])[0]
+
+
+def get_embeddings_batch(query_strings: list[str]) -> list[list[float]]:
+    encoder_component.get(timeout=MODEL_WAIT_SECONDS)
+    queries = [normalize_query(query_string) for query_string in query_strings]
+    keys = [embedding_cache.key(query) for query in queries]
+    embeddings = [embedding_cache.get(key) for key in keys]
+
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    futures = [batcher.submit(queries[i]) for i in missing]
+    for i, future in zip(missing, futures):
+        embeddings[i] = future.result()
+        embedding_cache.put(keys[i], embeddings[i])
+
+    return [list(map(float, embedding)) for embedding in embeddings]
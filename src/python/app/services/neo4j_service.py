@@ -1,26 +1,207 @@
-from neo4j import GraphDatabase, AsyncGraphDatabase
-from ..utils.env import NEO4J_PASSWORD, NEO4J_URI, NEO4J_USER, NEO4J_DATABASE
+import base64
+import hashlib
+import json
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter
+from typing import AsyncIterator
+
+from neo4j import AsyncDriver, AsyncGraphDatabase, Driver, GraphDatabase
+from ..utils.env import (NEO4J_PASSWORD, NEO4J_URI, NEO4J_USER, NEO4J_DATABASE, NEO4J_MAX_POOL_SIZE,
+                         NEO4J_MAX_CONNECTION_LIFETIME, NEO4J_CONNECTION_ACQUISITION_TIMEOUT,
+                         NEO4J_STREAM_FETCH_SIZE)
+
+logger = logging.getLogger(__name__)
+
+# one driver (and so one connection pool) per process, for all requests and syncs
+driver_config = dict(
+    auth=(NEO4J_USER, NEO4J_PASSWORD),
+    max_connection_pool_size=NEO4J_MAX_POOL_SIZE,
+    max_connection_lifetime=NEO4J_MAX_CONNECTION_LIFETIME,
+    connection_acquisition_timeout=NEO4J_CONNECTION_ACQUISITION_TIMEOUT,
+)
+
+_driver: Driver | None = None
+_async_driver: AsyncDriver | None = None
+_driver_lock = threading.Lock()
+
+
+class PoolMetrics:
+    """How many queries use the pool at once, against its size, and how they went"""
+
+    def __init__(self):
+        self.queries = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.seconds = 0.0
+        self.errors = Counter()
+        self._lock = threading.Lock()
+
+    def start(self) -> float:
+        with self._lock:
+            self.queries += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+        return perf_counter()
+
+    def finish(self, t_start: float, error: Exception | None = None) -> None:
+        with self._lock:
+            self.in_use -= 1
+            self.seconds += perf_counter() - t_start
+            if error is not None:
+                self.errors[type(error).__name__] += 1
+
+    def info(self) -> dict[str, object]:
+        with self._lock:
+            return {
+                "max_pool_size": NEO4J_MAX_POOL_SIZE,
+                "queries": self.queries,
+                "in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+                "utilisation": self.in_use / NEO4J_MAX_POOL_SIZE,
+                "mean_seconds": self.seconds / self.queries if self.queries else 0.0,
+                "errors": dict(self.errors),
+            }
+
+
+sync_metrics = PoolMetrics()
+async_metrics = PoolMetrics()
+
+
+def get_driver() -> Driver:
+    global _driver
+    if _driver is None:
+        with _driver_lock:
+            if _driver is None:
+                _driver = GraphDatabase.driver(NEO4J_URI, **driver_config)
+    return _driver
+
+
+def get_async_driver() -> AsyncDriver:
+    # created on first use, inside the event loop it is used from
+    global _async_driver
+    if _async_driver is None:
+        _async_driver = AsyncGraphDatabase.driver(NEO4J_URI, **driver_config)
+    return _async_driver
+
+
+@contextmanager
+def _measured(metrics: PoolMetrics):
+    # finished in any case, also when a request is cancelled or a stream is closed early
+    t_start = metrics.start()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        metrics.finish(t_start, error)
 
 
 def use_neo4j(query: str, param: dict = {}) -> list[dict[str, object]]:
-    with GraphDatabase.driver(
-        NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD), database=NEO4J_DATABASE
-    ) as driver:
-        records, _, _ = driver.execute_query(query, parameters_=param)
+    with _measured(sync_metrics):
+        records, _, _ = get_driver().execute_query(query, parameters_=param, database_=NEO4J_DATABASE)
         return [dict(record.data()) for record in records]
 
 
+def run_neo4j_auto_commit(query: str, param: dict = {}) -> list[dict[str, object]]:
+    """Runs query in an auto-commit transaction, which queries that commit
+    on their own, with CALL { ... } IN TRANSACTIONS, need"""
+    with _measured(sync_metrics):
+        with get_driver().session(database=NEO4J_DATABASE) as session:
+            return [dict(record.data()) for record in session.run(query, param)]
+
+
+def explain_neo4j(query: str, param: dict = {}) -> list[str]:
+    """The operators of the plan Neo4j makes for query, from the result down,
+    without running it"""
+    with _measured(sync_metrics):
+        _, summary, _ = get_driver().execute_query(f"EXPLAIN {query}", parameters_=param, database_=NEO4J_DATABASE)
+    operators = []
+    plans = [summary.plan] if summary.plan else []
+    while plans:
+        plan = plans.pop(0)
+        operators.append(plan["operatorType"].split("@")[0])
+        plans.extend(plan.get("children", []))
+    return operators
+
+
 async def use_neo4j_async(query: str, param: dict = {}) -> list[dict[str, object]]:
-    with AsyncGraphDatabase.driver(
-        NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD), database=NEO4J_DATABASE
-    ) as driver:
-        records, _, _ = await driver.execute_query(query, parameters_=param)
+    with _measured(async_metrics):
+        records, _, _ = await get_async_driver().execute_query(query, parameters_=param, database_=NEO4J_DATABASE)
         return [dict(record.data()) for record in records]
 
 
+async def stream_neo4j(query: str, skip: int = 0, limit: int | None = None,
+                       param: dict = {}) -> AsyncIterator[dict[str, object]]:
+    """Rows of query as Neo4j sends them, fetched NEO4J_STREAM_FETCH_SIZE at a time,
+    so only the rows the client hasn't read yet are in memory.
+
+    The query runs as it is given. The first skip rows are read and dropped
+    here, and after limit rows the rest of the result is discarded on the
+    server. Stable pages need an ORDER BY in the query.
+    """
+    with _measured(async_metrics):
+        async with get_async_driver().session(database=NEO4J_DATABASE, fetch_size=NEO4J_STREAM_FETCH_SIZE) as session:
+            result = await session.run(query, param)
+            n_rows = 0
+            async for record in result:
+                if skip:
+                    skip -= 1
+                    continue
+                if limit is not None and n_rows == limit:
+                    break
+                n_rows += 1
+                yield record.data()
+            await result.consume()
+
+
+def query_hash(query: str) -> str:
+    return hashlib.sha256(query.encode()).hexdigest()[:16]
+
+
+def make_cursor(query: str, offset: int) -> str:
+    """A token to continue query from offset, see read_cursor"""
+    token = json.dumps({"query": query_hash(query), "offset": offset}).encode()
+    return base64.urlsafe_b64encode(token).decode()
+
+
+def read_cursor(query: str, cursor: str) -> int:
+    """The offset a cursor from make_cursor continues at. Raises a
+    ValueError for a broken token, or one made for another query.
+    """
+    try:
+        token = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        query_token, offset = token["query"], int(token["offset"])
+    except (ValueError, TypeError, KeyError) as error:
+        raise ValueError(f"Invalid cursor: {error}") from error
+    if query_token != query_hash(query) or offset < 0:
+        raise ValueError("The cursor belongs to another query")
+    return offset
+
+
 def health_check_neo4j():
-    with GraphDatabase.driver(
-        NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD), database=NEO4J_DATABASE
-    ) as driver:
-        driver.verify_connectivity()
-        return True
+    get_driver().verify_connectivity()
+    return True
+
+
+def pool_metrics() -> dict[str, dict]:
+    return {"sync": sync_metrics.info(), "async": async_metrics.info()}
+
+
+def close() -> None:
+    global _driver
+    with _driver_lock:
+        if _driver is not None:
+            _driver.close()
+            _driver = None
+
+
+async def close_async() -> None:
+    global _async_driver
+    if _async_driver is not None:
+        await _async_driver.close()
+        _async_driver = None
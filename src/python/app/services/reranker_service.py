@@ -1,99 +1,137 @@
 from time import perf_counter
 from app.services import weaviate_service
 import logging
-from frozendict import frozendict
 from .s2search.rank import S2Ranker
 from os.path import abspath
-from functools import lru_cache
+from ..utils.env import (S2RANKER_TEXT_STORE_SIZE, S2RANKER_LM_CACHE_SIZE,
+                         S2RANKER_WORKERS, S2RANKER_PARALLEL_MIN_PAPERS, S2RANKER_LM_LOAD_METHOD,
+                         S2RANKER_MODEL_FORMAT, RESULT_CACHE_BACKEND, RESULT_CACHE_SQLITE_PATH,
+                         RESULT_CACHE_REDIS_URL, RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_MB,
+                         RESULT_CACHE_TTL_SECONDS, MODEL_WAIT_SECONDS)
+from ..utils import cache, readiness
+from ..utils.cache import cached
+from ..utils.memory import format_memory_usage
+from ..utils.ranking import RankedPapers
+from ..utils.candidates import CandidateSet
 
 # point to the artifacts downloaded from s3
 data_dir = abspath('/code/data/s2search')
 
 logger = logging.getLogger(__name__)
 
-# only do this once because we have to load the giant language models into memory
-s2ranker = S2Ranker(data_dir)
+
+def load_s2ranker() -> S2Ranker:
+    # only do this once because we have to load the giant language models into memory
+    s2ranker = S2Ranker(data_dir, text_store_size=S2RANKER_TEXT_STORE_SIZE,
+                        lm_cache_size=S2RANKER_LM_CACHE_SIZE, n_workers=S2RANKER_WORKERS,
+                        min_parallel_papers=S2RANKER_PARALLEL_MIN_PAPERS,
+                        lm_load_method=S2RANKER_LM_LOAD_METHOD, model_format=S2RANKER_MODEL_FORMAT)
+
+    # to size containers: shared pages are the memory-mapped models that other workers reuse
+    memory_report = s2ranker.memory_report()
+    logger.info(f"S2Ranker memory, main process: {format_memory_usage(memory_report['main'])}")
+    for worker_usage in memory_report["workers"]:
+        logger.info(f"S2Ranker memory, scoring worker: {format_memory_usage(worker_usage)}")
+
+    # a sync can change the text of papers, so forget their cleaned text along with the results
+    cache.on_invalidate(s2ranker.clear_text_store)
+    return s2ranker
+
+
+# loaded in the background after startup, see app.main
+s2ranker_component = readiness.register("s2ranker", load_s2ranker)
+
+
+def get_s2ranker() -> S2Ranker:
+    return s2ranker_component.get(timeout=MODEL_WAIT_SECONDS)
+
+
+def close() -> None:
+    if s2ranker_component.value is not None:
+        s2ranker_component.value.close()
+
+
+cache.configure(cache.make_backend(RESULT_CACHE_BACKEND, max_entries=RESULT_CACHE_MAX_ENTRIES,
+                                   max_bytes=RESULT_CACHE_MAX_MB * 2**20,
+                                   sqlite_path=RESULT_CACHE_SQLITE_PATH, redis_url=RESULT_CACHE_REDIS_URL))
 
 
 # Actual (non-helper) methods start here
 def query(query_string: str, offset: int, limit: int, n_papers_from_weaviate: int, alpha: float, field_filters: list, sort_option: str, search_type: str, min_date_filter: int, max_date_filter: int, min_citation_filter: int, venue_filter: list, survey_filter = bool | None):
+    # requests that only differ in whitespace or filter order share their cache entries and computations
+    query_string = " ".join(query_string.split())
     papers = get_publications_cached(
-        query_string, n_papers_from_weaviate, alpha, tuple(field_filters), search_type, min_date_filter, max_date_filter, min_citation_filter, tuple(venue_filter), survey_filter)
+        query_string, n_papers_from_weaviate, alpha, normalize_filters(field_filters), search_type, min_date_filter, max_date_filter, min_citation_filter, normalize_filters(venue_filter), survey_filter)
 
     if not papers: 
         logger.info("No matching papers with the given query")
         return
     
-    paper_list: tuple[frozendict]
-
     match sort_option:
         case "relevancy":
-            paper_list = reranker_relevancy(papers, query_string)
+            reranker, args = reranker_relevancy, (papers, query_string)
         case "recency":
-            paper_list = reranker_recency(papers)
+            reranker, args = reranker_recency, (papers,)
         case "citation":
-            paper_list = reranker_citations(papers)
+            reranker, args = reranker_citations, (papers,)
         case "influential":
-            paper_list = reranker_influential(papers)
+            reranker, args = reranker_influential, (papers,)
         case _:
-            logger.error("Error Unrecognized Sort Option:", sort_option)
-    
-    total = len(paper_list)
+            logger.error(f"Error Unrecognized Sort Option: {sort_option}")
+            return
 
-    statsDict = {}
-    for d in paper_list:
-        key = d["year"]
-        statsDict.setdefault(key, 0)
-        statsDict[key] += 1
+    key, paper_list = reranker.keyed(*args)
+    total = len(paper_list)
+    facets = papers.facets
 
     # Get the specified papers from index <Offset> to <Offset+limit>
+    n_sorted = paper_list.n_sorted
+    page = paper_list.page(papers, offset, limit)
+    if paper_list.n_sorted > n_sorted:
+        # the shared backends keep a copy, store the longer order for the next pages
+        reranker.cache.put(key, paper_list)
     return {
-        "papers": paper_list[offset:offset+limit],
+        "papers": page,
         "hasNext": total > offset + limit,
         "total": total,
-        "statistics": statsDict,
+        "statistics": facets["year"],
+        "facets": {"venue": facets["venue"], "field": facets["field"]},
     }
 
-@lru_cache
-def reranker_recency(papers: tuple[frozendict]) -> tuple[frozendict]:
-    result = sorted(
-        list(papers), key=lambda x: x["publication_date"], reverse=True)
-    return tuple(result)
 
+def normalize_filters(filters: list[str]) -> tuple[str]:
+    return tuple(sorted(set(filters)))
 
-@lru_cache
-def reranker_citations(papers: tuple[frozendict]) -> tuple[frozendict]:
-    result = sorted(list(papers), key=lambda x: x["n_citations"], reverse=True)
-    return tuple(result)
 
-@lru_cache
-def reranker_influential(papers: tuple[frozendict]) -> tuple[frozendict]:
-    result = sorted(list(papers), key=lambda x: x["n_key_citations"], reverse=True)
-    return tuple(result)
+# The rerankers only rank as far as the requested page, see RankedPapers
+@cached("reranker_recency", ttl=RESULT_CACHE_TTL_SECONDS)
+def reranker_recency(papers: CandidateSet) -> RankedPapers:
+    return RankedPapers(papers, papers.date_rank)
 
-@lru_cache
-def reranker_relevancy(papers: tuple[frozendict], query_string: str) -> tuple[frozendict]:
-    t_start = perf_counter()
-    paper_ranks = s2ranker.score(query_string, list(papers))
-    logger.info(f"Score Time: {perf_counter() - t_start}")
 
-    sorted_result = sorted(enumerate(paper_ranks),
-                           key=lambda x: x[1], reverse=True)
+@cached("reranker_citations", ttl=RESULT_CACHE_TTL_SECONDS)
+def reranker_citations(papers: CandidateSet) -> RankedPapers:
+    return RankedPapers(papers, papers.n_citations)
+
+@cached("reranker_influential", ttl=RESULT_CACHE_TTL_SECONDS)
+def reranker_influential(papers: CandidateSet) -> RankedPapers:
+    return RankedPapers(papers, papers.n_key_citations)
 
-    result = []
-    for index, rank in sorted_result:
-        paper = papers[index]
-        result.append(paper)
+@cached("reranker_relevancy", ttl=RESULT_CACHE_TTL_SECONDS)
+def reranker_relevancy(papers: CandidateSet, query_string: str) -> RankedPapers:
+    t_start = perf_counter()
+    paper_ranks = get_s2ranker().score(query_string, papers.papers)
+    logger.info(f"Score Time: {perf_counter() - t_start}")
 
-    return tuple(result)
+    return RankedPapers(papers, paper_ranks)
 
 
-# @list_to_tuple
-@lru_cache
-def get_publications_cached(query_string: str, n_papers_from_weaviate: int, alpha: float, field_filters: tuple[str], search_type: str, min_date_filter: int, max_date_filter: int, min_citation_filter: int, venue_filter: tuple[str], survey_filter: bool | None) -> tuple[frozendict]:
+@cached("publications", ttl=RESULT_CACHE_TTL_SECONDS)
+def get_publications_cached(query_string: str, n_papers_from_weaviate: int, alpha: float, field_filters: tuple[str], search_type: str, min_date_filter: int, max_date_filter: int, min_citation_filter: int, venue_filter: tuple[str], survey_filter: bool | None) -> CandidateSet:
     t_start = perf_counter()
 
-    papers = weaviate_service.get_publications(
+    # errors are raised, so a failed search is never cached
+    papers = weaviate_service.search_publications(
         query_string,
         alpha=alpha,
         limit=n_papers_from_weaviate,
@@ -106,4 +144,7 @@ def get_publications_cached(query_string: str, n_papers_from_weaviate: int, alph
         survey_filter=survey_filter)
 
     logger.info(f"Weaviate: {perf_counter() - t_start}")
-    return tuple([frozendict(paper) for paper in papers])
+    candidates = CandidateSet(papers)
+    # before the set is cached, so that the shared backends store the facets too
+    candidates.facets
+    return candidates
@@ -2,7 +2,7 @@ import numpy as np
 import datetime
 import re
 from collections import Counter
-from .text import find_query_ngrams_in_text, fix_text, STOPWORDS
+from .text import QueryNgrams, TextBatch, fix_text, STOPWORDS
 from .text import extract_from_between_quotations, fix_author_text
 from .text import standardize_whitespace_length
 
@@ -84,7 +84,11 @@ def make_feature_names_and_constraints():
     return np.array(feats), ','.join(constraints)
 
 
-def make_features(query, result_paper, lms, max_q_len=128, max_field_len=1024):
+def make_lm_scorer(lms, memo=None):
+    """Wrap the three language models into one scoring function.
+    If a memo dict is passed in, scores are remembered there, which
+    pays off when the same ngrams are scored for many papers.
+    """
     # the language model should have the beginning and end of sentences turned off
     lm_tiab, lm_auth, lm_venu = lms
     lm_dict = {
@@ -103,218 +107,455 @@ def make_features(query, result_paper, lms, max_q_len=128, max_field_len=1024):
             return lm_dict['author'](s)
         elif 'max' in which_lm:
             return np.max([lm_dict['title_abstract'](s), lm_dict['venue'](s), lm_dict['author'](s)])
-    
+
+    if memo is None:
+        return lm_score
+
+    def memoized_lm_score(s, which_lm='title'):
+        key = (s, which_lm)
+        if key not in memo:
+            memo[key] = lm_score(s, which_lm)
+        return memo[key]
+
+    return memoized_lm_score
+
+
+class PreparedQuery:
+    """Everything make_features needs that only depends on the query:
+    the cleaned and split query text, the compiled ngram regexes and the
+    language model scores of the query. Build it once per request and
+    pass it instead of the query string to featurize many papers.
+
+    Arguments:
+        query {str} -- plain text search query
+        lms {tuple} -- the title/abstract, author and venue language models
+        max_q_len {int} -- the cleaned query is cut off at this many characters
+    """
+
+    def __init__(self, query, lms, max_q_len=128):
+        # fix the text and separate out quoted and unquoted
+        self.query = str(query)
+        q = fix_text(self.query)[:max_q_len]
+        self.q_quoted = [i for i in extract_from_between_quotations(q) if len(i) > 0]
+        q_split_on_quotes = [i.strip() for i in q.split('"') if len(i.strip()) > 0]
+        self.q_unquoted = [i.strip() for i in q_split_on_quotes if i not in self.q_quoted and len(i.strip()) > 0] 
+        
+        q_unquoted_split_set = set(' '.join(self.q_unquoted).split())
+        q_quoted_split_set = set(' '.join(self.q_quoted).split())
+        q_split_set = q_unquoted_split_set | q_quoted_split_set
+        q_split_set -= STOPWORDS
+        self.q_unquoted_split_set = frozenset(q_unquoted_split_set)
+        self.q_quoted_split_set = frozenset(q_quoted_split_set)
+        self.q_split_set = frozenset(q_split_set)
+
+        # overall features for the query
+        q_quoted_len = np.sum([len(i) for i in self.q_quoted])  # total length of quoted snippets
+        q_unquoted_len = np.sum([len(i) for i in self.q_unquoted])   # total length of non-quoted snippets
+        self.q_len = q_unquoted_len + q_quoted_len
+        self.has_year = re.search('\d{4}', q) is not None
+
+        # the regexes for title, abstract and venue
+        self.unquoted_ngrams = QueryNgrams(self.q_unquoted, quotes=False)
+        self.quoted_ngrams = QueryNgrams(self.q_quoted, quotes=True)
+
+        # the author field gets its own version of the query
+        q_auth = fix_author_text(self.query)[:max_q_len]
+        self.q_quoted_auth = extract_from_between_quotations(q_auth)
+        q_split_on_quotes_auth = [i.strip() for i in q_auth.split('"') if len(i.strip()) > 0]
+        self.q_unquoted_auth = [i for i in q_split_on_quotes_auth if i not in self.q_quoted_auth]
+        # the author query depends on what the title and venue matched,
+        # so these regexes are compiled on demand and kept around
+        self._author_ngrams = {}
+
+        self.lm_score = make_lm_scorer(lms, memo={})
+        # later we will filter some features based on nonsensical unigrams in the query
+        # this is the log probability lower-bound for sensible unigrams
+        self.log_prob_nonsense = self.lm_score('qwertyuiop', 'max')
+
+    def author_ngrams(self, q, quotes):
+        key = (tuple(q), quotes)
+        if key not in self._author_ngrams:
+            self._author_ngrams[key] = QueryNgrams(q, quotes=quotes, use_word_boundaries=False)
+        return self._author_ngrams[key]
+
+
+def get_paper_year(result_paper):
     try:
         year = int(result_paper['paper_year'])
         year = np.minimum(now.year, year) # papers can't be from the future.
     except:
         year = np.nan
-    
-    if result_paper['author_name'] is None:
-        authors = []
-    else:
-        authors = result_paper['author_name']
-    
-    # fix the text and separate out quoted and unquoted
-    query = str(query)
-    q = fix_text(query)[:max_q_len]
-    q_quoted = [i for i in extract_from_between_quotations(q) if len(i) > 0]
-    q_split_on_quotes = [i.strip() for i in q.split('"') if len(i.strip()) > 0]
-    q_unquoted = [i.strip() for i in q_split_on_quotes if i not in q_quoted and len(i.strip()) > 0] 
-    
-    q_unquoted_split_set = set(' '.join(q_unquoted).split())
-    q_quoted_split_set = set(' '.join(q_quoted).split())
-    q_split_set = q_unquoted_split_set | q_quoted_split_set
-    q_split_set -= STOPWORDS
-    
-    # we will find out how much of a match we have *across* fields
-    unquoted_matched_across_fields = []
-    quoted_matched_across_fields = []
-    
-    # overall features for the paper and query
-    q_quoted_len = np.sum([len(i) for i in q_quoted])  # total length of quoted snippets
-    q_unquoted_len = np.sum([len(i) for i in q_unquoted])   # total length of non-quoted snippets
-    q_len = q_unquoted_len + q_quoted_len  
-    
+    return year
+
+
+def get_year_feature(prepared_query, year):
+    # testing whether a year is somewhere in the query and making year-based features
+    if prepared_query.has_year:  # if year is in query, the feature is whether the paper year appears in the query
+        return str(year) in prepared_query.q_split_set
+    else:  # if year isn't in the query, we don't care about matching
+        return np.nan
+
+
+def abstract_is_available(result_paper):
+    return result_paper['paper_abstract_cleaned'] is not None and len(result_paper['paper_abstract_cleaned']) > 1
+
+
+def make_features(query, result_paper, lms, max_q_len=128, max_field_len=1024):
+    if not isinstance(query, PreparedQuery):
+        query = PreparedQuery(query, lms, max_q_len)
+
     # if there's no query left at this point, we return NaNs
     # which the model natively supports
-    if q_len == 0:
+    if query.q_len == 0:
         return [np.nan] * len(FEATURE_NAMES)
-    
-    # testing whether a year is somewhere in the query and making year-based features
-    if re.search('\d{4}', q):  # if year is in query, the feature is whether the paper year appears in the query
-        year_feat = (str(year) in q_split_set)
-    else:  # if year isn't in the query, we don't care about matching
-        year_feat = np.nan
+
+    year = get_paper_year(result_paper)
+    year_feat = get_year_feature(query, year)
+    match_feats = make_match_features(query, result_paper, year, year_feat, max_field_len)
 
     feats = [
-        result_paper['paper_abstract_cleaned'] is not None and len(result_paper['paper_abstract_cleaned']) > 1,
+        abstract_is_available(result_paper),
         year_feat,  # whether the year appears anywhere in the (split) query
     ]
-    
-    # if year is matched, add it to the matched_across_all_fields but remove from query
-    # so it doesn't get matched in author/title/venue/abstract later
-    if np.any([str(year) in i for i in q_quoted]):
-        quoted_matched_across_fields.append(str(year))
-    if np.any([str(year) in i for i in q_unquoted]):
-        unquoted_matched_across_fields.append(str(year))
-        
-    # if year is matched, we don't need to match it again, so removing
-    if year_feat is True and len(q_split_set) > 1: 
-        q_split_set.remove(str(year))
+    feats.extend(match_feats[:n_field_match_features])
+
+    # oldness and citations 
+    feats.extend([
+        now.year - year,  # oldness (could be nan if year is missing)
+        result_paper['n_citations'],  # no need for log due to decision trees
+        result_paper['n_key_citations'],
+        np.nan if np.isnan(year) else result_paper['n_citations'] / (now.year - year + 1)
+    ])
+
+    feats.extend(match_feats[n_field_match_features:])
+    return feats
+
+
+def make_features_batch(query, result_papers, lms, max_q_len=128, max_field_len=1024):
+    """Featurize all candidate papers of one query at once.
+
+    Gives the same matrix as stacking make_features for every paper,
+    but the query is prepared only once, language model scores are shared
+    between papers, the paper-level columns are computed as arrays and the
+    text matching goes through make_match_features_batch.
+
+    Arguments:
+        query {str or PreparedQuery} -- the search query
+        result_papers {list of dicts} -- papers as returned by S2Ranker.prepare_result
+
+    Returns:
+        X {np.array} -- a (len(result_papers), len(FEATURE_NAMES)) feature matrix
+    """
+    X = np.full((len(result_papers), len(FEATURE_NAMES)), np.nan)
+    if not isinstance(query, PreparedQuery):
+        query = PreparedQuery(query, lms, max_q_len)
+    if len(result_papers) == 0 or query.q_len == 0:
+        return X
+
+    years = [get_paper_year(paper) for paper in result_papers]
+    year_feats = [get_year_feature(query, year) for year in years]
+    year_arr = np.array(years, dtype=float)
+    n_citations = np.array([paper['n_citations'] for paper in result_papers], dtype=float)
+
+    X[:, 0] = [abstract_is_available(paper) for paper in result_papers]
+    X[:, 1] = year_feats
+    X[:, oldness_ind] = now.year - year_arr
+    X[:, n_citations_ind] = n_citations
+    X[:, n_key_citations_ind] = [paper['n_key_citations'] for paper in result_papers]
+    X[:, citations_per_year_ind] = n_citations / (now.year - year_arr + 1)
+
+    X[:, match_feature_inds] = make_match_features_batch(query, result_papers, years, year_feats, max_field_len)
+
+    return X
+
+
+def make_match_features(prepared_query, result_paper, year, year_feat, max_field_len=1024):
+    """The features that come from matching the query against the paper's
+    title, abstract, venue and authors, in FEATURE_NAMES order.
+    """
+    if result_paper['author_name'] is None:
+        authors = []
+    else:
+        authors = result_paper['author_name']
+
+    # we will find out how much of a match we have *across* fields
+    unquoted_matched_across_fields, quoted_matched_across_fields = year_matched_across_fields(prepared_query, year)
+    q_split_set = query_split_set(prepared_query, year, year_feat)
+
+    feats = []
 
-    # later we will filter some features based on nonsensical unigrams in the query
-    # this is the log probability lower-bound for sensible unigrams
-    log_prob_nonsense = lm_score('qwertyuiop', 'max')
-    
     # features title, abstract, venue
     title_and_venue_matches = set()
     title_and_abstract_matches = set()
     for field in ['paper_title_cleaned', 'paper_abstract_cleaned', 'paper_venue_cleaned']:
-        if result_paper[field] is not None:
-            text = result_paper[field][:max_field_len]
-        else:
-            text = ''
-        text_len = len(text)
-        
+        text = field_text(result_paper, field, max_field_len)
+
         # unquoted matches
-        unquoted_match_spans, unquoted_match_text, unquoted_longest_starting_ngram = find_query_ngrams_in_text(q_unquoted, text, quotes=False)
+        _, unquoted_match_text, _ = prepared_query.unquoted_ngrams.find_in_text(text)
         unquoted_matched_across_fields.extend(unquoted_match_text)
-        unquoted_match_len = len(unquoted_match_spans)
-        
+
         # quoted matches
-        quoted_match_spans, quoted_match_text, quoted_longest_starting_ngram = find_query_ngrams_in_text(q_quoted, text, quotes=True)
+        _, quoted_match_text, _ = prepared_query.quoted_ngrams.find_in_text(text)
         quoted_matched_across_fields.extend(quoted_match_text)
-        quoted_match_len = len(quoted_match_text)
-        
-        # now we (a) combine the quoted and unquoted results
-        match_spans = unquoted_match_spans + quoted_match_spans
-        match_text = unquoted_match_text + quoted_match_text
-        
-        # and (b) take the set of the results
-        # while excluding sub-ngrams if longer ngrams are found
-        # e.g. if we already have 'sentiment analysis', then 'sentiment' is excluded
-        match_spans_set = []
-        match_text_set = []
-        for t, s in sorted(zip(match_text, match_spans), key=lambda s: len(s[0]))[::-1]:
-            if t not in match_text_set and ~np.any([t in i for i in match_text_set]):
-                match_spans_set.append(s)
-                match_text_set.append(t)
-                
-        # remove venue results if they already entirely appeared
-        if 'venue' in field:
-            text_unigram_len = len(text.split(' '))
-            match_spans_set_filtered = []
-            match_text_set_filtered = []
-            for sp, tx in zip(match_spans_set, match_text_set):
-                tx_unigrams = set(tx.split(' '))
-                # already matched all of these unigrams in title or abstract
-                condition_1 = (tx_unigrams.intersection(title_and_abstract_matches) == tx_unigrams)
-                # and matched too little of the venue text
-                condition_2 = len(tx_unigrams) / text_unigram_len <= 2/3
-                if not (condition_1 and condition_2):
-                    match_spans_set_filtered.append(sp)
-                    match_text_set_filtered.append(tx)
-                    
-            match_spans_set = match_spans_set_filtered
-            match_text_set = match_text_set_filtered
+
+        field_feats, match_text_set = field_match_features(
+            prepared_query, field, unquoted_match_text + quoted_match_text, q_split_set, title_and_abstract_matches, text)
+        feats.extend(field_feats)
 
         # match_text_set but unigrams
-        matched_text_unigrams = set()
         for i in match_text_set:
             i_split = i.split()
-            matched_text_unigrams.update(i_split)
             if 'title' in field or 'venue' in field:
                 title_and_venue_matches.update(i_split)
             if 'title' in field or 'abstract' in field:
                 title_and_abstract_matches.update(i_split)
-        
-        if len(match_text_set) > 0 and text_len > 0:  # if any matches and the text has any length
-            # log probabilities of the scores
-            if 'venue' in field:
-                lm_probs = [lm_score(match, 'venue') for match in match_text_set]
-            else:
-                lm_probs = [lm_score(match, 'max') for match in match_text_set]
-            
-            # match character lengths
-            match_lens = [len(i) for i in match_text_set]
-
-            # match word lens
-            match_word_lens = [len(i.split()) for i in match_text_set]
-            
-            # we have one feature that takes into account repetition of matches
-            match_text_counter = Counter(match_text)
-            match_spans_len_normed = np.log1p(list(match_text_counter.values())).sum()
-
-            # remove stopwords from unigrams
-            matched_text_unigrams -= STOPWORDS
-            
-            feats.extend([
-                len(q_split_set.intersection(matched_text_unigrams)) / np.maximum(len(q_split_set), 1),  # total fraction of the query that was matched in text
-                np.nanmean(lm_probs),  # average log-prob of the matches
-                np.nansum(np.array(lm_probs) * np.array(match_word_lens)),  # sum of log-prob of matches times word-lengths
-            ])
-        else:
-            # if we have no matches, then the features are deterministically 0
-            feats.extend([0, 0, 0])
-
 
     # features for author field only
     # note: we aren't using citation info
     # because we don't know which author we are matching
     # in the case of multiple authors with the same name
-    q_auth = fix_author_text(query)[:max_q_len]
-    q_quoted_auth = extract_from_between_quotations(q_auth)
-    q_split_on_quotes = [i.strip() for i in q_auth.split('"') if len(i.strip()) > 0]
-    q_unquoted_auth = [i for i in q_split_on_quotes if i not in q_quoted_auth]
+    unquoted_author_ngrams, quoted_author_ngrams = author_ngrams(prepared_query, title_and_venue_matches)
+    unquoted_matches = []
+    quoted_matches = []
+    for paper_author in authors:
+        if len(paper_author) > 0:
+            # only removes entire matches that are stopwords. too bad for people named 'the' or 'less'
+            matched_spans, match_text, _ = unquoted_author_ngrams.find_in_text(paper_author, len_filter=0, remove_stopwords=True)
+            unquoted_matches.append((matched_spans, match_text))
+            matched_spans, match_text, _ = quoted_author_ngrams.find_in_text(paper_author, len_filter=0, remove_stopwords=True)
+            quoted_matches.append((matched_spans, match_text))
+    feats.extend(author_match_features(
+        prepared_query, authors, unquoted_matches, quoted_matches,
+        unquoted_matched_across_fields, quoted_matched_across_fields,
+    ))
+
+    feats.extend(across_fields_match_features(prepared_query, unquoted_matched_across_fields, quoted_matched_across_fields))
+    return feats
+
+
+def make_match_features_batch(prepared_query, result_papers, years, year_feats, max_field_len=1024):
+    """make_match_features for many papers, as a (len(result_papers), 16) array:
+    3 columns each for title, abstract and venue, 3 for authors and 4 across fields.
+
+    Each query snippet is matched against one field of all papers in a
+    single regex scan, and the features of a field are computed once per
+    distinct list of matches, which most papers share with many others.
+    """
+    n = len(result_papers)
+    feats = np.zeros((n, len(match_feature_inds)))
+
+    # the year bookkeeping only depends on the year
+    year_memo = {}
+    unquoted_matched_across_fields = []
+    quoted_matched_across_fields = []
+    q_split_sets = []
+    for year, year_feat in zip(years, year_feats):
+        key = (str(year), year_feat is True)
+        if key not in year_memo:
+            year_memo[key] = (year_matched_across_fields(prepared_query, year),
+                              query_split_set(prepared_query, year, year_feat))
+        (unquoted_matched, quoted_matched), q_split_set = year_memo[key]
+        unquoted_matched_across_fields.append(list(unquoted_matched))
+        quoted_matched_across_fields.append(list(quoted_matched))
+        q_split_sets.append(q_split_set)
+
+    # features title, abstract, venue
+    title_and_venue_matches = [set() for _ in range(n)]
+    title_and_abstract_matches = [set() for _ in range(n)]
+    fields = ['paper_title_cleaned', 'paper_abstract_cleaned', 'paper_venue_cleaned']
+    for field_ind, field in enumerate(fields):
+        texts = [paper[field][:max_field_len] if paper[field] is not None else '' for paper in result_papers]
+        text_batch = TextBatch(texts)
+        unquoted = prepared_query.unquoted_ngrams.find_in_texts(text_batch)
+        quoted = prepared_query.quoted_ngrams.find_in_texts(text_batch)
+        memo = {}
+        # without matches the features stay 0
+        for i in sorted(unquoted.keys() | quoted.keys()):
+            unquoted_match_text = unquoted.get(i, NO_MATCHES)[1]
+            quoted_match_text = quoted.get(i, NO_MATCHES)[1]
+            unquoted_matched_across_fields[i].extend(unquoted_match_text)
+            quoted_matched_across_fields[i].extend(quoted_match_text)
+
+            match_text = list(unquoted_match_text) + list(quoted_match_text)
+            key = (tuple(match_text), id(q_split_sets[i]))
+            if 'venue' in field:
+                key += (frozenset(title_and_abstract_matches[i]), len(texts[i].split(' ')))
+            if key not in memo:
+                field_feats, match_text_set = field_match_features(
+                    prepared_query, field, match_text, q_split_sets[i], title_and_abstract_matches[i], texts[i])
+                memo[key] = (field_feats, {u for t in match_text_set for u in t.split()})
+            field_feats, matched_text_unigrams = memo[key]
+            feats[i, 3 * field_ind:3 * field_ind + 3] = field_feats
+            if 'title' in field or 'venue' in field:
+                title_and_venue_matches[i].update(matched_text_unigrams)
+            if 'title' in field or 'abstract' in field:
+                title_and_abstract_matches[i].update(matched_text_unigrams)
+
+    # features for author field only, matching the authors of all papers
+    # that have the same author query at once
+    groups = {}
+    for i in range(n):
+        groups.setdefault(frozenset(title_and_venue_matches[i]), []).append(i)
+    for title_and_venue, group in groups.items():
+        unquoted_author_ngrams, quoted_author_ngrams = author_ngrams(prepared_query, title_and_venue)
+        paper_authors = [[author for author in result_papers[i]['author_name'] or [] if len(author) > 0]
+                         for i in group]
+        flat_authors = [author for authors in paper_authors for author in authors]
+        text_batch = TextBatch(flat_authors)
+        unquoted = unquoted_author_ngrams.find_in_texts(text_batch, len_filter=0, remove_stopwords=True)
+        quoted = quoted_author_ngrams.find_in_texts(text_batch, len_filter=0, remove_stopwords=True)
+        start = 0
+        for i, authors in zip(group, paper_authors):
+            end = start + len(authors)
+            if any(k in unquoted or k in quoted for k in range(start, end)):
+                feats[i, 9:12] = author_match_features(
+                    prepared_query, result_papers[i]['author_name'],
+                    [unquoted.get(k, NO_MATCHES) for k in range(start, end)],
+                    [quoted.get(k, NO_MATCHES) for k in range(start, end)],
+                    unquoted_matched_across_fields[i], quoted_matched_across_fields[i],
+                )
+            else:
+                # nothing matched, so no author gets a weight
+                feats[i, 10:12] = [np.nan if end == start else 0, np.nan]
+            start = end
+
+    # special features for how much of the query was matched across all fields
+    memo = {}
+    for i in range(n):
+        key = (frozenset(unquoted_matched_across_fields[i]), frozenset(quoted_matched_across_fields[i]))
+        if key not in memo:
+            memo[key] = across_fields_match_features(
+                prepared_query, unquoted_matched_across_fields[i], quoted_matched_across_fields[i])
+        feats[i, 12:] = memo[key]
+
+    return feats
+
+
+def year_matched_across_fields(prepared_query, year):
+    """The starting (unquoted, quoted) matches across fields: the year, if
+    it is in the query"""
+    unquoted_matched_across_fields = []
+    quoted_matched_across_fields = []
+    if np.any([str(year) in i for i in prepared_query.q_quoted]):
+        quoted_matched_across_fields.append(str(year))
+    if np.any([str(year) in i for i in prepared_query.q_unquoted]):
+        unquoted_matched_across_fields.append(str(year))
+    return unquoted_matched_across_fields, quoted_matched_across_fields
+
+
+def query_split_set(prepared_query, year, year_feat):
+    """The query unigrams the title, abstract and venue matches count against"""
+    q_split_set = set(prepared_query.q_split_set)
+    # if year is matched, we don't need to match it again, so removing
+    if year_feat is True and len(q_split_set) > 1:
+        q_split_set.remove(str(year))
+    return q_split_set
+
+
+def field_text(result_paper, field, max_field_len=1024):
+    if result_paper[field] is not None:
+        return result_paper[field][:max_field_len]
+    return ''
+
+
+def field_match_features(prepared_query, field, match_text, q_split_set, title_and_abstract_matches, text):
+    """The three features of one of title, abstract and venue, from all of
+    its (unquoted and then quoted) matches. Also gives the matches that
+    count, for the title_and_venue/title_and_abstract unigrams.
+    """
+    # take the set of the results
+    # while excluding sub-ngrams if longer ngrams are found
+    # e.g. if we already have 'sentiment analysis', then 'sentiment' is excluded
+    match_text_set = []
+    for t in sorted(match_text, key=len)[::-1]:
+        if t not in match_text_set and not any(t in i for i in match_text_set):
+            match_text_set.append(t)
+
+    # remove venue results if they already entirely appeared
+    if 'venue' in field:
+        text_unigram_len = len(text.split(' '))
+        match_text_set_filtered = []
+        for tx in match_text_set:
+            tx_unigrams = set(tx.split(' '))
+            # already matched all of these unigrams in title or abstract
+            condition_1 = (tx_unigrams.intersection(title_and_abstract_matches) == tx_unigrams)
+            # and matched too little of the venue text
+            condition_2 = len(tx_unigrams) / text_unigram_len <= 2/3
+            if not (condition_1 and condition_2):
+                match_text_set_filtered.append(tx)
+        match_text_set = match_text_set_filtered
+
+    if len(match_text_set) == 0 or len(text) == 0:
+        # if we have no matches, then the features are deterministically 0
+        return [0, 0, 0], match_text_set
+
+    # match_text_set but unigrams, without stopwords
+    matched_text_unigrams = set()
+    for i in match_text_set:
+        matched_text_unigrams.update(i.split())
+    matched_text_unigrams -= STOPWORDS
+
+    # log probabilities of the scores
+    lm_score = prepared_query.lm_score
+    if 'venue' in field:
+        lm_probs = [lm_score(match, 'venue') for match in match_text_set]
+    else:
+        lm_probs = [lm_score(match, 'max') for match in match_text_set]
+
+    # match word lens
+    match_word_lens = [len(i.split()) for i in match_text_set]
+
+    return [
+        len(q_split_set.intersection(matched_text_unigrams)) / np.maximum(len(q_split_set), 1),  # total fraction of the query that was matched in text
+        np.nanmean(lm_probs),  # average log-prob of the matches
+        np.nansum(np.array(lm_probs) * np.array(match_word_lens)),  # sum of log-prob of matches times word-lengths
+    ], match_text_set
+
+
+def author_ngrams(prepared_query, title_and_venue_matches):
+    """The (unquoted, quoted) author regexes, for a paper whose title and
+    venue matched title_and_venue_matches"""
     # remove any unigrams that we already matched in title or venue
     # but not abstract since citations are included there
     # note: not sure if this make sense for quotes, but keeping it for those now
-    q_quoted_auth = [remove_unigrams(i, title_and_venue_matches) for i in q_quoted_auth]
-    q_unquoted_auth = [remove_unigrams(i, title_and_venue_matches) for i in q_unquoted_auth]
-    
+    q_quoted_auth = [remove_unigrams(i, title_and_venue_matches) for i in prepared_query.q_quoted_auth]
+    q_unquoted_auth = [remove_unigrams(i, title_and_venue_matches) for i in prepared_query.q_unquoted_auth]
+    return prepared_query.author_ngrams(q_unquoted_auth, False), prepared_query.author_ngrams(q_quoted_auth, True)
+
+
+def author_match_features(prepared_query, authors, unquoted_matches, quoted_matches,
+                          unquoted_matched_across_fields, quoted_matched_across_fields):
+    """The three author features, from the (spans, text) matches of the
+    unquoted and quoted author query in each non-empty author name.
+    Adds the matched names to the matches across fields.
+    """
+    q_len = prepared_query.q_len
     unquoted_match_lens = []  # normalized author matches
     quoted_match_lens = []  # quoted author matches
-    match_fracs = []
-    for paper_author in authors:
-        len_author = len(paper_author)
-        if len_author > 0:
-             # higher weight for the last name
-            paper_author_weights = np.ones(len_author)
-            len_last_name = len(paper_author.split(' ')[-1])
-            paper_author_weights[-len_last_name:] *= 10  # last name is ten times more important to match
-            paper_author_weights /= paper_author_weights.sum()
-            
-            # 
-            for quotes_flag, q_loop in zip([False, True], [q_unquoted_auth, q_quoted_auth]):
-                matched_spans, match_text, _ = find_query_ngrams_in_text(
-                    q_loop, 
-                    paper_author, 
-                    quotes=quotes_flag, 
-                    len_filter=0,
-                    remove_stopwords=True,  # only removes entire matches that are stopwords. too bad for people named 'the' or 'less'
-                    use_word_boundaries=False  
-                )
-                if len(matched_spans) > 0:
-                    matched_text_joined = ' '.join(match_text)
-                    # edge case: single character matches are not good
-                    if len(matched_text_joined) == 1:
-                        matched_text_joined = ''
-                    weight = np.sum([paper_author_weights[i:j].sum() for i, j in matched_spans]) 
-                    match_frac = np.minimum((len(matched_text_joined) / q_len), 1)
-                    match_fracs.append(match_frac)
-                    if quotes_flag:
-                        quoted_match_lens.append(match_frac * weight)
-                        quoted_matched_across_fields.append(matched_text_joined)
-                    else:
-                        unquoted_match_lens.append(match_frac * weight)
-                        unquoted_matched_across_fields.append(matched_text_joined)
-                else:
-                    if quotes_flag:
-                        quoted_match_lens.append(0)
-                    else:
-                        unquoted_match_lens.append(0)
-    
+    paper_authors = [paper_author for paper_author in authors if len(paper_author) > 0]
+    for paper_author, unquoted_match, quoted_match in zip(paper_authors, unquoted_matches, quoted_matches):
+        # higher weight for the last name
+        paper_author_weights = np.ones(len(paper_author))
+        len_last_name = len(paper_author.split(' ')[-1])
+        paper_author_weights[-len_last_name:] *= 10  # last name is ten times more important to match
+        paper_author_weights /= paper_author_weights.sum()
+
+        for (matched_spans, match_text), match_lens, matched_across_fields in [
+            (unquoted_match, unquoted_match_lens, unquoted_matched_across_fields),
+            (quoted_match, quoted_match_lens, quoted_matched_across_fields),
+        ]:
+            if len(matched_spans) > 0:
+                matched_text_joined = ' '.join(match_text)
+                # edge case: single character matches are not good
+                if len(matched_text_joined) == 1:
+                    matched_text_joined = ''
+                weight = np.sum([paper_author_weights[i:j].sum() for i, j in matched_spans])
+                match_frac = np.minimum((len(matched_text_joined) / q_len), 1)
+                match_lens.append(match_frac * weight)
+                matched_across_fields.append(matched_text_joined)
+            else:
+                match_lens.append(0)
+
     # since we ran this separately (per author) for quoted and uquoted, we want to avoid potential double counting
     match_lens_max = np.maximum(unquoted_match_lens, quoted_match_lens)
     nonzero_inds = np.flatnonzero(match_lens_max)
@@ -322,22 +563,21 @@ def make_features(query, result_paper, lms, max_q_len=128, max_field_len=1024):
     if len(nonzero_inds) == 0:
         author_ind_feature = np.nan
     else:
-        author_ind_feature = np.minimum(nonzero_inds[0], len(authors) - 1 - nonzero_inds[-1]) 
-    feats.extend([
-        np.nansum(match_lens_max),  # total amount of (weighted) matched authors 
+        author_ind_feature = np.minimum(nonzero_inds[0], len(authors) - 1 - nonzero_inds[-1])
+    return [
+        np.nansum(match_lens_max),  # total amount of (weighted) matched authors
         nanwrapper(np.nanmax, match_lens_max),  # largest (weighted) author match
         author_ind_feature,  # penalizing matches that are far away from ends of author list
-    ])
+    ]
+
+
+def across_fields_match_features(prepared_query, unquoted_matched_across_fields, quoted_matched_across_fields):
+    """The four features of how much of the query was matched/unmatched across all fields"""
+    lm_score = prepared_query.lm_score
+    feats = []
 
-    # oldness and citations 
-    feats.extend([
-        now.year - year,  # oldness (could be nan if year is missing)
-        result_paper['n_citations'],  # no need for log due to decision trees
-        result_paper['n_key_citations'],
-        np.nan if np.isnan(year) else result_paper['n_citations'] / (now.year - year + 1)
-    ])
-    
     # special features for how much of the unquoted query was matched/unmatched across all fields
+    q_unquoted_split_set = set(prepared_query.q_unquoted_split_set)
     q_unquoted_split_set -= STOPWORDS
     if len(q_unquoted_split_set) > 0:
         matched_split_set = set()
@@ -351,14 +591,15 @@ def make_features(query, result_paper, lms, max_q_len=128, max_field_len=1024):
         # the log-prob of the unmatched unquotes
         unmatched_unquoted = q_unquoted_split_set - matched_split_set
         log_probs_unmatched_unquoted = [lm_score(i, 'max') for i in unmatched_unquoted]
-        feats.append(np.nansum([i for i in log_probs_unmatched_unquoted if i > log_prob_nonsense]))
+        feats.append(np.nansum([i for i in log_probs_unmatched_unquoted if i > prepared_query.log_prob_nonsense]))
     else:
         feats.extend([np.nan, np.nan])
-        
+
     # special features for how much of the quoted query was matched/unmatched across all fields
+    q_quoted = prepared_query.q_quoted
     if len(q_quoted) > 0:
         numerator = len(set(' '.join(quoted_matched_across_fields).split()))
-        feats.append(numerator / len(q_quoted_split_set))
+        feats.append(numerator / len(prepared_query.q_quoted_split_set))
         # the log-prob of the unmatched quotes
         unmatched_quoted = set(q_quoted) - set(quoted_matched_across_fields)
         feats.append(np.nansum([lm_score(i, 'max') for i in unmatched_quoted]))
@@ -379,6 +620,16 @@ title_match_ind = feature_names.index('title_frac_of_query_matched_in_text')
 abstract_match_ind = feature_names.index('abstract_frac_of_query_matched_in_text')
 venue_match_ind = feature_names.index('venue_frac_of_query_matched_in_text')
 
+#  globals to use for make_features_batch
+NO_MATCHES = ((), ())
+oldness_ind = feature_names.index('paper_oldness')
+n_citations_ind = feature_names.index('paper_n_citations')
+n_key_citations_ind = feature_names.index('paper_n_key_citations')
+citations_per_year_ind = feature_names.index('paper_n_citations_divided_by_oldness')
+# make_match_features covers everything but the first two and the paper-level columns
+match_feature_inds = np.r_[2:oldness_ind, citations_per_year_ind + 1:len(feature_names)]
+n_field_match_features = oldness_ind - 2
+
 
 def posthoc_score_adjust(scores, X, query=None):
     if query is None:
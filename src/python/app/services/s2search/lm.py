@@ -0,0 +1,27 @@
+from .store import LRUStore
+
+
+class CachedLanguageModel:
+    """A kenlm.Model that remembers its scores. The same ngrams (query words,
+    popular venue names) get scored over and over, within a query and across
+    queries, and the score of a string never changes.
+
+    Arguments:
+        model {kenlm.Model} -- the language model to wrap
+        maxsize {int} -- how many scores to keep at most (0 disables the cache)
+    """
+
+    def __init__(self, model, maxsize=100000):
+        self.model = model
+        self.cache = LRUStore(maxsize)
+
+    def score(self, sentence, bos=True, eos=True):
+        key = (sentence, bos, eos)
+        score = self.cache.get(key)
+        if score is None:
+            score = self.model.score(sentence, bos=bos, eos=eos)
+            self.cache.put(key, score)
+        return score
+
+    def info(self):
+        return self.cache.info()
@@ -1,9 +1,104 @@
+import hashlib
 import os
 import pickle
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import kenlm
 import numpy as np
 from .text import fix_text, fix_author_text
-from .features import make_features, posthoc_score_adjust
+from .features import PreparedQuery, make_features_batch, posthoc_score_adjust
+from .store import CleanedTextStore
+from .lm import CachedLanguageModel
+from .trees import CompiledTreeEnsemble, compare_with_booster
+from ...utils.memory import memory_usage
+
+logger = logging.getLogger(__name__)
+
+# how the KenLM binaries are loaded, see S2Ranker
+LM_LOAD_METHODS = {
+    # memory-map the file and fault pages in on first use; the pages live in the
+    # page cache and are shared by every process that maps the same file
+    'lazy': 'LAZY',
+    # memory-map the file and read it all in up front (kenlm's default)
+    'populate': 'POPULATE_OR_READ',
+    # read the file into private memory of the process
+    'read': 'READ',
+}
+
+
+def thread_count():
+    """How many threads this process runs, native ones (e.g. of torch) included where the OS tells"""
+    try:
+        return len(os.listdir('/proc/self/task'))
+    except OSError:
+        return threading.active_count()
+
+
+def pool_context():
+    """fork when this process has no other threads: the workers then share the
+    loaded models copy-on-write. Forking a process with other threads can copy
+    a lock some thread holds and deadlock the worker, so otherwise the workers
+    start from a forkserver and load the models themselves (the memory-mapped
+    language models are still shared through the page cache)."""
+    if thread_count() == 1:
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context('forkserver')
+
+
+def load_lm(path, load_method='populate'):
+    config = kenlm.Config()
+    config.load_method = getattr(kenlm.LoadMethod, LM_LOAD_METHODS[load_method])
+    return kenlm.Model(path, config)
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_model(data_dir, model_format='lightgbm'):
+    """Load the ranking model.
+
+    'lightgbm' unpickles the lightgbm Booster. 'compiled' loads the model as a
+    CompiledTreeEnsemble from lightgbm_model.npz; the first time, that file is
+    made from the pickle and the predictions are checked against lightgbm,
+    and again whenever the pickle changed.
+    """
+    pickle_path = os.path.join(data_dir, 'lightgbm_model.pickle')
+    if model_format == 'lightgbm':
+        with open(pickle_path, 'rb') as f:
+            return pickle.load(f)
+    if model_format != 'compiled':
+        raise ValueError(f"Unknown model format: {model_format}")
+
+    compiled_path = os.path.join(data_dir, 'lightgbm_model.npz')
+    # the compiled model keeps the hash of the pickle it was made from
+    source = file_hash(pickle_path) if os.path.exists(pickle_path) else None
+    if os.path.exists(compiled_path):
+        model = CompiledTreeEnsemble.load(compiled_path)
+        if source is None or model.source == source:
+            return model
+        logger.info("S2Ranker: lightgbm_model.pickle changed since it was compiled, compiling it again")
+
+    with open(pickle_path, 'rb') as f:
+        booster = pickle.load(f)
+    model = CompiledTreeEnsemble.from_booster(booster)
+    model.source = source
+    check = compare_with_booster(model, booster, repeat=1)
+    logger.info(f"S2Ranker: compiled lightgbm model, check against lightgbm: {check}")
+    if check['max_abs_diff'] > 1e-9:
+        raise ValueError(f"Compiled model does not match lightgbm, largest difference {check['max_abs_diff']}")
+    try:
+        model.save(compiled_path)
+    except OSError as e:
+        logger.warning(f"S2Ranker: could not save the compiled model: {e}")
+    return model
 
 
 class S2Ranker:
@@ -12,50 +107,174 @@ class S2Ranker:
     Arguments:
         data_dir {str} -- where the language models and lightgbm model live.
         use_posthoc_correction {bool} -- whether to use posthoc correction
+        text_store_size {int} -- how many papers to keep cleaned text for (0 disables it)
+        lm_cache_size {int} -- how many scores to remember per language model (0 disables it)
+        n_workers {int} -- if > 0, score large candidate sets on a pool of this many
+                           worker processes started up front
+        min_parallel_papers {int} -- candidate sets smaller than this are always
+                                     scored in-process
+        lm_load_method {str} -- one of LM_LOAD_METHODS; 'populate' (the default)
+                                reads the memory-mapped language models in up front,
+                                'lazy' only faults in the pages queries touch
+        model_format {str} -- 'lightgbm' or 'compiled', see load_model
     """
 
-    def __init__(self, data_dir, use_posthoc_correction=True):
+    def __init__(self, data_dir, use_posthoc_correction=True, text_store_size=50000, lm_cache_size=100000,
+                 n_workers=0, min_parallel_papers=500, lm_load_method='populate', model_format='lightgbm'):
         self.use_posthoc_correction = use_posthoc_correction
         self.data_dir = data_dir
+        self.text_store = CleanedTextStore(text_store_size)
+        # bumped by clear_text_store, the workers clear theirs when they see a new one
+        self.text_generation = 0
+        self.n_workers = n_workers
+        self.min_parallel_papers = min_parallel_papers
+        self.lm_load_method = lm_load_method
+        self.model_format = model_format
+
+        lm_title_abstracts = load_lm(os.path.join(
+            data_dir, 'titles_abstracts_lm.binary'), lm_load_method)
+        lm_authors = load_lm(os.path.join(data_dir, 'authors_lm.binary'), lm_load_method)
+        lm_venues = load_lm(os.path.join(data_dir, 'venues_lm.binary'), lm_load_method)
+        self.lms = tuple(
+            CachedLanguageModel(lm, lm_cache_size)
+            for lm in (lm_title_abstracts, lm_authors, lm_venues)
+        )
+
+        self.model = load_model(data_dir, model_format)
+
+        self.pool = None
+        if n_workers > 0:
+            self.pool = self.start_pool(text_store_size, lm_cache_size)
+
+    def start_pool(self, text_store_size, lm_cache_size):
+        """Start the worker processes up front. Forked workers inherit this
+        ranker's already loaded models copy-on-write, so they share its
+        memory instead of loading their own copies, see pool_context.
+        """
+        global _shared_ranker
+        _shared_ranker = self
+        mp_context = pool_context()
+        pool = ProcessPoolExecutor(
+            max_workers=self.n_workers,
+            mp_context=mp_context,
+            initializer=_init_worker,
+            initargs=(self.data_dir, text_store_size, lm_cache_size, self.lm_load_method, self.model_format),
+        )
+        # wait until every worker is up so the first query doesn't pay for it
+        list(pool.map(_worker_ready, range(self.n_workers)))
+        logger.info(f"S2Ranker: started {self.n_workers} scoring workers ({mp_context.get_start_method()})")
+        return pool
+
+    def memory_report(self):
+        """Memory usage of this process and of the scoring workers, if any"""
+        report = {'main': memory_usage(), 'workers': []}
+        if self.pool is not None:
+            workers = {usage['pid']: usage for usage in self.pool.map(_worker_memory_usage, range(self.n_workers))}
+            report['workers'] = list(workers.values())
+        return report
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    def clear_text_store(self):
+        """Forget the cleaned text of all papers, in this process and in the
+        scoring workers, which clear theirs with the next shard they get"""
+        self.text_store.clear()
+        self.text_generation += 1
+
+    def cache_info(self):
+        """Size, hit and miss counts of the text store and the language model caches"""
+        lm_title_abstracts, lm_authors, lm_venues = self.lms
+        return {
+            'text_store': self.text_store.info(),
+            'lm_title_abstracts': lm_title_abstracts.info(),
+            'lm_authors': lm_authors.info(),
+            'lm_venues': lm_venues.info(),
+        }
 
-        lm_title_abstracts = kenlm.Model(os.path.join(
-            data_dir, 'titles_abstracts_lm.binary'))
-        lm_authors = kenlm.Model(os.path.join(data_dir, 'authors_lm.binary'))
-        lm_venues = kenlm.Model(os.path.join(data_dir, 'venues_lm.binary'))
-        self.lms = (lm_title_abstracts, lm_authors, lm_venues)
+    def prepare_query(self, query):
+        """Do all the query-only work of featurization once.
 
-        with open(os.path.join(data_dir, 'lightgbm_model.pickle'), 'rb') as f:
-            self.model = pickle.load(f)
+        Arguments:
+            query {str} -- plain text search query
+
+        Returns:
+            prepared_query {PreparedQuery} -- can be passed to score instead of the query
+        """
+        return PreparedQuery(query, self.lms)
 
     def score(self, query, papers) -> list[float]:
         """Score each pair of (query, paper) for all papers
 
         Arguments:
-            query {str} -- plain text search query 
+            query {str or PreparedQuery} -- plain text search query 
+                                            or the result of prepare_query
             papers {list of dicts} -- A list of candidate papers, each of which
                                       is a dictionary.
 
         Returns:
             scores {np.array} -- an array of scores, one per paper in papers
         """
-        query = str(query)
-        X = np.array([
-            make_features(query, self.prepare_result(paper), self.lms)
-            for paper in papers
-        ])
-        scores = self.model.predict(X)
+        if self.pool is not None and len(papers) >= self.min_parallel_papers:
+            try:
+                X, scores = self.predict_parallel(query, papers)
+            except BrokenProcessPool:
+                logger.error("S2Ranker: worker pool is broken, scoring in-process from now on")
+                self.pool = None
+                X, scores = self.predict(query, papers)
+        else:
+            X, scores = self.predict(query, papers)
+
         if self.use_posthoc_correction:
-            scores = posthoc_score_adjust(scores, X, query)
+            query_string = query.query if isinstance(query, PreparedQuery) else str(query)
+            scores = posthoc_score_adjust(scores, X, query_string)
         return scores
 
+    def predict(self, query, papers):
+        """Featurize the papers and run the lightgbm model on them,
+        without the posthoc correction.
+
+        Returns:
+            X {np.array} -- the feature matrix
+            scores {np.array} -- the raw model scores
+        """
+        if not isinstance(query, PreparedQuery):
+            query = self.prepare_query(query)
+        X = make_features_batch(
+            query, [self.prepare_result(paper, self.text_store) for paper in papers], self.lms)
+        return X, self.model.predict(X)
+
+    def predict_parallel(self, query, papers):
+        """Same as predict, but with the papers split into contiguous shards
+        that are scored on the worker pool and put back together in order.
+        """
+        if isinstance(query, PreparedQuery):
+            # the prepared query holds the language models, the workers prepare their own
+            query = query.query
+        papers = list(papers)
+        bounds = np.linspace(0, len(papers), self.n_workers + 1).astype(int)
+        futures = [
+            self.pool.submit(_predict_shard, query, papers[start:end], self.text_generation)
+            for start, end in zip(bounds[:-1], bounds[1:])
+            if end > start
+        ]
+        results = [future.result() for future in futures]
+        X = np.vstack([X_shard for X_shard, _ in results])
+        scores = np.concatenate([scores_shard for _, scores_shard in results])
+        return X, scores
+
     @classmethod
-    def prepare_result(cls, paper):
+    def prepare_result(cls, paper, text_store=None):
         """Prepare the raw text result for featurization
 
         Arguments:
             paper {dict} -- A dictionary that has the required paper fields:
                             'title', 'abstract', 'authors', 'venues', 'year',
                             'n_citations', 'n_key_citations'
+            text_store {CleanedTextStore} -- where cleaned text of papers with a
+                                             'neo4jID' is looked up first and kept
         Returns:
             out {dict} -- A dictionary where the paper fields have been pre-processed.
         """
@@ -66,9 +285,65 @@ class S2Ranker:
             'n_key_citations', int(-1.4 + np.log1p(out['n_citations'])))
         if out['n_key_citations'] < 0:
             out['n_key_citations'] = 0
-        out['paper_title_cleaned'] = fix_text(paper.get('title', ''))
-        out['paper_abstract_cleaned'] = fix_text(paper.get('abstract', ''))
-        out['paper_venue_cleaned'] = fix_text(paper.get('venue', ''))
-        out['author_name'] = [fix_author_text(
-            i) for i in paper.get('authors', [])]
+        out.update(cls.clean_text_fields(paper, text_store))
         return out
+
+    @classmethod
+    def clean_text_fields(cls, paper, text_store=None):
+        """The cleaned title, abstract, venue and authors of a paper,
+        from the text store if it has already seen the paper.
+        """
+        key = paper.get('neo4jID')
+        if text_store is not None and key is not None:
+            cleaned = text_store.get(key)
+            if cleaned is not None:
+                return cleaned
+
+        cleaned = {
+            'paper_title_cleaned': fix_text(paper.get('title', '')),
+            'paper_abstract_cleaned': fix_text(paper.get('abstract', '')),
+            'paper_venue_cleaned': fix_text(paper.get('venue', '')),
+            'author_name': [fix_author_text(i) for i in paper.get('authors', [])],
+        }
+        if text_store is not None and key is not None:
+            text_store.put(key, cleaned)
+        return cleaned
+
+
+# the ranker that started the pool, inherited by forked workers only, see pool_context
+_shared_ranker = None
+# the ranker of a pool worker process
+_worker_ranker = None
+
+
+def _init_worker(data_dir, text_store_size, lm_cache_size, lm_load_method, model_format):
+    global _worker_ranker
+    if _shared_ranker is not None:
+        # forked: reuse the parent's models, but keep caches per process
+        _worker_ranker = S2Ranker.__new__(S2Ranker)
+        _worker_ranker.__dict__.update(_shared_ranker.__dict__)
+        _worker_ranker.use_posthoc_correction = False
+        _worker_ranker.n_workers = 0
+        _worker_ranker.pool = None
+        _worker_ranker.text_store = CleanedTextStore(text_store_size)
+        _worker_ranker.lms = tuple(CachedLanguageModel(lm.model, lm_cache_size) for lm in _shared_ranker.lms)
+    else:
+        _worker_ranker = S2Ranker(data_dir, use_posthoc_correction=False, text_store_size=text_store_size,
+                                  lm_cache_size=lm_cache_size, lm_load_method=lm_load_method,
+                                  model_format=model_format)
+
+
+def _worker_ready(_):
+    return _worker_ranker is not None
+
+
+def _predict_shard(query, papers, text_generation):
+    if text_generation != _worker_ranker.text_generation:
+        # the parent cleared its text store since this worker last scored
+        _worker_ranker.text_store.clear()
+        _worker_ranker.text_generation = text_generation
+    return _worker_ranker.predict(query, papers)
+
+
+def _worker_memory_usage(_):
+    return memory_usage()
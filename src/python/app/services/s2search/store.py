@@ -0,0 +1,60 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUStore:
+    """A bounded, thread-safe key-value store that drops the least
+    recently used entries once maxsize is reached. None is not a valid value.
+
+    Arguments:
+        maxsize {int} -- how many entries to keep at most
+    """
+
+    def __init__(self, maxsize=50000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def info(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class CleanedTextStore(LRUStore):
+    """The cleaned text fields of papers, keyed by the paper's neo4jID.
+    The cleaned text only depends on the paper, so it does not have
+    to be recomputed for every query.
+    """
@@ -124,62 +124,151 @@ def find_query_ngrams_in_text(q, t, quotes=False, len_filter=1, remove_stopwords
         longest_starting_ngram -- the longest matching ngram that
                                   matches at the start of the text 
     """
-    longest_starting_ngram = ''
-    
     if len(q) == 0 or len(t) == 0:
-        return [], [], longest_starting_ngram
-    if type(q[0]) is not str or type(t) is not str:
-        return [], [], longest_starting_ngram
+        return [], [], ''
+    query_ngrams = QueryNgrams(q, quotes=quotes, use_word_boundaries=use_word_boundaries, max_ngram_len=max_ngram_len)
+    return query_ngrams.find_in_text(t, len_filter=len_filter, remove_stopwords=remove_stopwords)
 
-    q = [standardize_whitespace_length(i.translate(REGEX_TRANSLATION_TABLE)) 
-         for i in q]
-    q = [i for i in q if len(i) > 0]
-    t = standardize_whitespace_length(t.translate(REGEX_TRANSLATION_TABLE))
 
-    # if not between quotes, we get all ngrams
-    if quotes is False:
+class QueryNgrams:
+    """The ngram regexes that find_query_ngrams_in_text builds for a query,
+    compiled once so that they can be matched against many texts.
+
+    Arguments:
+        q {list of str} -- query snippets
+        quotes {bool} -- whether to find exact quotes or not
+        use_word_boundaries {bool} -- whether to care about word boundaries
+                                      when finding matches
+        max_ngram_len {int} -- longest allowable derived word n-grams
+    """
+
+    def __init__(self, q, quotes=False, use_word_boundaries=True, max_ngram_len=7):
+        self.quotes = quotes
+        # one (candidate ngrams, compiled regex) pair per query snippet
+        self.patterns = []
+
+        if len(q) == 0 or type(q[0]) is not str:
+            return
+
+        q = [standardize_whitespace_length(i.translate(REGEX_TRANSLATION_TABLE)) 
+             for i in q]
+        q = [i for i in q if len(i) > 0]
+
+        for q_sub in q:
+            # if not between quotes, we get all ngrams
+            if quotes is False:
+                q_split = q_sub.split() 
+                n_grams = [] 
+                longest_ngram = np.minimum(max_ngram_len, len(q_split))
+                for i in range(int(longest_ngram), 0, -1): 
+                    n_grams += [' '.join(ngram).replace('|', '\\|')for ngram in ngrams(q_split, i)]
+                if use_word_boundaries:
+                    pattern = '|'.join(['\\b' + i + '\\b' for i in n_grams])
+                else:
+                    pattern = '|'.join(n_grams)
+            # for the between-quotes texts we only care about exact matches
+            else:
+                n_grams = [q_sub]
+                if use_word_boundaries:
+                    pattern = '\\b' + q_sub + '\\b'
+                else:
+                    pattern = q_sub
+            self.patterns.append((n_grams, re.compile(pattern)))
+
+    def find_in_text(self, t, len_filter=1, remove_stopwords=True):
+        """Same as find_query_ngrams_in_text, with the query already compiled.
+        len_filter and remove_stopwords only apply to unquoted queries.
+        """
+        longest_starting_ngram = ''
+
+        if len(self.patterns) == 0 or len(t) == 0:
+            return [], [], longest_starting_ngram
+        if type(t) is not str:
+            return [], [], longest_starting_ngram
+
+        t = standardize_whitespace_length(t.translate(REGEX_TRANSLATION_TABLE))
+
         match_spans = []
         match_text_tokenized = []
-        for q_sub in q:
-            q_split = q_sub.split() 
-            n_grams = [] 
-            longest_ngram = np.minimum(max_ngram_len, len(q_split))
-            for i in range(int(longest_ngram), 0, -1): 
-                n_grams += [' '.join(ngram).replace('|', '\|')for ngram in ngrams(q_split, i)]
+        for n_grams, pattern in self.patterns:
             for i in n_grams:
                 if t.startswith(i) and len(i) > len(longest_starting_ngram):
                     longest_starting_ngram = i 
-            if use_word_boundaries:
-                matches = list(re.finditer('|'.join(['\\b' + i + '\\b' for i in n_grams]), t))
+            matches = list(pattern.finditer(t))
+            if self.quotes is False:
+                match_spans.extend([i.span() for i in matches
+                                   if i.span()[1] - i.span()[0] > len_filter])
+                match_text_tokenized.extend([i.group()
+                                             for i in matches
+                                             if i.span()[1] - i.span()[0] > len_filter])
             else:
-                matches = list(re.finditer('|'.join(n_grams), t))
-            match_spans.extend([i.span() for i in matches
-                               if i.span()[1] - i.span()[0] > len_filter])
-            match_text_tokenized.extend([i.group()
-                                         for i in matches
-                                         if i.span()[1] - i.span()[0] > len_filter])
-            
+                match_spans.extend([i.span() for i in matches])
+                match_text_tokenized.extend([i.group() for i in matches]) 
+
         # now we remove any of the results if the entire matched ngram is just a stopword
-        if remove_stopwords:
+        if self.quotes is False and remove_stopwords:
             match_spans = [span for i, span in enumerate(match_spans) if match_text_tokenized[i] not in STOPWORDS]
             match_text_tokenized = [text for text in match_text_tokenized if text not in STOPWORDS]  
-        
-    # now matches for the between-quotes texts
-    # we only care about exact matches
-    else:
-        match_spans = []
-        match_text_tokenized = []
-        for q_sub in q:
-            if use_word_boundaries:
-                matches = list(re.finditer('\\b' + q_sub + '\\b', t))
-            else:
-                matches = list(re.finditer(q_sub, t))
-            if t.startswith(q_sub) and len(q_sub) > len(longest_starting_ngram):
-                longest_starting_ngram = q_sub 
-            match_spans.extend([i.span() for i in matches])
-            match_text_tokenized.extend([i.group() for i in matches]) 
     
-    return match_spans, match_text_tokenized, longest_starting_ngram
+        return match_spans, match_text_tokenized, longest_starting_ngram
+
+    def find_in_texts(self, text_batch, len_filter=1, remove_stopwords=True):
+        """find_in_text for all texts of a TextBatch, with one regex scan per
+        query snippet. Returns a dict from the index of every text with
+        matches to its (match_spans, match_text_tokenized).
+        """
+        results = {}
+        if len(self.patterns) == 0 or len(text_batch.texts) == 0:
+            return results
+        if text_batch.joined is None:
+            for i, t in enumerate(text_batch.texts):
+                match_spans, match_text_tokenized, _ = self.find_in_text(t, len_filter, remove_stopwords)
+                if len(match_spans) > 0:
+                    results[i] = (match_spans, match_text_tokenized)
+            return results
+
+        filter_matches = self.quotes is False
+        for _, pattern in self.patterns:
+            matches = [(match.start(), match.end(), match.group()) for match in pattern.finditer(text_batch.joined)]
+            if len(matches) == 0:
+                continue
+            owners = np.searchsorted(text_batch.offsets, [start for start, _, _ in matches], side='right') - 1
+            for owner, (start, end, text) in zip(owners.tolist(), matches):
+                if filter_matches and (end - start <= len_filter or (remove_stopwords and text in STOPWORDS)):
+                    continue
+                offset = text_batch.offsets[owner]
+                if owner not in results:
+                    results[owner] = ([], [])
+                results[owner][0].append((start - offset, end - offset))
+                results[owner][1].append(text)
+        return results
+
+
+class TextBatch:
+    """Texts cleaned the way QueryNgrams.find_in_text cleans them, and joined
+    by newlines so that QueryNgrams.find_in_texts can scan them all at once.
+
+    Arguments:
+        texts {list of str} -- the texts, anything but a str counts as empty
+    """
+
+    def __init__(self, texts):
+        self.texts = [t if type(t) is str else '' for t in texts]
+        self.joined = None
+        self.offsets = []
+        if len(self.texts) == 0:
+            return
+
+        joined = '\n'.join(self.texts)
+        # the query regexes never match a newline and see one as a word boundary, like
+        # the ends of a text. texts with newlines or unprintable characters (which covers
+        # all other whitespace strip() would remove) go through find_in_text one by one
+        if joined.count('\n') != len(self.texts) - 1 or not joined.replace('\n', ' ').isprintable():
+            return
+        # same as standardize_whitespace_length on every text
+        joined = re.sub(r'  +', ' ', joined.translate(REGEX_TRANSLATION_TABLE))
+        self.joined = joined.replace(' \n', '\n').replace('\n ', '\n').strip(' ')
+        self.offsets = np.cumsum([0] + [len(t) + 1 for t in self.joined.split('\n')[:-1]]).tolist()
 
 '''
 import re
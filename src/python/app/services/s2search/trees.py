@@ -0,0 +1,184 @@
+import sys
+import pickle
+from time import perf_counter
+import numpy as np
+
+# how lightgbm treats missing values at a split
+MISSING_NONE, MISSING_ZERO, MISSING_NAN = 0, 1, 2
+MISSING_TYPES = {'None': MISSING_NONE, 'Zero': MISSING_ZERO, 'NaN': MISSING_NAN}
+# lightgbm counts values this close to 0 as zero (kZeroThreshold, a float32)
+K_ZERO_THRESHOLD = float(np.float32(1e-35))
+# objectives whose prediction is the raw sum of the trees
+RAW_SCORE_OBJECTIVES = ('lambdarank', 'rank_xendcg', 'regression')
+
+
+class CompiledTreeEnsemble:
+    """A lightgbm tree ensemble flattened into NumPy arrays, with a
+    vectorized predict that walks all trees for all rows at once.
+
+    The split nodes of all trees share one set of arrays. A child (or a tree
+    root) >= 0 is the index of another split node, a child < 0 is the leaf
+    with index ~child, the same encoding lightgbm uses internally.
+
+    Arguments:
+        split_feature {np.array} -- feature index per split node
+        threshold {np.array} -- go left if the feature value is <= threshold
+        left_child, right_child {np.array} -- children per split node
+        default_left {np.array} -- where missing values go per split node
+        missing_type {np.array} -- one of MISSING_TYPES per split node
+        leaf_value {np.array} -- output per leaf
+        tree_root {np.array} -- root of each tree
+        average_output {bool} -- whether the trees are averaged (random forest)
+        source {str} -- what the model was compiled from, e.g. a hash of the lightgbm model file
+    """
+
+    ARRAYS = ('split_feature', 'threshold', 'left_child', 'right_child',
+              'default_left', 'missing_type', 'leaf_value', 'tree_root')
+
+    def __init__(self, split_feature, threshold, left_child, right_child, default_left,
+                 missing_type, leaf_value, tree_root, average_output=False, source=''):
+        self.split_feature = np.asarray(split_feature, dtype=np.int32)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.left_child = np.asarray(left_child, dtype=np.int32)
+        self.right_child = np.asarray(right_child, dtype=np.int32)
+        self.default_left = np.asarray(default_left, dtype=bool)
+        self.missing_type = np.asarray(missing_type, dtype=np.int8)
+        self.leaf_value = np.asarray(leaf_value, dtype=np.float64)
+        self.tree_root = np.asarray(tree_root, dtype=np.int32)
+        self.average_output = bool(average_output)
+        self.source = source
+
+        # where a zero and a NaN go at each split, see lightgbm's NumericalDecision:
+        # NaN counts as zero unless the split has NaN as its missing type
+        self.zero_left = np.where(self.missing_type == MISSING_ZERO, self.default_left, 0.0 <= self.threshold)
+        self.nan_left = np.where(self.missing_type == MISSING_NAN, self.default_left, self.zero_left)
+        # children[2 * node] is the left and children[2 * node + 1] the right child
+        self.children = np.stack([self.left_child, self.right_child], axis=1).ravel()
+
+    @classmethod
+    def from_booster(cls, booster):
+        """Convert a lightgbm Booster (or a fitted sklearn wrapper of one)."""
+        booster = getattr(booster, 'booster_', booster)
+        dump = booster.dump_model()
+        objective = dump['objective'].split(' ')[0]
+        if dump['num_tree_per_iteration'] != 1 or objective not in RAW_SCORE_OBJECTIVES:
+            raise ValueError(f"Can't compile a lightgbm model with objective {dump['objective']}")
+
+        nodes = {name: [] for name in cls.ARRAYS}
+
+        def add(node):
+            if 'leaf_value' in node:
+                nodes['leaf_value'].append(node['leaf_value'])
+                return ~(len(nodes['leaf_value']) - 1)
+            if node['decision_type'] != '<=':
+                raise ValueError(f"Can't compile a lightgbm split with decision type {node['decision_type']}")
+            index = len(nodes['split_feature'])
+            nodes['split_feature'].append(node['split_feature'])
+            nodes['threshold'].append(node['threshold'])
+            nodes['default_left'].append(node['default_left'])
+            nodes['missing_type'].append(MISSING_TYPES[node['missing_type']])
+            nodes['left_child'].append(0)
+            nodes['right_child'].append(0)
+            nodes['left_child'][index] = add(node['left_child'])
+            nodes['right_child'][index] = add(node['right_child'])
+            return index
+
+        for tree in dump['tree_info']:
+            nodes['tree_root'].append(add(tree['tree_structure']))
+
+        return cls(average_output=dump['average_output'], **nodes)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in cls.ARRAYS}
+            # files saved before the source was kept have none
+            source = str(data['source']) if 'source' in data.files else ''
+            return cls(average_output=bool(data['average_output']), source=source, **arrays)
+
+    def save(self, path):
+        np.savez(path, average_output=self.average_output, source=self.source,
+                 **{name: getattr(self, name) for name in self.ARRAYS})
+
+    def predict(self, X):
+        """Predict all rows of X, same as the lightgbm Booster would.
+
+        Arguments:
+            X {np.array} -- a (n_rows, n_features) matrix, NaN for missing values
+
+        Returns:
+            scores {np.array} -- one score per row
+        """
+        X = np.asarray(X, dtype=np.float64)
+        # lightgbm drops near-zero values from a row before predicting, which makes them exactly 0
+        X = np.where(np.abs(X) <= K_ZERO_THRESHOLD, 0.0, X)
+        n_rows, n_features = X.shape
+        n_trees = len(self.tree_root)
+        X_flat = X.ravel()
+
+        # one entry per (row, tree) pair, row-major
+        node = np.tile(self.tree_root, n_rows)
+        row_offset = np.repeat(np.arange(n_rows) * n_features, n_trees)
+
+        # move every pair that is still at a split node one level down
+        active = np.flatnonzero(node >= 0)
+        while len(active) > 0:
+            current = node[active]
+            value = X_flat[row_offset[active] + self.split_feature[current]]
+            go_right = ~(value <= self.threshold[current])
+            # zeros and NaNs may have to go the default way instead
+            special = np.flatnonzero(np.isnan(value) | (value == 0))
+            if len(special) > 0:
+                special_node = current[special]
+                go_right[special] = ~np.where(np.isnan(value[special]),
+                                              self.nan_left[special_node], self.zero_left[special_node])
+            child = self.children[2 * current + go_right]
+            node[active] = child
+            active = active[child >= 0]
+
+        # add the trees up one at a time, in the same order lightgbm does
+        leaf_values = self.leaf_value[~node].reshape(n_rows, n_trees)
+        scores = np.cumsum(leaf_values, axis=1)[:, -1] if n_trees > 0 else np.zeros(n_rows)
+        if self.average_output and n_trees > 0:
+            scores /= n_trees
+        return scores
+
+
+def make_check_matrix(compiled, n_rows=2000, n_features=22, seed=0):
+    """Random rows that also hit split thresholds exactly, zeros and NaNs,
+    to compare a compiled ensemble with the lightgbm model it came from.
+    """
+    rng = np.random.default_rng(seed)
+    X = rng.normal(scale=100, size=(n_rows, n_features))
+    for feature in range(n_features):
+        thresholds = compiled.threshold[compiled.split_feature == feature]
+        if len(thresholds) > 0:
+            on_threshold = rng.random(n_rows) < 0.3
+            X[on_threshold, feature] = rng.choice(thresholds, on_threshold.sum())
+    X[rng.random(X.shape) < 0.1] = 0.0
+    X[rng.random(X.shape) < 0.2] = np.nan
+    return X
+
+
+def compare_with_booster(compiled, booster, n_rows=2000, n_features=22, repeat=10):
+    """Largest prediction difference and mean predict time of both models.
+
+    Returns:
+        result {dict} -- max_abs_diff, compiled_seconds and booster_seconds
+    """
+    X = make_check_matrix(compiled, n_rows, n_features)
+    result = {'max_abs_diff': float(np.max(np.abs(compiled.predict(X) - booster.predict(X)), initial=0.0))}
+    for name, model in [('compiled', compiled), ('booster', booster)]:
+        t_start = perf_counter()
+        for _ in range(repeat):
+            model.predict(X)
+        result[f'{name}_seconds'] = (perf_counter() - t_start) / repeat
+    return result
+
+
+if __name__ == '__main__':
+    # benchmark: python -m app.services.s2search.trees /code/data/s2search/lightgbm_model.pickle
+    with open(sys.argv[1], 'rb') as f:
+        booster = pickle.load(f)
+    compiled = CompiledTreeEnsemble.from_booster(booster)
+    print(compare_with_booster(compiled, booster))
@@ -1,12 +1,17 @@
 import logging
+import threading
+from time import monotonic
 from typing import Any, Mapping
 
 import weaviate
 from app.services import encoder_service
+from app.utils.readiness import NotReadyError
 from app.utils.types import Publication
+
 from weaviate.gql.get import HybridFusion
+from weaviate.util import generate_uuid5
 
-from ..utils.env import WEAVIATE_URI
+from ..utils.env import WEAVIATE_URI, WEAVIATE_ALIAS_TTL_SECONDS
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -31,120 +36,187 @@ except:
     logger.error("Can't connect to Weaviate")
 
 
+# Publications live in versioned classes (Publication_<version>, or the unversioned
+# Publication from before), a full sync builds a new one next to the live one.
+# Which one is read is the target of the alias object, one object of its own class.
+PUBLICATION_CLASS = "Publication"
+ALIAS_CLASS = "PublicationAlias"
+alias_class = {
+    "class": ALIAS_CLASS,
+    "vectorizer": "none",
+    "properties": [
+        {"dataType": ["text"], "name": "alias"},
+        {"dataType": ["text"], "name": "target"},
+    ],
+}
+alias_uuid = generate_uuid5(PUBLICATION_CLASS)
+
+# the active class, and until when it is trusted without asking Weaviate again
+_active_class = (PUBLICATION_CLASS, float("-inf"))
+_active_class_lock = threading.Lock()
+
+
+def get_active_class(refresh: bool = False) -> str:
+    """The class searches read from, re-read from the alias object at most
+    every WEAVIATE_ALIAS_TTL_SECONDS, so all workers pick up a switch"""
+    global _active_class
+    with _active_class_lock:
+        name, expires_at = _active_class
+        if refresh or monotonic() >= expires_at:
+            try:
+                # before the first blue/green sync there is no alias, only Publication
+                alias = client.data_object.get_by_id(alias_uuid, class_name=ALIAS_CLASS) \
+                    if client.schema.exists(ALIAS_CLASS) else None
+                name = alias["properties"]["target"] if alias else PUBLICATION_CLASS
+            except Exception as e:
+                # Weaviate is down: keep what we had
+                logger.warning(f"Can't read the {ALIAS_CLASS} object: {e}")
+            _active_class = (name, monotonic() + WEAVIATE_ALIAS_TTL_SECONDS)
+        return name
+
+
+def set_active_class(name: str) -> None:
+    """Switch all searches to class name, in one write"""
+    global _active_class
+    if not client.schema.exists(ALIAS_CLASS):
+        client.schema.create_class(alias_class)
+    alias = {"alias": PUBLICATION_CLASS, "target": name}
+    with _active_class_lock:
+        if client.data_object.exists(alias_uuid, class_name=ALIAS_CLASS):
+            client.data_object.replace(alias, class_name=ALIAS_CLASS, uuid=alias_uuid)
+        else:
+            client.data_object.create(alias, class_name=ALIAS_CLASS, uuid=alias_uuid)
+        _active_class = (name, monotonic() + WEAVIATE_ALIAS_TTL_SECONDS)
+    logger.info(f"{PUBLICATION_CLASS} now reads from {name}")
+
+
 def health_check_weaviate() -> bool:
     logger.info("Checking Weaviate readiness...")
     return client.is_ready()
 
 
+def search_publications(query: str, limit=10, offset=0, alpha=0.5, field_filters=[], search_type: str = "default",
+                        min_date_filter=1, max_date_filter=99999, min_citation_filter=0, venue_filter=[],
+                        survey_filter: bool | None = None) -> list[Publication]:
+    """
+    Offset = page * limit. Errors are raised, see get_publications
+    """
+    operands = [
+        {
+            "path": ["n_citations"],
+            "operator": "GreaterThanEqual",
+            "valueInt": min_citation_filter
+        },
+        {
+            "path": ["year"],
+            "operator": "GreaterThanEqual",
+            "valueInt": min_date_filter
+        },
+        {
+            "path": ["year"],
+            "operator": "LessThanEqual",
+            "valueInt": max_date_filter
+        },
+    ]
+
+    if len(venue_filter) != 0:
+        operands.append({
+            "path": ["venue"],
+            "operator": "ContainsAny",
+            "valueStringArray": venue_filter
+        })
+
+    if len(field_filters) != 0:
+        operands.append({
+            "path": ["field_list"],
+            "operator": "ContainsAny",
+            "valueStringArray": field_filters
+        })
+
+    if survey_filter is True:
+        operands.append({
+            "path": ["survey"],
+            "operator": "Equal",
+            "valueBoolean": True
+        })
+
+    class_name = get_active_class()
+    get_builder = client.query.get(
+        class_name,
+        ["neo4jID",
+         "title",
+         "abstract",
+         "venue",
+         "venue_name",
+         "authors",
+         "year",
+         "n_citations",
+         "n_key_citations",
+         "field_list",
+         "publication_date"],
+    )
+
+    if search_type == "default":
+        embeddings = encoder_service.get_embeddings(query)
+        response = (get_builder
+                    .with_additional(["score"])
+                    .with_hybrid(query=query, alpha=alpha, vector=embeddings,
+                                 properties=["title", "abstract", "authors", "venue", "venue_name"], fusion_type=HybridFusion.RELATIVE_SCORE)
+                    # Remove authors and venue? Or add abstract?
+                    .with_where({"operator": "And", "operands": operands})
+                    .with_limit(limit)
+                    .with_offset(offset)
+                    .do()
+                    )
+    elif search_type == "string":
+        search_operands = {"operator": "Or",
+                           "operands": [
+                               {
+                                   "path": ["title"],
+                                   "operator": "Like",
+                                   "valueText": "*" + query + "*"
+                               },
+                               {
+                                   "path": ["venue"],
+                                   "operator": "Like",
+                                   "valueText": "*" + query + "*"
+                               },
+                               {
+                                   "path": ["venue_name"],
+                                   "operator": "Like",
+                                   "valueText": "*" + query + "*"
+                               },
+                               {
+                                   "path": ["authors"],
+                                   "operator": "Like",
+                                   "valueText": "*" + query + "*"
+                               }]}
+        operands.append(search_operands)
+
+        response = (get_builder
+                    .with_additional(["score"])
+                    .with_where({"operator": "And", "operands": operands})
+                    .with_limit(limit)
+                    .do()
+                    )
+
+    result = response["data"]["Get"][class_name]
+    papers = list(map(to_publication, result))
+
+    return papers
+
+
 def get_publications(query: str, limit=10, offset=0, alpha=0.5, field_filters=[], search_type: str = "default",
                      min_date_filter=1, max_date_filter=99999, min_citation_filter=0, venue_filter=[],
                      survey_filter: bool | None = None) -> list[Publication]:
-    """
-    Offset = page * limit
-    """
+    """search_publications, but errors other than a query encoder that is still loading are logged"""
     try:
-        operands = [
-            {
-                "path": ["n_citations"],
-                "operator": "GreaterThanEqual",
-                "valueInt": min_citation_filter
-            },
-            {
-                "path": ["year"],
-                "operator": "GreaterThanEqual",
-                "valueInt": min_date_filter
-            },
-            {
-                "path": ["year"],
-                "operator": "LessThanEqual",
-                "valueInt": max_date_filter
-            },
-        ]
-
-        if len(venue_filter) != 0:
-            operands.append({
-                "path": ["venue"],
-                "operator": "ContainsAny",
-                "valueStringArray": venue_filter
-            })
-
-        if len(field_filters) != 0:
-            operands.append({
-                "path": ["field_list"],
-                "operator": "ContainsAny",
-                "valueStringArray": field_filters
-            })
-
-        if survey_filter is True:
-            operands.append({
-                "path": ["survey"],
-                "operator": "Equal",
-                "valueBoolean": True
-            })
-
-        get_builder = client.query.get(
-            "Publication",
-            ["neo4jID",
-             "title",
-             "abstract",
-             "venue",
-             "venue_name",
-             "authors",
-             "year",
-             "n_citations",
-             "n_key_citations",
-             "field_list",
-             "publication_date"],
-        )
-
-        if search_type == "default":
-            embeddings = encoder_service.get_embeddings(query)
-            response = (get_builder
-                        .with_additional(["score"])
-                        .with_hybrid(query=query, alpha=alpha, vector=embeddings,
-                                     properties=["title", "abstract", "authors", "venue", "venue_name"], fusion_type=HybridFusion.RELATIVE_SCORE)
-                        # Remove authors and venue? Or add abstract?
-                        .with_where({"operator": "And", "operands": operands})
-                        .with_limit(limit)
-                        .with_offset(offset)
-                        .do()
-                        )
-        elif search_type == "string":
-            search_operands = {"operator": "Or",
-                               "operands": [
-                                   {
-                                       "path": ["title"],
-                                       "operator": "Like",
-                                       "valueText": "*" + query + "*"
-                                   },
-                                   {
-                                       "path": ["venue"],
-                                       "operator": "Like",
-                                       "valueText": "*" + query + "*"
-                                   },
-                                   {
-                                       "path": ["venue_name"],
-                                       "operator": "Like",
-                                       "valueText": "*" + query + "*"
-                                   },
-                                   {
-                                       "path": ["authors"],
-                                       "operator": "Like",
-                                       "valueText": "*" + query + "*"
-                                   }]}
-            operands.append(search_operands)
-
-            response = (get_builder
-                        .with_additional(["score"])
-                        .with_where({"operator": "And", "operands": operands})
-                        .with_limit(limit)
-                        .do()
-                        )
-
-        result = response["data"]["Get"]["Publication"]
-        papers = list(map(to_publication, result))
-
-        return papers
+        return search_publications(query, limit=limit, offset=offset, alpha=alpha, field_filters=field_filters,
+                                   search_type=search_type, min_date_filter=min_date_filter,
+                                   max_date_filter=max_date_filter, min_citation_filter=min_citation_filter,
+                                   venue_filter=venue_filter, survey_filter=survey_filter)
+    except NotReadyError:
+        raise
     except Exception as e:
         logger.error(e)
         return {}
@@ -1,18 +1,32 @@
+import hashlib
+import json
 import logging
-import math
-from multiprocessing import Queue
-from queue import Empty
+import os
+import re
+import threading
+from queue import Full, Queue
 from threading import Thread
-from time import perf_counter, sleep
+from time import perf_counter, sleep, time
 
+import numpy as np
 import weaviate
 from weaviate.util import generate_uuid5
 
 from . import neo4j_service
-from ..utils.env import WEAVIATE_URI
+from .weaviate_service import PUBLICATION_CLASS, get_active_class, set_active_class
+from ..utils.cache import bump_generation
+from ..utils.checkpoint import SyncCheckpoint, checkpoint_in_use, load_checkpoint
+from ..utils.env import (WEAVIATE_URI, SYNC_KEY, SYNC_PAGE_SIZE, SYNC_FETCHERS, SYNC_UPLOADERS,
+                         SYNC_QUEUE_SIZE, SYNC_MODE, SYNC_MIN_COUNT_RATIO, SYNC_DROP_GRACE_SECONDS,
+                         SYNC_CHECKPOINT_PATH, SYNC_RESUME_ON_START, SYNC_MAX_RETRIES, SYNC_RETRY_BACKOFF_SECONDS)
 
 logger = logging.getLogger(__name__)
 
+# the Publication node property with the class and fingerprint of what the sync last wrote for it
+SYNC_MARKER_PROPERTY = "weaviateSyncMarker"
+# the default SYNC_KEY, a unique property the sync fills in from the node id
+OWN_SYNC_KEY = "p.syncKey"
+
 client = weaviate.Client(WEAVIATE_URI)
 client.batch.configure(
     batch_size=400,
@@ -20,51 +34,516 @@ client.batch.configure(
 )
 
 
-def start_sync() -> None:
-    client.schema.delete_all()
-    client.schema.create_class(publication_class)
+class StageMetrics:
+    """Pages and rows through one stage of the sync, and the time spent on them"""
+
+    def __init__(self):
+        self.pages = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, rows: int, seconds: float) -> None:
+        with self._lock:
+            self.pages += 1
+            self.rows += rows
+            self.seconds += seconds
+
+    def info(self) -> dict[str, int | float]:
+        with self._lock:
+            return {
+                "pages": self.pages,
+                "rows": self.rows,
+                "seconds": self.seconds,
+                # summed over the threads of the stage, per thread
+                "rows_per_second": self.rows / self.seconds if self.seconds else 0.0,
+            }
+
+
+class SyncMetrics:
+    """Settings, progress and per-stage throughput of one sync"""
+
+    def __init__(self, fetchers: int, uploaders: int, page_size: int, queue_size: int, mode: str = "full"):
+        self.settings = {"fetchers": fetchers, "uploaders": uploaders, "page_size": page_size,
+                         "queue_size": queue_size, "mode": mode}
+        self.state = "running"
+        self.started_at = time()
+        self.finished_at: float | None = None
+        self.stages = {"fetch": StageMetrics(), "transform": StageMetrics(), "upload": StageMetrics()}
+        self.queue: Queue | None = None
+        self.max_queue_depth = 0
+        self.errors = 0
+        # what happened to the objects in Weaviate
+        self.changes = {"upserted": 0, "unchanged": 0, "deleted": 0}
+        self._lock = threading.Lock()
+
+    def queued(self) -> None:
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def error(self) -> None:
+        with self._lock:
+            self.errors += 1
+
+    def changed(self, change: str, n: int) -> None:
+        with self._lock:
+            self.changes[change] += n
+
+    def info(self) -> dict[str, object]:
+        end = self.finished_at or time()
+        uploaded = self.stages["upload"].info()["rows"]
+        return {
+            "state": self.state,
+            "settings": self.settings,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "seconds": end - self.started_at,
+            "rows_per_second": uploaded / (end - self.started_at) if end > self.started_at else 0.0,
+            "stages": {name: stage.info() for name, stage in self.stages.items()},
+            "queue": {"depth": self.queue.qsize() if self.queue else 0, "max_depth": self.max_queue_depth,
+                      "size": self.settings["queue_size"]},
+            "errors": self.errors,
+            "changes": dict(self.changes),
+        }
+
+
+class DeltaState:
+    """The content hash of every object Weaviate has, and which of them the
+    running delta sync has seen in Neo4j so far"""
+
+    def __init__(self, existing: dict[str, str]):
+        self.existing = existing
+        self.seen: set[str] = set()
+        self._lock = threading.Lock()
+
+    def is_unchanged(self, uuid: str, content_hash: str) -> bool:
+        with self._lock:
+            self.seen.add(uuid)
+        return self.existing.get(uuid) == content_hash
+
+    def saw(self, uuids: list[str]) -> None:
+        with self._lock:
+            self.seen.update(uuids)
+
+    def removed(self) -> list[str]:
+        with self._lock:
+            return [uuid for uuid in self.existing if uuid not in self.seen]
+
+
+class PageQueue(Queue):
+    """The bounded queue from fetchers to uploaders. Uploaders sign off when
+    they stop, and once none is left, put_page raises instead of waiting
+    forever for room.
+
+    Arguments:
+        maxsize {int} -- how many pages can wait
+        uploaders {int} -- how many uploaders take pages
+    """
+
+    def __init__(self, maxsize: int, uploaders: int):
+        super().__init__(maxsize)
+        self.uploaders = uploaders
+        self.no_uploaders = threading.Event()
+        self._uploaders_lock = threading.Lock()
+
+    def uploader_stopped(self) -> None:
+        with self._uploaders_lock:
+            self.uploaders -= 1
+            if self.uploaders <= 0:
+                self.no_uploaders.set()
+
+    def put_page(self, item) -> None:
+        while not self.no_uploaders.is_set():
+            try:
+                self.put(item, timeout=1)
+                return
+            except Full:
+                pass
+        raise RuntimeError("No uploader is running")
+
+
+class PublicationPage:
+    """A page of rows from get_data, as columns. The embeddings are one
+    contiguous float32 array instead of a list of Python floats per row,
+    about a tenth of the memory while the page waits in the queue, and
+    uploaders hand its rows to the batch as they are. Rows that are
+    unchanged since the sync last wrote them to the class only have their
+    key and neo4jID.
+
+    Arguments:
+        rows {list} -- rows as returned by get_data's query
+    """
+
+    def __init__(self, rows: list[dict[str, object]]):
+        self.keys = [row["sync_key_"] for row in rows]
+        self.markers = [row.get("sync_marker_") for row in rows]
+        self.unchanged = np.array([bool(row.get("unchanged_")) for row in rows], dtype=bool)
+        # publications without a venue or fields aren't uploaded, unchanged ones don't need to be
+        self.keep = np.array([row["has_venue_"] and row["n_fields_"] > 0 for row in rows], dtype=bool) & ~self.unchanged
+        self.columns = {key: [row[value] for row in rows]
+                        for key, value in publication_properties_dict.items() if key != "embedding"}
+        embeddings = [row[publication_properties_dict["embedding"]] for row in rows]
+        self.has_embedding = np.array([embedding is not None for embedding in embeddings], dtype=bool)
+        dim = next((len(embedding) for embedding in embeddings if embedding is not None), 0)
+        self.embeddings = np.zeros((len(rows), dim), dtype=np.float32)
+        if self.has_embedding.all():
+            self.embeddings[:] = embeddings
+        elif self.has_embedding.any():
+            self.embeddings[self.has_embedding] = [embedding for embedding in embeddings if embedding is not None]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def rows(self):
+        """(properties, embedding or None) of every publication to upload"""
+        names = list(self.columns)
+        for i, values in enumerate(zip(*self.columns.values())):
+            if self.keep[i]:
+                yield dict(zip(names, values)), self.embeddings[i] if self.has_embedding[i] else None
+
+    def unchanged_ids(self) -> list[str]:
+        return [neo4j_id for neo4j_id, unchanged in zip(self.columns["neo4jID"], self.unchanged) if unchanged]
+
+    def new_markers(self) -> list[dict[str, str]]:
+        """{id, marker} of every row whose marker is to be written once the page is"""
+        return [{"id": neo4j_id, "marker": marker}
+                for neo4j_id, marker, unchanged in zip(self.columns["neo4jID"], self.markers, self.unchanged)
+                if marker is not None and not unchanged]
+
+
+class BatchError(Exception):
+    """Weaviate rejected objects of a batch"""
+
+
+def raise_batch_errors(results: list[dict] | None) -> None:
+    # the batch callback, so that a rejected page is retried and recorded instead of only logged
+    errors = [result["result"]["errors"] for result in results or []
+              if "errors" in result.get("result", {})]
+    if errors:
+        raise BatchError(f"{len(errors)} objects were rejected, the first with {errors[0]}")
+
+
+def with_retries(what: str, function, *args):
+    """function(*args), tried again SYNC_MAX_RETRIES times after exponentially longer pauses"""
+    for attempt in range(SYNC_MAX_RETRIES + 1):
+        try:
+            return function(*args)
+        except Exception as e:
+            if attempt == SYNC_MAX_RETRIES:
+                raise
+            delay = SYNC_RETRY_BACKOFF_SECONDS * 2 ** attempt
+            logger.warning(f"{what} failed ({e}), try {attempt + 2} of {SYNC_MAX_RETRIES + 1} in {delay:.1f}s")
+            sleep(delay)
+
+
+# the running or last sync
+sync_metrics: SyncMetrics | None = None
+
+
+def start_sync(fetchers: int = SYNC_FETCHERS, uploaders: int = SYNC_UPLOADERS,
+               page_size: int = SYNC_PAGE_SIZE, queue_size: int = SYNC_QUEUE_SIZE, mode: str = SYNC_MODE,
+               resume: bool = True) -> None:
+    """Copy all publications from Neo4j to Weaviate.
+
+    A full sync uploads everything into a new class (Publication_<time>)
+    while searches keep reading the active one. Once the new class has
+    about as many publications as Neo4j, searches are switched to it and
+    the old class is dropped SYNC_DROP_GRACE_SECONDS later.
+    A delta sync updates the active class in place and only uploads
+    publications whose content hash changed, replacing them by their uuid,
+    and then deletes the objects of publications that are gone. Neo4j only
+    sends the properties and embeddings of publications whose fingerprint
+    changed since the sync last wrote them to the class (see get_data).
+    An active class from before delta syncs, without content hashes, gets
+    a full sync instead.
+
+    With resume, a sync that was interrupted or had pages fail (see
+    SYNC_CHECKPOINT_PATH) is continued, in its mode and class, from the
+    watermarks of its key ranges.
+    """
+    if mode not in ("full", "delta"):
+        raise ValueError(f"Unknown sync mode {mode}, use full or delta")
+    checkpoint = SyncCheckpoint(SYNC_CHECKPOINT_PATH)
+    if not checkpoint.acquire():
+        logger.error(f"A sync is already running (it holds {SYNC_CHECKPOINT_PATH}), not starting another")
+        return
+    try:
+        _sync(checkpoint, fetchers, uploaders, page_size, queue_size, mode, resume)
+    finally:
+        checkpoint.release()
+
+
+def _sync(checkpoint: SyncCheckpoint, fetchers: int, uploaders: int, page_size: int, queue_size: int,
+          mode: str, resume: bool) -> None:
+    global sync_metrics
+    active_class = get_active_class(refresh=True)
+    saved = load_checkpoint(checkpoint.path)
+    previous = saved if resume else None
+    if (previous is not None and previous["state"] in ("running", "incomplete")
+            and previous["sync_key"] == SYNC_KEY and client.schema.exists(previous["class"])):
+        mode, target_class = previous["mode"], previous["class"]
+        state = previous
+        logger.info(f"Resuming the {mode} sync into {target_class} after {previous['rows']} rows")
+    else:
+        state = None
+        if mode == "delta" and client.schema.exists(active_class) and has_property(active_class, "content_hash"):
+            target_class = active_class
+        else:
+            if mode == "delta":
+                logger.info(f"Delta sync: {active_class} has no content hashes, running a full sync instead")
+            mode, target_class = "full", f"{PUBLICATION_CLASS}_{int(time() * 1000)}"
+
+    metrics = sync_metrics = SyncMetrics(fetchers, uploaders, page_size, queue_size, mode)
+    metrics.settings["class"] = target_class
+    metrics.settings["resumed"] = state is not None
+
+    delta = None
+    if mode == "delta":
+        delta = DeltaState(get_content_hashes(target_class))
+        logger.info(f"Delta sync: Weaviate has {len(delta.existing)} publications")
+    elif state is None:
+        client.schema.create_class({**publication_class, "class": target_class})
     # client.schema.create_class(field_class)
 
-    queue = Queue()
-
-    # Create and start the producer and consumer processes
-    producer_thread = Thread(target=producer, args=(queue,))
-    consumer_thread = Thread(target=consumer, args=(queue,))
+    ensure_sync_key_index()
+    try:
+        check_page_plan()
+    except Exception as e:
+        logger.warning(f"Sync: Can't explain the page query: {str(e)}")
+
+    if state is None:
+        state = {
+            "class": target_class, "mode": mode, "sync_key": SYNC_KEY, "started_at": time(),
+            "total_rows": count_rows(), "errors": 0, "failures": [],
+            "pending_drops": saved.get("pending_drops", []) if saved else [],
+            "ranges": [{"after": after, "until": until, "written_until": after, "rows": 0,
+                        "fetched": False, "done": False}
+                       for after, until in key_ranges(fetchers)],
+        }
+    checkpoint.start(state)
+    drop_expired(checkpoint)
+
+    # bounded, so fetchers wait for the uploaders instead of filling memory
+    queue = PageQueue(max(1, queue_size), max(1, uploaders))
+    metrics.queue = queue
+
+    # Create and start the fetcher and uploader threads, each fetcher pages through its own key range
+    fetcher_threads = [
+        Thread(target=fetcher, args=(queue, target_class, range_index, key_range["written_until"],
+                                     key_range["until"], page_size, metrics, checkpoint))
+        for range_index, key_range in enumerate(state["ranges"]) if not key_range["done"]]
+    uploader_threads = [Thread(target=uploader, args=(queue, metrics, delta, checkpoint))
+                        for _ in range(max(1, uploaders))]
 
     t1_start = perf_counter()
 
-    producer_thread.start()
-    consumer_thread.start()
+    for thread in fetcher_threads + uploader_threads:
+        thread.start()
 
-    producer_thread.join()
-    consumer_thread.join()
+    for thread in fetcher_threads:
+        thread.join()
+    # Done, one stop for every uploader that is still running
+    for _ in uploader_threads:
+        try:
+            queue.put_page(None)
+        except RuntimeError:
+            break
+    for thread in uploader_threads:
+        thread.join()
+
+    if metrics.errors:
+        # the failed pages are behind the watermarks, resuming writes them
+        logger.error(f"Sync: {metrics.errors} errors, {target_class} is incomplete. "
+                     f"POST /v1/weaviate/sync resumes it")
+        metrics.state = "incomplete"
+    elif delta is not None:
+        if metrics.settings["resumed"]:
+            # objects written before the interruption weren't seen, the next delta sync deletes removed ones
+            logger.info("Delta sync: resumed, not deleting any objects")
+        else:
+            delete_objects(target_class, delta.removed(), metrics)
+        if metrics.changes["upserted"] or metrics.changes["deleted"]:
+            bump_generation("by the Weaviate sync end")
+        metrics.state = "done"
+    else:
+        metrics.state = "done" if switch_to(target_class, active_class, metrics, checkpoint) else "failed"
+    checkpoint.finish(metrics.state)
+    drop_expired(checkpoint)
 
     t1_stop = perf_counter()
+    metrics.finished_at = time()
 
     logger.info(
         f"Elapsed time during the whole program in seconds: {t1_stop - t1_start}"
     )
-
-
-def producer(queue: Queue) -> None:
-    n_total_publications = neo4j_service.use_neo4j(
-        f"""
-            MATCH (p:Publication)
-            RETURN count(*)
-            """)
-    n_total_publications = n_total_publications[0]['count(*)']
-    n_increments = 200
-    n_sync_steps = math.ceil(n_total_publications / n_increments)
-
-    for i in range(n_sync_steps):
-        queue.put(
-            get_data(
-                properties_list=list(publication_properties_dict.values()),
-                data_type="Publication",
-                increment=n_increments,
-                offset=i,
-            )
-        )
+    logger.info(f"Sync metrics: {metrics.info()}")
+
+
+def resume_interrupted() -> None:
+    """Continue, on a background thread, a sync that stopped with the process.
+    Otherwise drop the replaced classes that were due while it was down (a
+    resumed sync drops them itself)."""
+    state = load_checkpoint(SYNC_CHECKPOINT_PATH)
+    if state is None or checkpoint_in_use(SYNC_CHECKPOINT_PATH):
+        return
+    if SYNC_RESUME_ON_START and state["state"] == "running":
+        Thread(target=start_sync, name="weaviate-sync", daemon=True).start()
+    elif state.get("pending_drops"):
+        Thread(target=drop_expired_classes, name="weaviate-drop", daemon=True).start()
+
+
+def sync_status() -> dict[str, object] | None:
+    """Progress of the running or last sync, from its checkpoint"""
+    state = load_checkpoint(SYNC_CHECKPOINT_PATH)
+    if state is None:
+        return None
+    running = state["state"] == "running"
+    if running and not checkpoint_in_use(SYNC_CHECKPOINT_PATH):
+        state["state"] = "interrupted"
+    rows, total = state["rows"], state["total_rows"]
+    seconds = state["updated_at"] - state["resumed_at"]
+    rate = (rows - state["rows_at_resume"]) / seconds if seconds > 0 else 0.0
+    return {
+        "state": state["state"],
+        "class": state["class"],
+        "mode": state["mode"],
+        "started_at": state["started_at"],
+        "updated_at": state["updated_at"],
+        "rows": rows,
+        "total_rows": total,
+        "progress": min(rows / total, 1.0) if total else None,
+        "rows_per_second": rate,
+        "eta_seconds": max(total - rows, 0) / rate if state["state"] == "running" and rate else None,
+        "ranges": {"done": sum(key_range["done"] for key_range in state["ranges"]), "total": len(state["ranges"])},
+        "errors": state["errors"],
+        "failures": state["failures"][-10:],
+    }
+
+
+def switch_to(target_class: str, previous_class: str, metrics: SyncMetrics, checkpoint: SyncCheckpoint) -> bool:
+    """Point searches at the freshly filled target_class if it is complete,
+    and drop previous_class after the grace period. An incomplete class is
+    dropped right away and searches stay where they are."""
+    expected = count_publications()
+    actual = count_objects(target_class)
+    metrics.settings["expected"], metrics.settings["uploaded"] = expected, actual
+    if actual < expected * SYNC_MIN_COUNT_RATIO:
+        logger.error(f"Full sync: {target_class} has {actual} of {expected} publications, keeping {previous_class}")
+        client.schema.delete_class(target_class)
+        return False
+
+    set_active_class(target_class)
+    bump_generation("by the Weaviate sync end")
+    # searches that already read previous_class can finish, workers pick up the switch
+    if previous_class != target_class:
+        checkpoint.schedule_drop(previous_class, time() + SYNC_DROP_GRACE_SECONDS)
+        # a moment late, so that the drop is due. If the process stops first, the next start
+        # or sync drops it
+        timer = threading.Timer(SYNC_DROP_GRACE_SECONDS + 1, drop_expired_classes)
+        timer.daemon = True
+        timer.start()
+    return True
+
+
+def drop_expired(checkpoint: SyncCheckpoint) -> None:
+    """Drop the replaced classes in the held checkpoint that are due"""
+    for name in checkpoint.expired_drops():
+        try:
+            drop_class(name)
+        except Exception as e:
+            logger.error(f"Can't drop the old class {name}, trying again with the next sync: {str(e)}")
+            continue
+        checkpoint.dropped(name)
+
+
+def drop_expired_classes() -> None:
+    """Drop the replaced classes that are due, unless a sync holds the
+    checkpoint (it drops them when it ends)"""
+    checkpoint = SyncCheckpoint(SYNC_CHECKPOINT_PATH)
+    if not checkpoint.acquire():
+        return
+    try:
+        state = load_checkpoint(checkpoint.path)
+        if state is not None:
+            checkpoint.state = state
+            drop_expired(checkpoint)
+    finally:
+        checkpoint.release()
+
+
+def drop_class(name: str) -> None:
+    """Delete the publication class name, unless searches read it (again)"""
+    if get_active_class(refresh=True) == name or not client.schema.exists(name):
+        return
+    logger.info(f"Dropping the old class {name}")
+    client.schema.delete_class(name)
+
+
+def count_publications() -> int:
+    """How many publications a full sync should upload: those with a venue and fields"""
+    result = neo4j_service.use_neo4j(
+        """
+        MATCH (p:Publication)
+        WHERE EXISTS { (p)-[:PUBLISHED_AT]->(:Venue) } AND EXISTS { (p)-[:HAS_FIELD_OF_STUDY]-(:FieldOfStudy) }
+        RETURN count(p) AS n
+        """)
+    return result[0]["n"]
+
+
+def count_rows() -> int:
+    """How many rows the fetchers page through"""
+    return neo4j_service.use_neo4j("MATCH (p:Publication) RETURN count(p) AS n")[0]["n"]
+
+
+def count_objects(class_name: str) -> int:
+    response = client.query.aggregate(class_name).with_meta_count().do()
+    return response["data"]["Aggregate"][class_name][0]["meta"]["count"]
+
+
+def key_ranges(n_ranges: int) -> list[tuple[object, object]]:
+    """Split the SYNC_KEY values of all publications into up to n_ranges
+    disjoint (after, until] ranges of about equal width. Only numeric keys
+    can be split, other keys are read as one range.
+    """
+    bounds = neo4j_service.use_neo4j(f"MATCH (p:Publication) RETURN min({SYNC_KEY}) AS lo, max({SYNC_KEY}) AS hi")
+    lo, hi = (bounds[0]["lo"], bounds[0]["hi"]) if bounds else (None, None)
+    if n_ranges <= 1 or not isinstance(lo, (int, float)) or not isinstance(hi, (int, float)) or hi <= lo:
+        return [(None, None)]
+
+    if isinstance(lo, int) and isinstance(hi, int):
+        edges = {lo + (hi - lo) * i // n_ranges for i in range(1, n_ranges)}
+    else:
+        edges = {lo + (hi - lo) * i / n_ranges for i in range(1, n_ranges)}
+    edges = sorted(edges)
+    return list(zip([None, *edges], [*edges, None]))
+
+
+def fetcher(queue: PageQueue, class_name: str, range_index: int, after, until, page_size: int,
+            metrics: SyncMetrics, checkpoint: SyncCheckpoint) -> None:
+    # keyset pagination: every page starts after the last key of the one before,
+    # so Neo4j never rescans skipped rows and rows added during the sync aren't paged twice
+    try:
+        while True:
+            t_start = perf_counter()
+            entry = with_retries(f"Fetching after key {after}", get_data,
+                                 list(publication_properties_dict.values()), class_name, page_size, after, until)
+            _, _, page = entry
+            metrics.stages["fetch"].add(len(page), perf_counter() - t_start)
+            if not len(page):
+                break
+            # registered before an uploader can write it
+            checkpoint.fetched(range_index, after, page.keys[-1], len(page))
+            queue.put_page((range_index, entry))
+            metrics.queued()
+            # rows are ordered by key, there can be several per publication
+            after = page.keys[-1]
+            if len(set(page.keys)) < page_size:
+                break
+        checkpoint.fetch_done(range_index)
+    except Exception as e:
+        metrics.error()
+        checkpoint.failed(range_index, after, e)
+        logger.error(f"Fetcher: An exception occurred after key {after}: {str(e)}")
 
     # 100 ish entries
     # queue.put(
@@ -74,91 +553,257 @@ def producer(queue: Queue) -> None:
     #     )
     # )
 
-    # Done
-    queue.put(None)
-
 
-def consumer(queue: Queue) -> None:
-    while True:
-        try:
+def uploader(queue: PageQueue, metrics: SyncMetrics, delta: DeltaState | None,
+             checkpoint: SyncCheckpoint) -> None:
+    try:
+        # the batch of a weaviate client can't be shared between threads
+        uploader_client = weaviate.Client(WEAVIATE_URI)
+        uploader_client.batch.configure(
+            batch_size=400,
+            dynamic=True,
+            callback=raise_batch_errors,
+        )
+    except Exception as e:
+        metrics.error()
+        logger.error(f"Uploader: Can't connect to Weaviate: {str(e)}")
+        queue.uploader_stopped()
+        return
+
+    try:
+        while True:
             result = queue.get()
 
             # check for stop
             if result is None:
                 break
 
-            process_data(result)
+            range_index, entry = result
+            _, after, _ = entry
+            try:
+                # objects have fixed uuids, writing a page again replaces them
+                with_retries(f"Uploading after key {after}", process_data, entry, uploader_client, metrics, delta)
+                checkpoint.written(range_index, after)
+            except Exception as e:
+                metrics.error()
+                checkpoint.failed(range_index, after, e)
+                logger.error(f"Uploader: An exception occurred after key {after}: {str(e)}")
+    finally:
+        queue.uploader_stopped()
+
+    logger.info("Uploader: Done all")
 
-        except Empty:
-            logger.info("Consumer: got nothing, waiting a while...")
-            sleep(0.5)
-            continue
-        except Exception as e:
-            logger.info(f"Consumer: An exception occurred: {str(e)}")
-            continue
 
-    logger.info("Consumer: Done all")
+def has_property(class_name: str, name: str) -> bool:
+    properties = client.schema.get(class_name).get("properties") or []
+    return any(prop["name"] == name for prop in properties)
+
+
+def get_content_hashes(class_name: str, page_size: int = 2000) -> dict[str, str]:
+    """uuid -> content_hash of every object of class_name, read with the cursor API"""
+    hashes = {}
+    after = None
+    while True:
+        query = (client.query.get(class_name, ["content_hash"])
+                 .with_additional(["id"])
+                 .with_limit(page_size))
+        if after is not None:
+            query = query.with_after(after)
+        objects = query.do()["data"]["Get"][class_name]
+        if not objects:
+            return hashes
+        for obj in objects:
+            hashes[obj["_additional"]["id"]] = obj.get("content_hash")
+        after = objects[-1]["_additional"]["id"]
+
+
+def delete_objects(class_name: str, uuids: list[str], metrics: SyncMetrics, chunk_size: int = 1000) -> None:
+    for start in range(0, len(uuids), chunk_size):
+        chunk = uuids[start:start + chunk_size]
+        client.batch.delete_objects(
+            class_name=class_name,
+            where={"path": ["id"], "operator": "ContainsAny", "valueTextArray": chunk},
+        )
+        metrics.changed("deleted", len(chunk))
+    logger.info(f"Delta sync: deleted {len(uuids)} publications that are gone from Neo4j")
+
+
+def content_hash(data_object: dict[str, object], vector: np.ndarray | None) -> str:
+    """A hash of everything that is uploaded for a publication, the bytes of its embedding included"""
+    content = hashlib.sha256(json.dumps(data_object, sort_keys=True, default=str).encode())
+    if vector is not None:
+        content.update(vector.tobytes())
+    return content.hexdigest()
+
+
+def ensure_sync_key_index() -> None:
+    """A SYNC_KEY that is a Publication property needs a range index for the
+    pages to be read in index order. The index is named after the property,
+    so changing SYNC_KEY gets a new one.
+
+    The sync's own key, OWN_SYNC_KEY, is written to Neo4j: a uniqueness
+    constraint on it is created, and publications that don't have it yet
+    are given their node id, in one pass that commits every 10000 rows.
+    """
+    if not SYNC_KEY.startswith("p."):
+        return
+    name = "publication_sync_key_" + re.sub(r"\W", "_", SYNC_KEY[2:])
+    if SYNC_KEY != OWN_SYNC_KEY:
+        neo4j_service.use_neo4j(f"CREATE INDEX {name} IF NOT EXISTS FOR (p:Publication) ON ({SYNC_KEY})")
+        return
+
+    # the uniqueness constraint comes with a range index
+    neo4j_service.use_neo4j(
+        f"CREATE CONSTRAINT {name} IF NOT EXISTS FOR (p:Publication) REQUIRE {SYNC_KEY} IS UNIQUE")
+    # node ids are unique among the nodes there are
+    result = neo4j_service.run_neo4j_auto_commit(
+        f"""
+        MATCH (p:Publication) WHERE {SYNC_KEY} IS NULL
+        CALL {{ WITH p SET {SYNC_KEY} = id(p) }} IN TRANSACTIONS OF 10000 ROWS
+        RETURN count(*) AS filled
+        """)
+    if result and result[0]["filled"]:
+        logger.info(f"Sync: gave {result[0]['filled']} publications their {SYNC_KEY}")
+
+
+def page_query(properties_list: list[str], after=None, until=None) -> str:
+    """The query for a page of rows with keys in (after, until]. Only the bounds
+    that are set go into the WHERE, as the plain range predicates Neo4j can
+    answer with a seek of the key's range index, in index order, so the
+    ORDER BY ... LIMIT reads just the page. The bounds themselves are
+    parameters, $after and $until.
+    """
+    bounds = []
+    if after is not None:
+        bounds.append(f"{SYNC_KEY} > $after")
+    if until is not None:
+        bounds.append(f"{SYNC_KEY} <= $until")
+    # without bounds, the index is still scanned in order. Rows without a key can't be paged by it
+    where = " AND ".join(bounds) or f"{SYNC_KEY} IS NOT NULL"
+
+    # columns keep the names they'd have unaliased, the neo4jID one is returned for every row
+    properties_in_with = ",".join(f"{prop} AS `{prop}`" for prop in properties_list)
+    properties_in_fingerprint = ",".join(f"`{prop}`" for prop in properties_list)
+    properties_in_return = ",".join(
+        f"`{prop}`" if prop == publication_properties_dict["neo4jID"]
+        else f"CASE WHEN unchanged_ THEN null ELSE `{prop}` END AS `{prop}`"
+        for prop in properties_list)
+
+    # publications without a venue or fields are still returned (and skipped in process_data),
+    # so that a page is only short at the end. The marker is the class and a fingerprint of the
+    # row, computed in Neo4j. If the node has the same one, the sync already wrote that row
+    # to the class, and only its key and id are sent
+    return f"""
+        MATCH (p:Publication)
+        WHERE {where}
+        WITH p
+        ORDER BY {SYNC_KEY}
+        LIMIT $increment
+        OPTIONAL MATCH (p)-[:PUBLISHED_AT]->(v:Venue)
+        OPTIONAL MATCH (p)-[:HAS_FIELD_OF_STUDY]-(f:FieldOfStudy)
+        WITH p, {SYNC_KEY} AS sync_key_, v IS NOT NULL AS has_venue_, count(f) AS n_fields_,
+             {properties_in_with}
+        WITH *, $class_name + ':' + apoc.hashing.fingerprint([has_venue_, n_fields_, {properties_in_fingerprint}])
+             AS sync_marker_
+        WITH *, coalesce(p.{SYNC_MARKER_PROPERTY} = sync_marker_, false) AS unchanged_
+        RETURN sync_key_, has_venue_, n_fields_, sync_marker_, unchanged_,
+               {properties_in_return}
+        ORDER BY sync_key_
+        """
+
+
+def check_page_plan() -> None:
+    """Logs a warning if Neo4j plans the pages of a SYNC_KEY that is a
+    Publication property without its index, checked with EXPLAIN"""
+    if not SYNC_KEY.startswith("p."):
+        return
+    lowest = neo4j_service.use_neo4j(f"MATCH (p:Publication) RETURN min({SYNC_KEY}) AS lo")
+    after = lowest[0]["lo"] if lowest else None
+    query = page_query(list(publication_properties_dict.values()), after=after)
+    operators = neo4j_service.explain_neo4j(
+        query, {"after": after, "until": None, "increment": 1, "class_name": "Publication"})
+    if not any(operator.startswith("NodeIndex") for operator in operators):
+        logger.warning(f"Sync: pages by {SYNC_KEY} are planned without its index: {' > '.join(operators)}")
+    else:
+        logger.info(f"Sync: pages by {SYNC_KEY} are planned as {' > '.join(operators)}")
 
 
 def get_data(
         properties_list: list[str],
         data_type: str,
         increment=200,
-        offset=0,
-) -> list[dict[str, object]]:
+        after=None,
+        until=None,
+) -> tuple[str, object, PublicationPage]:
     t_start = perf_counter()
 
-    properties_list_in_string = ",".join(properties_list)
-
     result = neo4j_service.use_neo4j(
-        f"""
-        MATCH (p:Publication)-[:PUBLISHED_AT]->(v:Venue)
-        WITH p, v
-        SKIP {increment * offset} 
-        LIMIT {increment}
-        MATCH (p)-[:HAS_FIELD_OF_STUDY]-(f:FieldOfStudy)
-        RETURN {properties_list_in_string}
-        """)
+        page_query(properties_list, after, until),
+        {"after": after, "until": until, "increment": increment, "class_name": data_type})
 
     t_stop = perf_counter()
     logger.info(
-        f"Got {data_type} for offset {offset} with time : {t_stop - t_start}")
-    return (data_type, offset, result)
+        f"Got {data_type} after key {after} with time : {t_stop - t_start}")
+    return (data_type, after, PublicationPage(result))
 
 
-def process_data(entry: tuple[str, int, list[dict[str, object]]]) -> None:
-    data_type, offset, neo4j_entity_list = entry
-    property_list = publication_properties_dict.items()
+def process_data(entry: tuple[str, object, PublicationPage], weaviate_client: weaviate.Client = client,
+                 metrics: SyncMetrics | None = None, delta: DeltaState | None = None) -> None:
+    data_type, after, page = entry
 
     t_start = perf_counter()
 
     # Transform data
-    data_list: list[dict] = []
-    for neo4j_entity in neo4j_entity_list:
-        temp = {}
-        for key, value in property_list:
-            # logger.info(neo4j_entity["p.publicationDate"])
-            temp[key] = neo4j_entity[value]
-        data_list.append(temp)
-
-    # Send data to weaviate
-    with client.batch as batch:
-        for list_entry in data_list:
-            cur_vector: list[float] = list_entry.pop("embedding")
-
+    data_list: list[tuple[dict, np.ndarray | None]] = []
+    for data_object, vector in page.rows():
+        data_object["content_hash"] = content_hash(data_object, vector)
+        data_list.append((data_object, vector))
+
+    n_transformed = len(data_list)
+    n_unchanged = int(page.unchanged.sum())
+    if delta is not None:
+        delta.saw([generate_uuid5(neo4j_id) for neo4j_id in page.unchanged_ids()])
+        data_list = [(data_object, vector) for data_object, vector in data_list
+                     if not delta.is_unchanged(generate_uuid5(data_object["neo4jID"]), data_object["content_hash"])]
+
+    t_transformed = perf_counter()
+
+    # Send data to weaviate, the client takes the float32 rows as they are
+    with weaviate_client.batch as batch:
+        for data_object, vector in data_list:
             batch.add_data_object(
-                data_object=list_entry,
+                data_object=data_object,
                 class_name=data_type,
-                vector=cur_vector,
-                uuid=generate_uuid5(list_entry["neo4jID"]),
+                vector=vector,
+                uuid=generate_uuid5(data_object["neo4jID"]),
             )
+    write_sync_markers(page)
 
     t_stop = perf_counter()
+    if metrics is not None:
+        metrics.stages["transform"].add(n_transformed, t_transformed - t_start)
+        metrics.stages["upload"].add(len(data_list), t_stop - t_transformed)
+        metrics.changed("upserted", len(data_list))
+        metrics.changed("unchanged", n_transformed - len(data_list) + n_unchanged)
     logger.info(
-        f"Transfered {data_type} for offset {offset} with time : {t_stop - t_start}"
+        f"Transfered {data_type} after key {after} with time : {t_stop - t_start}"
     )
 
 
+def write_sync_markers(page: PublicationPage) -> None:
+    """Store the markers of a written page on its nodes, so that later syncs
+    into the same class skip them while they don't change"""
+    markers = page.new_markers()
+    if markers:
+        neo4j_service.use_neo4j(
+            f"""
+            UNWIND $markers AS marker
+            MATCH (p:Publication) WHERE elementId(p) = marker.id
+            SET p.{SYNC_MARKER_PROPERTY} = marker.marker
+            """,
+            {"markers": markers})
+
+
 publication_properties_dict = {
     "neo4jID": "elementId(p)",
     "embedding": "p.embedding",
@@ -181,7 +826,7 @@ publication_properties_dict = {
 
 # Classes
 publication_class = {
-    "class": "Publication",
+    "class": PUBLICATION_CLASS,
     "properties": [
         {
             "dataType": ["text"],
@@ -229,5 +874,38 @@ publication_class = {
             "dataType": ["text"],
             "name": "publication_date",
         },
+        # For delta syncs, not searched
+        {
+            "dataType": ["text"],
+            "name": "content_hash",
+            "indexFilterable": False,
+            "indexSearchable": False,
+        },
     ],
 }
+
+
+def benchmark_transform(n_rows: int = 2000, dim: int = 768, page_size: int = SYNC_PAGE_SIZE) -> float:
+    """Rows per second from get_data's rows to the objects and vectors
+    handed to the batch, on made-up publications with dim-d embeddings"""
+    rng = np.random.default_rng(0)
+    rows = []
+    for i in range(n_rows):
+        row = {value: f"{key} {i}" for key, value in publication_properties_dict.items()}
+        row.update({publication_properties_dict["embedding"]: rng.standard_normal(dim).tolist(),
+                    publication_properties_dict["year"]: 2000 + i % 25,
+                    publication_properties_dict["authors"]: ["Ada Lovelace", "Alan Turing"],
+                    publication_properties_dict["field_list"]: ["4:field:1", "4:field:2"],
+                    "sync_key_": i, "has_venue_": True, "n_fields_": 2})
+        rows.append(row)
+    pages = [rows[start:start + page_size] for start in range(0, n_rows, page_size)]
+    t_start = perf_counter()
+    for page in pages:
+        for data_object, vector in PublicationPage(page).rows():
+            data_object["content_hash"] = content_hash(data_object, vector)
+    return n_rows / (perf_counter() - t_start)
+
+
+if __name__ == '__main__':
+    # transform throughput of the sync: python -m app.services.weaviate_sync_service
+    print(f"{benchmark_transform():.0f} rows/s")
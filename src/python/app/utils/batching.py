@@ -0,0 +1,96 @@
+import logging
+import threading
+from concurrent.futures import Future
+from queue import Empty, Queue
+from time import monotonic
+from typing import Any, Callable, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """Gathers items submitted by concurrent callers into batches for a
+    function that is much cheaper per item on a batch, e.g. a model forward
+    pass. A batch is run as soon as it has max_batch_size items, or max_wait
+    seconds after its first item arrived, on one background thread.
+
+    Arguments:
+        batch_function {callable} -- maps a list of items to a list of results, in order
+        max_batch_size {int} -- how many items to run together at most
+        max_wait {float} -- how many seconds the first item of a batch waits for more
+    """
+
+    def __init__(self, batch_function: Callable[[list], Sequence], max_batch_size: int = 32,
+                 max_wait: float = 0.005, name: str = "micro-batcher"):
+        self.batch_function = batch_function
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.name = name
+        self.n_items = 0
+        self.n_batches = 0
+        self.largest_batch = 0
+        self._queue: Queue[tuple[Any, Future]] = Queue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def submit(self, item: Any) -> Future:
+        """Queue item for the next batch, its result will be in the returned future"""
+        future = Future()
+        self._ensure_started()
+        self._queue.put((item, future))
+        return future
+
+    def map(self, items: Sequence) -> list:
+        """Results of all items, in order, batched with whatever else is queued"""
+        futures = [self.submit(item) for item in items]
+        return [future.result() for future in futures]
+
+    def _ensure_started(self) -> None:
+        # started on first use, so that forked workers each get their own thread
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                    self._thread.start()
+
+    def _next_batch(self) -> list[tuple[Any, Future]]:
+        batch = [self._queue.get()]
+        deadline = monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - monotonic()
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            # callers that gave up don't need a result
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            self.n_items += len(batch)
+            self.n_batches += 1
+            self.largest_batch = max(self.largest_batch, len(batch))
+            try:
+                results = self.batch_function([item for item, _ in batch])
+                for (_, future), result in zip(batch, results, strict=True):
+                    future.set_result(result)
+            except Exception as error:
+                logger.exception(f"{self.name}: batch of {len(batch)} failed")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def info(self) -> dict[str, int | float]:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait": self.max_wait,
+            "queued": self._queue.qsize(),
+            "items": self.n_items,
+            "batches": self.n_batches,
+            "mean_batch_size": self.n_items / self.n_batches if self.n_batches else 0.0,
+            "largest_batch": self.largest_batch,
+        }
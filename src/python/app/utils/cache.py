@@ -0,0 +1,667 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import struct
+import sys
+import threading
+from collections import OrderedDict
+from time import monotonic, time
+from typing import Any, Callable
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# how long a process trusts the generation it read last from a shared backend
+GENERATION_CHECK_SECONDS = 1.0
+# first bytes of every value in the shared backends
+FORMAT_MAGIC = b"nlpkg-cache-1\0"
+
+
+def estimate_size(value: Any, _seen: set | None = None) -> int:
+    """Rough size of a value in bytes, including what it refers to.
+
+    Objects can report their own size with an nbytes attribute, which is
+    how NumPy arrays, candidate sets and rankings are measured. Objects
+    referenced more than once inside the value are counted once.
+    """
+    if _seen is None:
+        _seen = set()
+    if id(value) in _seen:
+        return 0
+    _seen.add(id(value))
+
+    nbytes = getattr(value, "nbytes", None)
+    if isinstance(nbytes, int):
+        return nbytes + (0 if isinstance(value, np.ndarray) else sys.getsizeof(value))
+
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(key, _seen) + estimate_size(item, _seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, _seen) for item in value)
+    return size
+
+
+def key_token(value: Any) -> str:
+    """A representation of a function argument that is the same in every
+    process. Objects can provide their own with a cache_key attribute.
+    """
+    token = getattr(value, "cache_key", None)
+    if isinstance(token, str):
+        return token
+    if isinstance(value, (tuple, list)):
+        return "(" + ",".join(key_token(item) for item in value) + ")"
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return repr(value)
+    raise TypeError(f"Can't build a cache key from a {type(value).__name__}")
+
+
+# classes whose instances the shared backends can store, by name, see cache_type
+_value_types: dict[str, type] = {}
+
+
+def cache_type(cls):
+    """Class decorator for values the shared backends can store. The class
+    provides to_cache(), its state made of the types dumps supports, and a
+    classmethod from_cache(state) that builds an instance from it again.
+    """
+    _value_types[cls.__name__] = cls
+    return cls
+
+
+def dumps(value: Any) -> bytes:
+    """value as bytes for the shared backends. Unlike pickle, reading them
+    back with loads can't run code, whoever wrote them: the format only has
+    JSON, tuples, dicts with any such keys, NumPy arrays of plain dtypes and
+    the classes registered with cache_type.
+    """
+    arrays: list[np.ndarray] = []
+
+    def encode(item):
+        if item is None or isinstance(item, (str, bool, int, float)):
+            return item
+        if isinstance(item, np.generic):
+            return item.item()
+        if isinstance(item, list):
+            return [encode(element) for element in item]
+        if isinstance(item, tuple):
+            return {"__tuple__": [encode(element) for element in item]}
+        if isinstance(item, dict):
+            if all(isinstance(key, str) and not key.startswith("__") for key in item):
+                return {key: encode(element) for key, element in item.items()}
+            return {"__dict__": [[encode(key), encode(element)] for key, element in item.items()]}
+        if isinstance(item, np.ndarray):
+            if item.dtype.hasobject:
+                raise TypeError("Can't store a NumPy array of objects in the result cache")
+            arrays.append(np.ascontiguousarray(item))
+            return {"__ndarray__": len(arrays) - 1}
+        if _value_types.get(type(item).__name__) is type(item):
+            return {"__type__": type(item).__name__, "state": encode(item.to_cache())}
+        raise TypeError(f"Can't store a {type(item).__name__} in the result cache")
+
+    header = json.dumps({
+        "value": encode(value),
+        "arrays": [[array.dtype.str, array.shape] for array in arrays],
+    }, separators=(",", ":")).encode()
+    return b"".join([FORMAT_MAGIC, struct.pack("<Q", len(header)), header,
+                     *(array.tobytes() for array in arrays)])
+
+
+def loads(data: bytes) -> Any:
+    """A value written with dumps. Raises a ValueError for anything else."""
+    if not data.startswith(FORMAT_MAGIC):
+        raise ValueError("Not a result cache value")
+    start = len(FORMAT_MAGIC) + 8
+    try:
+        (header_size,) = struct.unpack_from("<Q", data, len(FORMAT_MAGIC))
+        header = json.loads(data[start:start + header_size])
+        offset = start + header_size
+        arrays = []
+        for dtype, shape in header["arrays"]:
+            dtype = np.dtype(dtype)
+            if dtype.hasobject:
+                raise ValueError("NumPy array of objects")
+            count = int(np.prod(shape, dtype=np.int64))
+            arrays.append(np.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape(shape))
+            offset += count * dtype.itemsize
+    except (KeyError, TypeError, struct.error) as error:
+        raise ValueError(f"Broken result cache value: {error}") from error
+
+    def decode(item):
+        if isinstance(item, list):
+            return [decode(element) for element in item]
+        if not isinstance(item, dict):
+            return item
+        if "__tuple__" in item:
+            return tuple(decode(element) for element in item["__tuple__"])
+        if "__dict__" in item:
+            return {decode(key): decode(element) for key, element in item["__dict__"]}
+        if "__ndarray__" in item:
+            return arrays[item["__ndarray__"]]
+        if "__type__" in item:
+            cls = _value_types.get(item["__type__"])
+            if cls is None:
+                raise ValueError(f"Unknown result cache type {item['__type__']}")
+            return cls.from_cache(decode(item["state"]))
+        return {key: decode(element) for key, element in item.items()}
+
+    return decode(header["value"])
+
+
+def make_key(name: str, generation: int, args: tuple, kwargs: dict) -> str:
+    token = key_token(args) + key_token(tuple(sorted(kwargs.items())))
+    return f"{name}:{generation}:{hashlib.blake2b(token.encode(), digest_size=16).hexdigest()}"
+
+
+class MemoryBackend:
+    """Results kept as Python objects in this process, in one LRU that is
+    bounded by the number of entries and by their estimated size in bytes.
+
+    Arguments:
+        max_entries {int} -- how many entries to keep at most
+        max_bytes {int} -- how many bytes the entries may take up together
+    """
+
+    kind = "memory"
+
+    def __init__(self, max_entries: int = 512, max_bytes: int = 512 * 2**20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejections = 0
+        self._generation = 0
+        # key -> (value, size, expires_at)
+        self._data: OrderedDict[str, tuple[Any, int, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, _, expires_at = entry
+            if monotonic() >= expires_at:
+                self._remove(key)
+                self.expirations += 1
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Any, ttl: float) -> None:
+        if self.max_entries <= 0:
+            return
+        size = estimate_size(value)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            if size > self.max_bytes:
+                # would push out everything else and still not fit
+                self.rejections += 1
+                return
+            self._data[key] = (value, size, monotonic() + ttl)
+            self.nbytes += size
+            while len(self._data) > self.max_entries or self.nbytes > self.max_bytes:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._data.pop(key)
+        self.nbytes -= size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def generation(self) -> int:
+        return self._generation
+
+    def bump_generation(self) -> int:
+        self._generation += 1
+        # nothing can look up entries of older generations anymore
+        self.clear()
+        return self._generation
+
+    def info(self) -> dict[str, int | float | str]:
+        with self._lock:
+            return {
+                "kind": self.kind,
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "rejections": self.rejections,
+            }
+
+
+class SqliteBackend:
+    """Results in a sqlite file (as written by dumps), shared by all worker processes on a
+    host and kept across restarts. The least recently used entries are
+    deleted once there are more than max_entries or more than max_bytes.
+
+    Arguments:
+        path {str} -- the sqlite database file, created if it doesn't exist
+        max_entries {int} -- how many entries to keep at most
+        max_bytes {int} -- how many bytes of stored values to keep at most
+    """
+
+    kind = "sqlite"
+
+    def __init__(self, path: str, max_entries: int = 512, max_bytes: int = 512 * 2**20):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self.rejections = 0
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, "
+                "size INTEGER, expires_at REAL, accessed_at REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+            connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+            connection.execute("INSERT OR IGNORE INTO meta VALUES ('generation', 0)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads, and must not survive a fork
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key: str) -> Any:
+        connection = self._connection()
+        now = time()
+        row = connection.execute(
+            "SELECT value, accessed_at FROM entries WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+        if row is None:
+            return None
+        data, accessed_at = row
+        if now - accessed_at > GENERATION_CHECK_SECONDS:
+            # keep writes on the read path rare
+            connection.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        return loads(data)
+
+    def put(self, key: str, value: Any, ttl: float) -> None:
+        if self.max_entries <= 0:
+            return
+        data = dumps(value)
+        if len(data) > self.max_bytes:
+            self.rejections += 1
+            return
+        now = time()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("DELETE FROM entries WHERE expires_at <= ?", (now,))
+            connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                               (key, data, len(data), now + ttl, now))
+            n_entries, n_bytes = connection.execute("SELECT count(*), coalesce(sum(size), 0) FROM entries").fetchone()
+            if n_entries > self.max_entries or n_bytes > self.max_bytes:
+                evicted = 0
+                for old_key, size in connection.execute(
+                        "SELECT key, size FROM entries ORDER BY accessed_at").fetchall():
+                    if n_entries <= self.max_entries and n_bytes <= self.max_bytes:
+                        break
+                    connection.execute("DELETE FROM entries WHERE key = ?", (old_key,))
+                    n_entries -= 1
+                    n_bytes -= size
+                    evicted += 1
+                self.evictions += evicted
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def clear(self) -> None:
+        self._connection().execute("DELETE FROM entries")
+
+    def generation(self) -> int:
+        return self._connection().execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()[0]
+
+    def bump_generation(self) -> int:
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("UPDATE meta SET value = value + 1 WHERE name = 'generation'")
+            connection.execute("DELETE FROM entries")
+            generation = connection.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()[0]
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return generation
+
+    def info(self) -> dict[str, int | float | str]:
+        n_entries, n_bytes = self._connection().execute(
+            "SELECT count(*), coalesce(sum(size), 0) FROM entries").fetchone()
+        return {
+            "kind": self.kind,
+            "path": self.path,
+            "entries": n_entries,
+            "max_entries": self.max_entries,
+            "bytes": n_bytes,
+            "max_bytes": self.max_bytes,
+            # evictions and rejections by this process
+            "evictions": self.evictions,
+            "rejections": self.rejections,
+        }
+
+
+class RedisBackend:
+    """Results on a Redis-protocol server (as written by dumps), shared by all workers on
+    all hosts. Entries expire through the server's TTL; the memory bound is
+    the server's maxmemory (with an LRU eviction policy), not enforced here.
+
+    Arguments:
+        url {str} -- where the server is, e.g. redis://localhost:6379/0
+        client -- a client to use instead of connecting to url, anything with
+                  redis-py's get, set, incr and scan_iter/delete (e.g. fakeredis)
+        prefix {str} -- namespace of all keys
+        max_bytes {int} -- larger values are not stored
+    """
+
+    kind = "redis"
+
+    def __init__(self, url: str | None = None, client=None, prefix: str = "nlpkg:results:",
+                 max_bytes: int = 512 * 2**20):
+        if client is None:
+            try:
+                import redis
+            except ImportError as error:
+                raise ImportError("RESULT_CACHE_BACKEND=redis needs the redis package: pip install redis") from error
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.rejections = 0
+
+    def get(self, key: str) -> Any:
+        data = self.client.get(self.prefix + key)
+        return None if data is None else loads(data)
+
+    def put(self, key: str, value: Any, ttl: float) -> None:
+        data = dumps(value)
+        if len(data) > self.max_bytes:
+            self.rejections += 1
+            return
+        self.client.set(self.prefix + key, data, px=max(1, int(ttl * 1000)))
+
+    def clear(self) -> None:
+        keys = [key for key in self.client.scan_iter(match=self.prefix + "*")
+                if key not in (self.prefix + "generation", (self.prefix + "generation").encode())]
+        if keys:
+            self.client.delete(*keys)
+
+    def generation(self) -> int:
+        return int(self.client.get(self.prefix + "generation") or 0)
+
+    def bump_generation(self) -> int:
+        # older entries can't be looked up anymore and run out through their TTL
+        return int(self.client.incr(self.prefix + "generation"))
+
+    def info(self) -> dict[str, int | float | str]:
+        return {
+            "kind": self.kind,
+            "rejections": self.rejections,
+        }
+
+
+def make_backend(kind: str, max_entries: int, max_bytes: int, sqlite_path: str = "", redis_url: str = ""):
+    """The backend for RESULT_CACHE_BACKEND: memory, sqlite or redis"""
+    if kind == "memory":
+        return MemoryBackend(max_entries, max_bytes)
+    if kind == "sqlite":
+        return SqliteBackend(sqlite_path, max_entries, max_bytes)
+    if kind == "redis":
+        return RedisBackend(redis_url, max_bytes=max_bytes)
+    raise ValueError(f"Unknown result cache backend {kind}, use memory, sqlite or redis")
+
+
+_backend = MemoryBackend()
+_invalidation_callbacks: list[Callable[[], None]] = []
+# the last generation this process saw, and when it read it
+_generation = (0, float("-inf"))
+# callbacks run while it is held, and may read the generation again
+_generation_lock = threading.RLock()
+
+
+def configure(backend) -> None:
+    """Store results in backend from now on, see make_backend"""
+    global _backend, _generation
+    with _generation_lock:
+        _backend = backend
+        try:
+            _generation = (backend.generation(), monotonic())
+        except Exception as error:
+            # read again on the next lookup
+            logger.warning(f"Can't read the result cache generation: {error}")
+            _generation = (0, float("-inf"))
+
+
+def get_backend():
+    return _backend
+
+
+def on_invalidate(callback: Callable[[], None]) -> None:
+    """Call callback every time the caches are invalidated, also when
+    another process invalidated a shared backend.
+    """
+    _invalidation_callbacks.append(callback)
+
+
+def _set_generation(generation: int) -> None:
+    global _generation
+    changed = generation != _generation[0]
+    _generation = (generation, monotonic())
+    if changed:
+        for callback in _invalidation_callbacks:
+            callback()
+
+
+def current_generation() -> int:
+    with _generation_lock:
+        generation, checked_at = _generation
+        if monotonic() - checked_at >= GENERATION_CHECK_SECONDS:
+            try:
+                _set_generation(_backend.generation())
+            except Exception as error:
+                logger.warning(f"Can't read the result cache generation: {error}")
+        return _generation[0]
+
+
+def bump_generation(reason: str = "") -> int:
+    """Invalidate every result cache, and everything registered with on_invalidate"""
+    with _generation_lock:
+        generation = _backend.bump_generation()
+        _set_generation(generation)
+    logger.info(f"Result caches invalidated (generation {generation}) {reason}".rstrip())
+    return generation
+
+
+class SingleFlight:
+    """Runs a computation once per key at a time: callers that ask for a key
+    that is already being computed wait for that result instead of computing
+    it again. Exceptions are raised in every waiting caller.
+    """
+
+    class Flight:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.n_waiting = 0
+
+    def __init__(self):
+        self.coalesced = 0
+        self.max_waiting = 0
+        self._flights: dict[str, SingleFlight.Flight] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, function: Callable[[], Any]) -> tuple[Any, bool]:
+        """Call function, or wait for the call for key that is already running.
+
+        Returns:
+            result -- what function returned, here or in the call waited for
+            shared {bool} -- whether the result came from another caller
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = SingleFlight.Flight()
+            else:
+                flight.n_waiting += 1
+                self.coalesced += 1
+                self.max_waiting = max(self.max_waiting, flight.n_waiting)
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = function()
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, False
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._flights)
+
+
+class ResultCache:
+    """The results of one function in the configured backend, under their own
+    key prefix, with a TTL. Entries of an older generation are never returned.
+    A backend that fails only makes lookups miss, it never fails a request.
+
+    Arguments:
+        name {str} -- key prefix, and under which name the metrics are reported
+        ttl {float} -- seconds after which an entry expires
+    """
+
+    def __init__(self, name: str, ttl: float = 3600):
+        self.name = name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.single_flight = SingleFlight()
+
+    def key(self, args: tuple, kwargs: dict) -> str:
+        return make_key(self.name, current_generation(), args, kwargs)
+
+    def peek(self, key: str) -> Any:
+        """Look up key without counting a hit or miss"""
+        try:
+            return _backend.get(key)
+        except Exception as error:
+            logger.warning(f"Result cache {self.name}: lookup failed: {error}")
+            self.errors += 1
+            return None
+
+    def get(self, key: str) -> Any:
+        value = self.peek(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        try:
+            _backend.put(key, value, self.ttl)
+        except Exception as error:
+            logger.warning(f"Result cache {self.name}: store failed: {error}")
+            self.errors += 1
+
+    def info(self) -> dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "errors": self.errors,
+            # misses that waited for the same computation of another request
+            "coalesced": self.single_flight.coalesced,
+            "max_waiting": self.single_flight.max_waiting,
+            "in_flight": self.single_flight.in_flight(),
+        }
+
+
+# all result caches by name, for the metrics endpoint
+caches: dict[str, ResultCache] = {}
+
+
+def cached(name: str, ttl: float = 3600):
+    """Decorator like functools.lru_cache, but backed by a ResultCache in the
+    configured backend. The arguments of the decorated function have to be
+    strings, numbers, None, tuples of those, or have a cache_key.
+
+    Concurrent calls with the same arguments that all miss the cache are
+    computed once, the others wait for that result (single-flight).
+    """
+    cache = ResultCache(name, ttl)
+    caches[name] = cache
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return keyed(*args, **kwargs)[1]
+
+        def keyed(*args, **kwargs):
+            # the key too, for results that are changed and stored again with cache.put
+            key = cache.key(args, kwargs)
+            result = cache.get(key)
+            if result is None:
+                result, _ = cache.single_flight.do(key, lambda: compute(key, args, kwargs))
+            return key, result
+
+        def compute(key, args, kwargs):
+            # a flight for the same key may have finished right after the lookup
+            result = cache.peek(key)
+            if result is None:
+                result = function(*args, **kwargs)
+                if result is not None:
+                    cache.put(key, result)
+            return result
+
+        wrapper.cache = cache
+        wrapper.keyed = keyed
+        return wrapper
+
+    return decorator
+
+
+def cache_metrics() -> dict[str, dict]:
+    try:
+        backend_info = _backend.info()
+    except Exception as error:
+        backend_info = {"kind": _backend.kind, "error": str(error)}
+    return {
+        "backend": backend_info,
+        "generation": current_generation(),
+        "caches": {name: cache.info() for name, cache in caches.items()},
+    }
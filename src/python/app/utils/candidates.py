@@ -0,0 +1,83 @@
+import hashlib
+import sys
+from typing import Iterator, Sequence
+
+import numpy as np
+
+from .cache import cache_type, estimate_size
+from .facets import compute_facets
+from .types import Publication
+
+
+@cache_type
+class CandidateSet:
+    """The papers Weaviate returned for one search, with the columns the
+    rerankers and the statistics need kept as NumPy arrays.
+
+    The set is identified by its (interned) paper IDs: the cache key is
+    computed once, and the hash is derived from it, so using a CandidateSet
+    as a cache key doesn't hash every title and abstract again, and the
+    hash is the same in every process.
+    """
+
+    def __init__(self, papers: Sequence[Publication]):
+        self.papers = tuple(papers)
+        self.ids = tuple(sys.intern(paper["neo4jID"]) for paper in self.papers)
+        self.year = np.array([paper["year"] for paper in self.papers], dtype=np.int64)
+        self.n_citations = np.array([paper["n_citations"] for paper in self.papers], dtype=np.int64)
+        self.n_key_citations = np.array([paper["n_key_citations"] for paper in self.papers], dtype=np.int64)
+        # publication dates are ISO strings, keep their sorted position
+        _, self.date_rank = np.unique(
+            np.array([paper["publication_date"] for paper in self.papers], dtype=str), return_inverse=True)
+        # the same in every process, unlike hash()
+        self.cache_key = hashlib.blake2b("\0".join(self.ids).encode(), digest_size=16).hexdigest()
+        self._facets = None
+        self._nbytes = None
+
+    def __len__(self) -> int:
+        return len(self.papers)
+
+    def __iter__(self) -> Iterator[Publication]:
+        return iter(self.papers)
+
+    def __getitem__(self, index: int) -> Publication:
+        return self.papers[index]
+
+    def __hash__(self) -> int:
+        return int(self.cache_key[:16], 16)
+
+    def __eq__(self, other) -> bool:
+        if self is other:
+            return True
+        if not isinstance(other, CandidateSet):
+            return NotImplemented
+        return self.cache_key == other.cache_key and self.ids == other.ids
+
+    def to_cache(self) -> dict:
+        # the columns are computed again from the papers, the facets are kept
+        return {"papers": self.papers, "facets": self._facets}
+
+    @classmethod
+    def from_cache(cls, state: dict) -> "CandidateSet":
+        candidates = cls(state["papers"])
+        candidates._facets = state["facets"]
+        return candidates
+
+    @property
+    def nbytes(self) -> int:
+        """Estimated size of the papers and columns, computed on first use"""
+        if self._nbytes is None:
+            self._nbytes = estimate_size(self.papers) + estimate_size(self.ids) + sum(
+                column.nbytes for column in (self.year, self.n_citations, self.n_key_citations, self.date_rank))
+        return self._nbytes
+
+    @property
+    def facets(self) -> dict[str, dict]:
+        """Year, venue and field of study counts, computed on first use"""
+        if self._facets is None:
+            self._facets = compute_facets(
+                self.year,
+                [paper["venue"] for paper in self.papers],
+                [paper["field_list"] for paper in self.papers],
+            )
+        return self._facets
@@ -0,0 +1,148 @@
+import fcntl
+import json
+import os
+import threading
+from time import time
+
+
+class SyncCheckpoint:
+    """What a sync has written to Weaviate, kept in a JSON file so that an
+    interrupted sync can resume where it stopped.
+
+    The classes replaced by full syncs are dropped after a grace period,
+    they are listed in the file with when, so that drops that are due
+    while the API is down still happen, see
+    weaviate_sync_service.drop_expired_classes.
+
+    Every key range of the sync has a watermark, the key up to which all its
+    pages are written. Uploaders finish pages out of order, so the pages
+    past the watermark are tracked until the ones before them are written
+    too. The file is replaced (atomically) after every page. Only one
+    process can hold the checkpoint, so there is one sync per host at a time.
+
+    Arguments:
+        path {str} -- the JSON file, its lock is path + ".lock"
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.state: dict[str, object] = {}
+        # per range: [after, last key, rows, written] of the pages past its watermark
+        self._pages: list[list[list]] = []
+        self._lock = threading.Lock()
+        self._lock_file = None
+
+    def acquire(self) -> bool:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        lock_file = open(self.path + ".lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def release(self) -> None:
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def start(self, state: dict[str, object]) -> None:
+        """Track state, a new one or one read from the file to resume"""
+        now = time()
+        # pages past the watermarks are read again, so they don't count yet
+        # and their ranges are only done once their fetchers are done again
+        for key_range in state["ranges"]:
+            key_range["fetched"] = key_range["done"]
+        state["rows"] = sum(key_range["rows"] for key_range in state["ranges"])
+        state.setdefault("pending_drops", [])
+        state.update(state="running", resumed_at=now, rows_at_resume=state["rows"])
+        self.state = state
+        self._pages = [[] for _ in state["ranges"]]
+        self.save()
+
+    def fetched(self, range_index: int, after, last_key, rows: int) -> None:
+        with self._lock:
+            self._pages[range_index].append([after, last_key, rows, False])
+
+    def written(self, range_index: int, after) -> None:
+        with self._lock:
+            pages = self._pages[range_index]
+            for page in pages:
+                if page[0] == after:
+                    page[3] = True
+                    self.state["rows"] += page[2]
+            key_range = self.state["ranges"][range_index]
+            while pages and pages[0][3]:
+                _, key_range["written_until"], rows, _ = pages.pop(0)
+                key_range["rows"] += rows
+            self._check_done(range_index)
+            self._save()
+
+    def failed(self, range_index: int, after, error: Exception) -> None:
+        with self._lock:
+            self.state["errors"] += 1
+            # the last failures, the watermark of the range stays before the first
+            self.state["failures"] = [*self.state["failures"][-99:], {
+                "range": range_index, "after": after, "error": f"{type(error).__name__}: {error}", "at": time()}]
+            self._save()
+
+    def fetch_done(self, range_index: int) -> None:
+        with self._lock:
+            self.state["ranges"][range_index]["fetched"] = True
+            self._check_done(range_index)
+            self._save()
+
+    def _check_done(self, range_index: int) -> None:
+        key_range = self.state["ranges"][range_index]
+        key_range["done"] = key_range["fetched"] and not self._pages[range_index]
+
+    def schedule_drop(self, class_name: str, drop_at: float) -> None:
+        with self._lock:
+            self.state["pending_drops"].append({"class": class_name, "drop_at": drop_at})
+            self._save()
+
+    def expired_drops(self) -> list[str]:
+        """The classes to drop whose grace period is over"""
+        with self._lock:
+            now = time()
+            return [drop["class"] for drop in self.state.get("pending_drops", []) if drop["drop_at"] <= now]
+
+    def dropped(self, class_name: str) -> None:
+        with self._lock:
+            self.state["pending_drops"] = [drop for drop in self.state["pending_drops"]
+                                           if drop["class"] != class_name]
+            self._save()
+
+    def finish(self, state: str) -> None:
+        with self._lock:
+            self.state["state"] = state
+            self._save()
+
+    def save(self) -> None:
+        with self._lock:
+            self._save()
+
+    def _save(self) -> None:
+        self.state["updated_at"] = time()
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.state, f, default=str)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def load_checkpoint(path: str) -> dict[str, object] | None:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def checkpoint_in_use(path: str) -> bool:
+    """Whether a sync (of any process) holds the checkpoint"""
+    checkpoint = SyncCheckpoint(path)
+    if checkpoint.acquire():
+        checkpoint.release()
+        return False
+    return True
@@ -0,0 +1,137 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# per row of the cache: the key it holds and when it was last used
+SLOT_DTYPE = np.dtype([("key", "S32"), ("used", "<u8")])
+
+
+class EmbeddingCache:
+    """An LRU of query embeddings, kept as float32 rows of one array.
+
+    Keys are digests of the model identity and the normalized query, so a
+    different model or adapter never gets another one's vectors. With a
+    path, the rows are memory-mapped files (path + ".vectors" and the key
+    and last use of every row in path + ".slots"), so the cache survives
+    restarts. A row's key is only written after its vector, so a crash
+    can't pair a key with the wrong vector. Only one process can own the
+    files, others that are given the same path keep their cache in memory.
+
+    Arguments:
+        model_identity {str} -- changes whenever the embeddings would
+        dim {int} -- size of the embeddings
+        capacity {int} -- how many embeddings to keep at most
+        path {str} -- where to persist the cache, None to keep it in memory
+    """
+
+    def __init__(self, model_identity: str, dim: int, capacity: int = 10000, path: str | None = None):
+        self.model_identity = model_identity
+        self.dim = dim
+        self.capacity = max(0, capacity)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._lock_file = None
+        if not (path and self.capacity > 0 and self._open()):
+            self.path = None
+            self.vectors = np.zeros((self.capacity, dim), dtype=np.float32)
+            self.slots = np.zeros(self.capacity, dtype=SLOT_DTYPE)
+        # key -> row, and a counter that orders the uses of rows
+        self._index = {key.decode(): slot for slot, key in enumerate(self.slots["key"]) if key}
+        self._free = [slot for slot in range(self.capacity - 1, -1, -1) if not self.slots["key"][slot]]
+        self._clock = int(self.slots["used"].max(initial=0))
+
+    def _open(self) -> bool:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        lock_file = open(self.path + ".lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            logger.info(f"Embedding cache {self.path} is used by another process, keeping this one in memory")
+            return False
+        self._lock_file = lock_file
+
+        meta = {"model_identity": self.model_identity, "dim": self.dim, "capacity": self.capacity}
+        try:
+            with open(self.path + ".json") as f:
+                reuse = json.load(f) == meta
+        except (OSError, ValueError):
+            reuse = False
+        mode = "r+" if reuse else "w+"
+        if not reuse:
+            logger.info(f"Embedding cache: starting a new cache in {self.path}")
+        self.vectors = np.memmap(self.path + ".vectors", dtype=np.float32, mode=mode, shape=(self.capacity, self.dim))
+        self.slots = np.memmap(self.path + ".slots", dtype=SLOT_DTYPE, mode=mode, shape=(self.capacity,))
+        if not reuse:
+            with open(self.path + ".json", "w") as f:
+                json.dump(meta, f)
+        return True
+
+    def key(self, normalized_query: str) -> str:
+        return hashlib.blake2b(f"{self.model_identity}\0{normalized_query}".encode(), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> np.ndarray | None:
+        with self._lock:
+            slot = self._index.get(key)
+            if slot is None:
+                self.misses += 1
+                return None
+            self._clock += 1
+            self.slots["used"][slot] = self._clock
+            self.hits += 1
+            return np.array(self.vectors[slot])
+
+    def put(self, key: str, vector) -> None:
+        if self.capacity == 0:
+            return
+        with self._lock:
+            slot = self._index.get(key)
+            if slot is None:
+                if self._free:
+                    slot = self._free.pop()
+                else:
+                    # the least recently used row, a linear scan is cheap next to an embedding
+                    slot = int(np.argmin(self.slots["used"]))
+                    del self._index[self.slots["key"][slot].decode()]
+                    self.evictions += 1
+                self.slots["key"][slot] = b""
+                self.vectors[slot] = np.asarray(vector, dtype=np.float32)
+                self.slots["key"][slot] = key.encode()
+                self._index[key] = slot
+            self._clock += 1
+            self.slots["used"][slot] = self._clock
+
+    def flush(self) -> None:
+        """Write the memory-mapped rows to disk, if the cache has a path"""
+        if self.path is not None:
+            with self._lock:
+                self.vectors.flush()
+                self.slots.flush()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def info(self) -> dict[str, int | float | str | None]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "model_identity": self.model_identity,
+                "path": self.path,
+                "entries": len(self._index),
+                "capacity": self.capacity,
+                "bytes": self.vectors.nbytes + self.slots.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
@@ -5,7 +5,76 @@ from dotenv import find_dotenv, load_dotenv
 load_dotenv(find_dotenv())
 
 WEAVIATE_URI = os.getenv("WEAVIATE_URI")
+# how long searches keep using the active Publication class before checking for a switch
+WEAVIATE_ALIAS_TTL_SECONDS = float(os.getenv("WEAVIATE_ALIAS_TTL_SECONDS", 10))
 NEO4J_URI = os.getenv("NEO4J_URI")
 NEO4J_USER = os.getenv("NEO4J_USER")
 NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD")
 NEO4J_DATABASE = os.getenv("NEO4J_DATABASE")
+# the connection pool of the one Neo4j driver per process
+NEO4J_MAX_POOL_SIZE = int(os.getenv("NEO4J_MAX_POOL_SIZE", 100))
+NEO4J_MAX_CONNECTION_LIFETIME = float(os.getenv("NEO4J_MAX_CONNECTION_LIFETIME", 3600))
+NEO4J_CONNECTION_ACQUISITION_TIMEOUT = float(os.getenv("NEO4J_CONNECTION_ACQUISITION_TIMEOUT", 60))
+# how many rows a streamed query fetches from Neo4j at a time, and returns per request at most
+NEO4J_STREAM_FETCH_SIZE = int(os.getenv("NEO4J_STREAM_FETCH_SIZE", 1000))
+NEO4J_STREAM_MAX_ROWS = int(os.getenv("NEO4J_STREAM_MAX_ROWS", 100000))
+
+# how many papers S2Ranker keeps cleaned title/abstract/venue/author text for
+S2RANKER_TEXT_STORE_SIZE = int(os.getenv("S2RANKER_TEXT_STORE_SIZE", 50000))
+# how many scores S2Ranker remembers per KenLM language model
+S2RANKER_LM_CACHE_SIZE = int(os.getenv("S2RANKER_LM_CACHE_SIZE", 100000))
+# number of worker processes S2Ranker scores on (0 scores in the request thread)
+S2RANKER_WORKERS = int(os.getenv("S2RANKER_WORKERS", 0))
+# candidate sets smaller than this are scored in-process even with workers
+S2RANKER_PARALLEL_MIN_PAPERS = int(os.getenv("S2RANKER_PARALLEL_MIN_PAPERS", 500))
+# how S2Ranker loads the KenLM binaries: populate (memory-map and read in up front),
+# lazy (memory-map, pages are faulted in by the first queries that need them) or read
+S2RANKER_LM_LOAD_METHOD = os.getenv("S2RANKER_LM_LOAD_METHOD", "populate")
+# how S2Ranker loads its ranking model: lightgbm (the pickle) or compiled (flat arrays)
+S2RANKER_MODEL_FORMAT = os.getenv("S2RANKER_MODEL_FORMAT", "lightgbm")
+
+# where reranker_service keeps results: memory (per process), sqlite (per host) or redis (shared).
+# the sqlite file and the redis server must only be writable by the app
+RESULT_CACHE_BACKEND = os.getenv("RESULT_CACHE_BACKEND", "memory")
+RESULT_CACHE_SQLITE_PATH = os.getenv("RESULT_CACHE_SQLITE_PATH", "/code/data/result_cache/results.sqlite")
+RESULT_CACHE_REDIS_URL = os.getenv("RESULT_CACHE_REDIS_URL", "redis://localhost:6379/0")
+# bounds of all cached results together (a sync invalidates them all)
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 512))
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", 512))
+RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", 3600))
+
+# concurrent query embeddings are batched up to this size, waiting at most this long for more
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", 32))
+EMBEDDING_MAX_WAIT_MS = float(os.getenv("EMBEDDING_MAX_WAIT_MS", 5))
+# how many query embeddings to remember, and optionally where to keep them across restarts
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 10000))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "")
+# how queries are embedded: eager (fp32 PyTorch), int8 (quantized PyTorch), onnx or onnx-int8 (onnxruntime)
+ENCODER_BACKEND = os.getenv("ENCODER_BACKEND", "eager")
+ENCODER_ONNX_DIR = os.getenv("ENCODER_ONNX_DIR", "/code/data/encoder_onnx")
+# a backend whose embeddings are less similar than this to eager ones is not used
+ENCODER_MIN_COSINE = float(os.getenv("ENCODER_MIN_COSINE", 0.99))
+# how long a request waits for a model that is still loading before it gets a 503
+MODEL_WAIT_SECONDS = float(os.getenv("MODEL_WAIT_SECONDS", 10))
+# the Weaviate sync reads publications in pages ordered by this key, a property it
+# keeps a range index on. For the default p.syncKey, the sync writes to Neo4j: it creates
+# a uniqueness constraint on Publication.syncKey and sets it on publications without one
+# (it also sets Publication.weaviateSyncMarker on the publications it uploaded)
+SYNC_KEY = os.getenv("SYNC_KEY", "p.syncKey")
+SYNC_PAGE_SIZE = int(os.getenv("SYNC_PAGE_SIZE", 200))
+# full: rebuild the Weaviate class, delta: only upload changed publications and delete removed ones
+SYNC_MODE = os.getenv("SYNC_MODE", "full")
+# concurrent Neo4j fetchers (over disjoint key ranges), Weaviate uploaders, and pages queued between them
+SYNC_FETCHERS = int(os.getenv("SYNC_FETCHERS", 4))
+SYNC_UPLOADERS = int(os.getenv("SYNC_UPLOADERS", 2))
+SYNC_QUEUE_SIZE = int(os.getenv("SYNC_QUEUE_SIZE", 16))
+# a full sync only goes live with at least this share of the publications Neo4j has,
+# and the class it replaces is dropped this many seconds later
+SYNC_MIN_COUNT_RATIO = float(os.getenv("SYNC_MIN_COUNT_RATIO", 0.999))
+SYNC_DROP_GRACE_SECONDS = float(os.getenv("SYNC_DROP_GRACE_SECONDS", 600))
+# where the sync keeps its progress, and whether a sync that stopped with the API is resumed on start
+SYNC_CHECKPOINT_PATH = os.getenv("SYNC_CHECKPOINT_PATH", "/code/data/weaviate_sync_checkpoint.json")
+SYNC_RESUME_ON_START = os.getenv("SYNC_RESUME_ON_START", "true").lower() == "true"
+# a page that fails is tried again this often, after 1, 2, 4... times this many seconds
+SYNC_MAX_RETRIES = int(os.getenv("SYNC_MAX_RETRIES", 3))
+SYNC_RETRY_BACKOFF_SECONDS = float(os.getenv("SYNC_RETRY_BACKOFF_SECONDS", 1))
@@ -0,0 +1,25 @@
+from itertools import chain
+from typing import Iterable, Sequence
+
+import numpy as np
+
+
+def count_values(values: Iterable) -> dict:
+    """How often each value occurs, in one vectorized pass"""
+    values = np.asarray(values if isinstance(values, np.ndarray) else list(values))
+    if len(values) == 0:
+        return {}
+    unique, counts = np.unique(values, return_counts=True)
+    return dict(zip(unique.tolist(), counts.tolist()))
+
+
+def compute_facets(years: np.ndarray, venues: Sequence[str], field_lists: Sequence[Sequence[str]]) -> dict[str, dict]:
+    """Year histogram and venue and field of study counts of a candidate set.
+
+    None of these depend on how the papers are sorted or paged.
+    """
+    return {
+        "year": count_values(years),
+        "venue": count_values(venue for venue in venues if venue),
+        "field": count_values(chain.from_iterable(field_lists)),
+    }
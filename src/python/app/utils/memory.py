@@ -0,0 +1,43 @@
+import os
+import resource
+
+SMAPS_ROLLUP_PATH = "/proc/self/smaps_rollup"
+
+
+def memory_usage() -> dict[str, int]:
+    """Memory of the current process in bytes.
+
+    On Linux this is read from /proc/self/smaps_rollup, which splits the
+    resident set into pages shared with other processes (e.g. memory-mapped
+    model files, or pages inherited from a forked parent) and pages private
+    to this process. pss divides every shared page by the number of processes
+    sharing it, so summing pss over all workers gives the real footprint.
+    Elsewhere only the peak rss is available.
+    """
+    try:
+        fields = {}
+        with open(SMAPS_ROLLUP_PATH) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == "kB":
+                    fields[parts[0].rstrip(":")] = int(parts[1]) * 1024
+        return {
+            "pid": os.getpid(),
+            "rss": fields.get("Rss", 0),
+            "pss": fields.get("Pss", 0),
+            "shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+            "private": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+        }
+    except OSError:
+        # ru_maxrss is in kilobytes on Linux
+        return {
+            "pid": os.getpid(),
+            "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        }
+
+
+def format_memory_usage(usage: dict[str, int]) -> str:
+    return " ".join(
+        f"{key}={value / 2**20:.1f}MB" if key != "pid" else f"pid={value}"
+        for key, value in usage.items()
+    )
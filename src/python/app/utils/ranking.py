@@ -0,0 +1,87 @@
+import threading
+from typing import Sequence
+
+import numpy as np
+
+from .cache import cache_type
+
+
+def top_k_order(keys: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest keys, largest first.
+
+    Equal keys keep their input order, which gives the same order as
+    sorted(..., reverse=True) would, but only the top k are sorted.
+    """
+    n = len(keys)
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    if k < n:
+        # everything above the k-th largest key, plus the first of the ties with it
+        kth_key = np.partition(keys, n - k)[n - k]
+        above = np.flatnonzero(keys > kth_key)
+        ties = np.flatnonzero(keys == kth_key)[:k - len(above)]
+        candidates = np.concatenate([above, ties])
+    else:
+        candidates = np.arange(n)
+
+    order = np.lexsort((candidates, -keys[candidates]))
+    return candidates[order]
+
+
+@cache_type
+class RankedPapers:
+    """The papers of a candidate set ranked by a key, largest first.
+
+    Only the keys and the order are kept, against the cache_key of the
+    candidate set, so a cached ranking doesn't hold the papers again. The
+    ranking is only sorted as far as the pages asked for so far, and grows
+    (at least doubling) when a later page is requested.
+    """
+
+    def __init__(self, papers: Sequence, keys: np.ndarray):
+        self.candidates_key = getattr(papers, "cache_key", None)
+        self.keys = np.asarray(keys)
+        self._order = np.empty(0, dtype=np.intp)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def to_cache(self) -> dict:
+        # for the shared result caches, the lock stays behind
+        return {"candidates_key": self.candidates_key, "keys": self.keys, "order": self._order}
+
+    @classmethod
+    def from_cache(cls, state: dict) -> "RankedPapers":
+        ranking = cls.__new__(cls)
+        ranking.candidates_key = state["candidates_key"]
+        ranking.keys = state["keys"]
+        ranking._order = state["order"]
+        ranking._lock = threading.Lock()
+        return ranking
+
+    @property
+    def nbytes(self) -> int:
+        # the keys and, at most, a full order; the papers belong to the candidate set
+        return self.keys.nbytes + len(self.keys) * np.dtype(np.intp).itemsize
+
+    @property
+    def n_sorted(self) -> int:
+        """How many of the top papers are sorted so far"""
+        return len(self._order)
+
+    def page(self, papers: Sequence, offset: int, limit: int) -> list:
+        """The papers from offset to offset + limit, out of papers, the
+        candidate set that was ranked"""
+        if getattr(papers, "cache_key", None) != self.candidates_key or len(papers) != len(self.keys):
+            raise ValueError("The ranking is of another candidate set")
+        end = min(offset + limit, len(self.keys))
+        if end <= offset:
+            return []
+        with self._lock:
+            if end > len(self._order):
+                self._order = top_k_order(self.keys, max(end, 2 * len(self._order)))
+            order = self._order
+        return [papers[i] for i in order[offset:end]]
@@ -0,0 +1,100 @@
+import logging
+import threading
+from time import monotonic, time
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+PENDING, LOADING, READY, FAILED = "pending", "loading", "ready", "failed"
+
+
+class NotReadyError(Exception):
+    """A component a request needs isn't loaded (yet), answered with a 503"""
+
+    def __init__(self, component: str, state: str, error: str | None = None):
+        self.component = component
+        self.state = state
+        self.error = error
+        super().__init__(f"{component} is {state}" + (f": {error}" if error else ""))
+
+
+class Component:
+    """Something slow to load (a model) that requests wait for, up to a timeout.
+
+    Arguments:
+        name {str} -- how the component is reported on /ready
+        loader {callable} -- loads the component and returns it
+    """
+
+    def __init__(self, name: str, loader: Callable[[], Any]):
+        self.name = name
+        self.loader = loader
+        self.state = PENDING
+        self.value = None
+        self.error: str | None = None
+        self.started_at: float | None = None
+        self.seconds: float | None = None
+        self._loaded = threading.Event()
+
+    def load(self) -> None:
+        self.state = LOADING
+        self.started_at = time()
+        t_start = monotonic()
+        try:
+            self.value = self.loader()
+            self.state = READY
+        except Exception as error:
+            logger.exception(f"Loading {self.name} failed")
+            self.error = f"{type(error).__name__}: {error}"
+            self.state = FAILED
+        self.seconds = monotonic() - t_start
+        logger.info(f"{self.name} is {self.state} after {self.seconds:.1f}s")
+        self._loaded.set()
+
+    def get(self, timeout: float) -> Any:
+        """The loaded component, waiting at most timeout seconds for it"""
+        if not self._loaded.wait(timeout) or self.state != READY:
+            raise NotReadyError(self.name, self.state, self.error)
+        return self.value
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "state": self.state,
+            "started_at": self.started_at,
+            "seconds": self.seconds if self.seconds is not None
+            else (time() - self.started_at if self.started_at else None),
+            "error": self.error,
+        }
+
+
+# all components in the order they are loaded
+components: dict[str, Component] = {}
+_loading_thread: threading.Thread | None = None
+
+
+def register(name: str, loader: Callable[[], Any]) -> Component:
+    components[name] = Component(name, loader)
+    return components[name]
+
+
+def load_all(first: tuple[str, ...] = ()) -> None:
+    """Load the components named in first, then all others in the order they were registered"""
+    for name in [*first, *components]:
+        if components[name].state == PENDING:
+            components[name].load()
+
+
+def start_loading(first: tuple[str, ...] = ()) -> None:
+    """Load all components on a background thread, one after the other"""
+    global _loading_thread
+    if _loading_thread is None:
+        _loading_thread = threading.Thread(target=load_all, args=(first,), name="model-loader", daemon=True)
+        _loading_thread.start()
+
+
+def is_ready() -> bool:
+    return all(component.state == READY for component in components.values())
+
+
+def status() -> dict[str, dict]:
+    return {name: component.status() for name, component in components.items()}
@@ -0,0 +1,84 @@
+"""MicroBatcher: concurrent callers share batches, results go back to the
+caller that submitted the item, and a failing batch fails its callers only.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.utils.batching import MicroBatcher
+
+
+def test_results_in_order_of_the_items():
+    batcher = MicroBatcher(lambda items: [item * 2 for item in items], max_batch_size=4)
+    assert batcher.map(range(10)) == [item * 2 for item in range(10)]
+    assert batcher.info()["items"] == 10
+    assert batcher.info()["largest_batch"] <= 4
+
+
+def test_concurrent_callers_share_batches():
+    batches = []
+
+    def run(items):
+        batches.append(list(items))
+        time.sleep(0.01)
+        return [item + 1 for item in items]
+
+    batcher = MicroBatcher(run, max_batch_size=8, max_wait=0.05)
+    start = threading.Barrier(16)
+
+    def call(item):
+        start.wait()
+        return batcher.submit(item).result(5)
+
+    with ThreadPoolExecutor(16) as pool:
+        results = list(pool.map(call, range(16)))
+    assert results == [item + 1 for item in range(16)]
+    assert sorted(item for batch in batches for item in batch) == list(range(16))
+    assert len(batches) < 16 and max(map(len, batches)) <= 8
+
+
+def test_a_lone_item_waits_at_most_max_wait():
+    batcher = MicroBatcher(lambda items: items, max_batch_size=100, max_wait=0.02)
+    t_start = time.perf_counter()
+    assert batcher.submit("a").result(5) == "a"
+    assert time.perf_counter() - t_start < 1
+
+
+def test_a_failing_batch_fails_its_callers_only():
+    def run(items):
+        if "bad" in items:
+            raise ValueError("bad item")
+        return items
+
+    batcher = MicroBatcher(run, max_batch_size=2, max_wait=0.0)
+    with pytest.raises(ValueError):
+        batcher.submit("bad").result(5)
+    assert batcher.submit("good").result(5) == "good"
+
+
+def test_a_batch_function_with_the_wrong_number_of_results_fails():
+    batcher = MicroBatcher(lambda items: items[:-1], max_batch_size=1)
+    with pytest.raises(ValueError):
+        batcher.submit(1).result(5)
+
+
+def test_cancelled_items_are_not_run():
+    seen, release = [], threading.Event()
+
+    def run(items):
+        seen.extend(items)
+        release.wait(5)
+        return items
+
+    batcher = MicroBatcher(run, max_batch_size=1, max_wait=0.0)
+    first = batcher.submit("first")
+    while not seen:
+        time.sleep(0.001)
+    cancelled = batcher.submit("cancelled")
+    assert cancelled.cancel()
+    last = batcher.submit("last")
+    release.set()
+    assert first.result(5) == "first" and last.result(5) == "last"
+    assert seen == ["first", "last"]
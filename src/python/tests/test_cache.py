@@ -0,0 +1,344 @@
+"""The result cache: its backends, the value format of the shared ones,
+ResultCache and cached, SingleFlight, and invalidation by generation.
+The redis backend runs against a small in-memory stand-in for the few
+commands it uses.
+"""
+import json
+import pickle
+import struct
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from app.utils import cache
+from app.utils.candidates import CandidateSet
+from app.utils.ranking import RankedPapers
+
+
+class DictRedis:
+    """get, set with px, incr, scan_iter and delete of redis-py, in a dict"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is None or (value[1] is not None and time.monotonic() >= value[1]):
+            return None
+        return value[0]
+
+    def set(self, key, value, px=None):
+        self.data[key] = (value, None if px is None else time.monotonic() + px / 1000)
+
+    def incr(self, key):
+        value = int(self.get(key) or 0) + 1
+        self.set(key, str(value).encode())
+        return value
+
+    def scan_iter(self, match):
+        return [key for key in self.data if key.startswith(match.rstrip("*"))]
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+
+def make_papers(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return [{
+        "neo4jID": f"4:p:{i}",
+        "title": f"title {i}",
+        "abstract": "abstract",
+        "venue": ["ACL", "EMNLP", ""][i % 3],
+        "authors": ("Ada Lovelace", "Alan Turing"),
+        "year": int(2000 + rng.integers(20)),
+        "n_citations": int(rng.integers(5)),
+        "n_key_citations": int(rng.integers(3)),
+        "field_list": ("NLP", "Parsing")[:1 + i % 2],
+        "publication_date": f"20{rng.integers(20):02d}-01-01",
+    } for i in range(n)]
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return cache.MemoryBackend(max_entries=3, max_bytes=2**20)
+    if request.param == "sqlite":
+        return cache.SqliteBackend(str(tmp_path / "cache" / "results.sqlite"), max_entries=3, max_bytes=2**20)
+    return cache.RedisBackend(client=DictRedis(), max_bytes=2**20)
+
+
+@pytest.fixture
+def configured():
+    """A fresh memory backend, the one before is put back afterwards"""
+    before = cache.get_backend()
+    callbacks = list(cache._invalidation_callbacks)
+    cache.configure(cache.MemoryBackend())
+    yield cache.get_backend()
+    cache._invalidation_callbacks[:] = callbacks
+    cache.configure(before)
+
+
+def test_backend_get_put_and_expiry(backend):
+    assert backend.get("missing") is None
+    backend.put("a", {"ids": ("x", "y")}, ttl=60)
+    assert backend.get("a") == {"ids": ("x", "y")}
+    backend.put("short", [1, 2], ttl=0.05)
+    time.sleep(0.1)
+    assert backend.get("short") is None
+
+
+def test_backend_bump_generation(backend):
+    backend.put("a", [1], ttl=60)
+    generation = backend.generation()
+    assert backend.bump_generation() == generation + 1
+    assert backend.generation() == generation + 1
+    if backend.kind != "redis":
+        # redis entries of older generations run out through their TTL
+        assert backend.get("a") is None
+
+
+@pytest.mark.parametrize("kind", ["memory", "sqlite"])
+def test_backend_evicts_least_recently_used(kind, tmp_path):
+    backend = cache.make_backend(kind, max_entries=2, max_bytes=2**20, sqlite_path=str(tmp_path / "c.sqlite"))
+    backend.put("a", [1], ttl=60)
+    backend.put("b", [2], ttl=60)
+    if kind == "sqlite":
+        # reads only refresh entries that weren't read in the last moment
+        time.sleep(cache.GENERATION_CHECK_SECONDS + 0.1)
+    assert backend.get("a") == [1]
+    backend.put("c", [3], ttl=60)
+    assert backend.get("b") is None
+    assert backend.get("a") == [1] and backend.get("c") == [3]
+
+
+def test_memory_backend_rejects_values_larger_than_its_bound():
+    backend = cache.MemoryBackend(max_entries=10, max_bytes=1000)
+    backend.put("small", np.zeros(10), ttl=60)
+    backend.put("large", np.zeros(1000), ttl=60)
+    assert backend.get("large") is None
+    assert backend.get("small") is not None
+    assert backend.info()["rejections"] == 1
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        cache.make_backend("memcached", 1, 1)
+
+
+@pytest.mark.parametrize("value", [
+    None, True, 3, 2.5, "text", [1, "a", None], (1, (2, 3)), {"a": 1, "b": [2]},
+    {2019: 3, 2020: 4}, {"__tuple__": 1}, np.arange(5, dtype=np.int64), np.zeros((2, 3), dtype=np.float32),
+    np.empty(0), np.int64(7),
+])
+def test_dumps_loads_round_trip(value):
+    loaded = cache.loads(cache.dumps(value))
+    if isinstance(value, np.ndarray):
+        assert loaded.dtype == value.dtype and loaded.shape == value.shape
+        np.testing.assert_array_equal(loaded, value)
+    else:
+        assert loaded == value and type(loaded) is type(value if not isinstance(value, np.generic) else value.item())
+
+
+def test_dumps_loads_candidates_and_ranking():
+    candidates = CandidateSet(make_papers(50))
+    candidates.facets
+    ranking = RankedPapers(candidates, candidates.n_citations)
+    first_page = ranking.page(candidates, 0, 10)
+
+    loaded = cache.loads(cache.dumps(candidates))
+    assert loaded == candidates and loaded.cache_key == candidates.cache_key
+    assert loaded.papers == candidates.papers
+    assert loaded._facets == candidates.facets
+    np.testing.assert_array_equal(loaded.date_rank, candidates.date_rank)
+
+    loaded_ranking = cache.loads(cache.dumps(ranking))
+    assert loaded_ranking.n_sorted == ranking.n_sorted
+    assert loaded_ranking.page(loaded, 0, 10) == first_page
+    assert loaded_ranking.page(loaded, 10, 30) == ranking.page(candidates, 10, 30)
+
+
+class Exploit:
+    def __reduce__(self):
+        return (eval, ("1 / 0",))
+
+
+def encoded(header, buffers=b""):
+    """Bytes in the format of cache.dumps, with any header"""
+    header = json.dumps(header).encode()
+    return cache.FORMAT_MAGIC + struct.pack("<Q", len(header)) + header + buffers
+
+
+@pytest.mark.parametrize("data", [
+    pickle.dumps(Exploit()),
+    pickle.dumps([1, 2]),
+    cache.FORMAT_MAGIC,
+    cache.FORMAT_MAGIC + b"\x05\x00\x00\x00\x00\x00\x00\x00{\"va",
+    cache.dumps(np.arange(10))[:-8],
+    encoded({"value": {"__type__": "Exploit", "state": 1}, "arrays": []}),
+    encoded({"value": {"__ndarray__": 0}, "arrays": [["|O", [1]]]}, b"\0" * 8),
+    encoded({"value": 1}),
+])
+def test_loads_rejects_everything_else(data):
+    with pytest.raises(ValueError):
+        cache.loads(data)
+
+
+@pytest.mark.parametrize("value", [object(), np.array([object()]), {1, 2}])
+def test_dumps_rejects_unsupported_values(value):
+    with pytest.raises(TypeError):
+        cache.dumps(value)
+
+
+def test_sqlite_backend_creates_its_directory_for_the_owner_only(tmp_path):
+    cache.SqliteBackend(str(tmp_path / "private" / "results.sqlite"))
+    assert (tmp_path / "private").stat().st_mode & 0o077 == 0
+
+
+def test_result_cache_counts_and_survives_a_failing_backend(configured):
+    results = cache.ResultCache("test_counts", ttl=60)
+    key = results.key(("q",), {})
+    assert results.get(key) is None
+    results.put(key, [1, 2])
+    assert results.get(key) == [1, 2]
+    assert results.info()["hits"] == 1 and results.info()["misses"] == 1
+
+    class Broken:
+        kind = "broken"
+
+        def get(self, key):
+            raise OSError("down")
+
+        def put(self, key, value, ttl):
+            raise OSError("down")
+
+        def generation(self):
+            return 0
+
+    cache.configure(Broken())
+    results.put(key, [3])
+    assert results.get(key) is None
+    assert results.info()["errors"] == 2
+
+
+def test_cached_keys_by_arguments(configured):
+    calls = []
+
+    @cache.cached("test_keys", ttl=60)
+    def square(x, candidates=None):
+        calls.append(x)
+        return [x * x]
+
+    candidates = CandidateSet(make_papers(3))
+    assert square(3) == [9] and square(3) == [9]
+    assert square(3, candidates=candidates) == [9]
+    assert square(3, candidates=CandidateSet(make_papers(3))) == [9]
+    assert calls == [3, 3]
+    key, result = square.keyed(3)
+    assert key == square.cache.key((3,), {}) and result == [9]
+    with pytest.raises(TypeError):
+        square(object())
+
+
+def test_cached_doesnt_store_none(configured):
+    calls = []
+
+    @cache.cached("test_none", ttl=60)
+    def nothing(x):
+        calls.append(x)
+
+    nothing(1)
+    nothing(1)
+    assert calls == [1, 1]
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = cache.SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "result"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("k", compute)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do("k", compute))) for _ in range(5)]
+    for thread in followers:
+        thread.start()
+    while flight.coalesced < 5:
+        time.sleep(0.01)
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(5)
+
+    assert calls == [1]
+    assert sorted(results, key=lambda result: result[1]) == [("result", False)] + [("result", True)] * 5
+    assert flight.in_flight() == 0 and flight.max_waiting == 5
+
+
+def test_single_flight_raises_in_every_caller():
+    flight = cache.SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("failed")
+
+    errors = []
+
+    def call():
+        try:
+            flight.do("k", fail)
+        except RuntimeError as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=call)]
+    threads[0].start()
+    started.wait(5)
+    threads += [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads[1:]:
+        thread.start()
+    while flight.coalesced < 3:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(errors) == 4
+    # the next call computes again
+    assert flight.do("k", lambda: 1) == (1, False)
+
+
+def test_bump_generation_invalidates_and_calls_back(configured):
+    invalidated = []
+    cache.on_invalidate(lambda: invalidated.append(cache.current_generation()))
+    results = cache.ResultCache("test_generation", ttl=60)
+    key = results.key(("q",), {})
+    results.put(key, [1])
+
+    generation = cache.bump_generation("in a test")
+    assert invalidated == [generation]
+    assert results.key(("q",), {}) != key
+    assert results.get(results.key(("q",), {})) is None
+
+
+def test_generation_of_another_process_is_picked_up(tmp_path, configured, monkeypatch):
+    path = str(tmp_path / "shared.sqlite")
+    cache.configure(cache.SqliteBackend(path))
+    invalidated = []
+    cache.on_invalidate(lambda: invalidated.append(True))
+    generation = cache.current_generation()
+
+    # another worker on the host invalidates the shared file
+    cache.SqliteBackend(path).bump_generation()
+    assert cache.current_generation() == generation
+    monkeypatch.setattr(cache, "GENERATION_CHECK_SECONDS", 0.0)
+    assert cache.current_generation() == generation + 1
+    assert invalidated == [True]
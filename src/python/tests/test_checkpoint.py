@@ -0,0 +1,109 @@
+"""SyncCheckpoint: the watermarks a sync resumes from, with pages written
+out of order and pages that fail, and the class drops it keeps pending.
+"""
+import time
+
+from app.utils.checkpoint import SyncCheckpoint, checkpoint_in_use, load_checkpoint
+
+
+def new_state(ranges):
+    return {
+        "class": "Publication_1", "mode": "full", "sync_key": "p.syncKey", "started_at": time.time(),
+        "total_rows": 1000, "errors": 0, "failures": [],
+        "ranges": [{"after": after, "until": until, "written_until": after, "rows": 0,
+                    "fetched": False, "done": False}
+                   for after, until in ranges],
+    }
+
+
+def started(tmp_path, ranges=((None, 100), (100, None))):
+    checkpoint = SyncCheckpoint(str(tmp_path / "sync" / "checkpoint.json"))
+    assert checkpoint.acquire()
+    checkpoint.start(new_state(ranges))
+    return checkpoint
+
+
+def test_watermark_waits_for_earlier_pages(tmp_path):
+    checkpoint = started(tmp_path)
+    for after, last_key in [(None, 10), (10, 20), (20, 30)]:
+        checkpoint.fetched(0, after, last_key, 10)
+
+    checkpoint.written(0, 20)
+    saved = load_checkpoint(checkpoint.path)
+    assert saved["ranges"][0]["written_until"] is None and saved["ranges"][0]["rows"] == 0
+    assert saved["rows"] == 10
+
+    checkpoint.written(0, None)
+    saved = load_checkpoint(checkpoint.path)
+    assert saved["ranges"][0]["written_until"] == 10
+
+    checkpoint.written(0, 10)
+    saved = load_checkpoint(checkpoint.path)
+    assert saved["ranges"][0]["written_until"] == 30 and saved["ranges"][0]["rows"] == 30
+    assert not saved["ranges"][0]["done"]
+    checkpoint.fetch_done(0)
+    assert load_checkpoint(checkpoint.path)["ranges"][0]["done"]
+    # the other range is untouched
+    assert load_checkpoint(checkpoint.path)["ranges"][1]["written_until"] == 100
+
+
+def test_a_failed_page_holds_the_watermark(tmp_path):
+    checkpoint = started(tmp_path)
+    checkpoint.fetched(1, 100, 150, 5)
+    checkpoint.fetched(1, 150, 200, 5)
+    checkpoint.failed(1, 100, RuntimeError("boom"))
+    checkpoint.written(1, 150)
+    checkpoint.fetch_done(1)
+    checkpoint.finish("incomplete")
+
+    saved = load_checkpoint(checkpoint.path)
+    assert saved["state"] == "incomplete" and saved["errors"] == 1
+    assert saved["failures"][-1]["error"] == "RuntimeError: boom"
+    key_range = saved["ranges"][1]
+    assert key_range["written_until"] == 100 and key_range["rows"] == 0 and not key_range["done"]
+
+
+def test_resuming_counts_only_rows_behind_the_watermarks(tmp_path):
+    checkpoint = started(tmp_path)
+    checkpoint.fetched(0, None, 50, 50)
+    checkpoint.written(0, None)
+    checkpoint.fetch_done(0)
+    checkpoint.fetched(1, 100, 150, 50)
+    # written past the watermark of range 1, but the page before is missing
+    checkpoint.fetched(1, 150, 200, 50)
+    checkpoint.written(1, 150)
+    checkpoint.release()
+
+    resumed = SyncCheckpoint(checkpoint.path)
+    assert resumed.acquire()
+    state = load_checkpoint(resumed.path)
+    assert state["rows"] == 100
+    resumed.start(state)
+    assert resumed.state["rows"] == 50 and resumed.state["rows_at_resume"] == 50
+    assert resumed.state["state"] == "running"
+    assert [key_range["fetched"] for key_range in resumed.state["ranges"]] == [True, False]
+    assert resumed.state["ranges"][1]["written_until"] == 100
+
+
+def test_one_holder_at_a_time(tmp_path):
+    checkpoint = started(tmp_path)
+    assert checkpoint_in_use(checkpoint.path)
+    assert not SyncCheckpoint(checkpoint.path).acquire()
+    checkpoint.release()
+    assert not checkpoint_in_use(checkpoint.path)
+
+
+def test_pending_drops(tmp_path):
+    checkpoint = started(tmp_path)
+    checkpoint.schedule_drop("Publication_0", time.time() - 1)
+    checkpoint.schedule_drop("Publication_1", time.time() + 60)
+    assert checkpoint.expired_drops() == ["Publication_0"]
+    checkpoint.dropped("Publication_0")
+    assert checkpoint.expired_drops() == []
+    assert [drop["class"] for drop in load_checkpoint(checkpoint.path)["pending_drops"]] == ["Publication_1"]
+
+
+def test_a_missing_or_broken_checkpoint_is_none(tmp_path):
+    assert load_checkpoint(str(tmp_path / "missing.json")) is None
+    (tmp_path / "broken.json").write_text("{")
+    assert load_checkpoint(str(tmp_path / "broken.json")) is None
@@ -0,0 +1,120 @@
+"""make_features_batch against the feature rows of the original per-paper
+make_features (before any of the batching work), kept in
+data/features_baseline.npz. The papers, queries and language models are
+made up here, deterministically. Some features sum over sets of ngrams,
+whose order depends on string hashing, so rows can differ from the
+baseline in the last bits from one process to the next.
+"""
+import random
+from os.path import dirname, join
+
+import numpy as np
+import pytest
+
+from app.services.s2search.features import FEATURE_NAMES, PreparedQuery, make_features, make_features_batch
+from app.services.s2search.text import QueryNgrams, TextBatch, fix_author_text, fix_text
+
+BASELINE_PATH = join(dirname(__file__), "data", "features_baseline.npz")
+
+WORDS = [
+    "neural", "machine", "translation", "named", "entity", "recognition", "language", "models",
+    "transformer", "attention", "graph", "knowledge", "question", "answering", "sentiment", "analysis",
+    "low-resource", "parsing", "dependency", "semantic", "embeddings", "bert", "word2vec", "survey",
+    "of", "the", "for", "with", "a", "in", "and", "on", "2019", "2020", "multilingual", "retrieval",
+    "summarization", "dialogue", "generation", "large", "pre-trained", "zero-shot", "evaluation",
+]
+VENUES = ["ACL", "EMNLP", "NAACL", "Computational Linguistics", "Transactions of the ACL", "COLING 2020",
+          "LREC", "arXiv", ""]
+NAMES = ["Ada Lovelace", "Alan M. Turing", "Noam Chomsky", "Christopher D. Manning", "Dan Jurafsky",
+         "Yoshua Bengio", "Emily M. Bender", "Graham Neubig", "Kyunghyun Cho", "J. R. Firth", "Li Wei",
+         "Manning Smith", "Bert Kappen"]
+QUERIES = [
+    "neural machine translation",
+    "named entity recognition for low-resource languages",
+    '"question answering" survey',
+    "bert 2019",
+    '"knowledge graph" embeddings 2020 transformer',
+    "manning dependency parsing",
+    "Chomsky",
+    '"sentiment analysis" "graph"',
+    "the of a",
+    "ACL 2020 summarization of dialogue",
+    "Turing large language models zero-shot evaluation",
+    "",
+]
+
+
+class StubLM:
+    """A deterministic stand-in for a kenlm model"""
+
+    def __init__(self, scale):
+        self.scale = scale
+
+    def score(self, s, bos=True, eos=True):
+        return -self.scale * (len(s.split()) * 1.7 + sum(map(ord, s)) % 97 / 13.0)
+
+
+LMS = (StubLM(1.0), StubLM(1.3), StubLM(0.8))
+
+
+def words(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def make_papers(n=200, seed=0):
+    """Cleaned papers like S2Ranker.prepare_result makes them"""
+    rng = random.Random(seed)
+    papers = []
+    for _ in range(n):
+        abstract = rng.choice([None, "", words(rng, rng.randint(5, 80))])
+        papers.append({
+            "paper_year": rng.choice([2015, 2019, 2020, 2023, 3000, None, "", "2020"]),
+            "n_citations": rng.randint(0, 500),
+            "n_key_citations": rng.randint(0, 50),
+            "paper_title_cleaned": fix_text(words(rng, rng.randint(2, 12))),
+            "paper_abstract_cleaned": fix_text(abstract) if abstract is not None else None,
+            "paper_venue_cleaned": fix_text(rng.choice(VENUES)),
+            "author_name": rng.choice([None, [fix_author_text(rng.choice(NAMES)) for _ in range(rng.randint(0, 8))]]),
+        })
+    return papers
+
+
+@pytest.fixture(scope="module")
+def papers():
+    return make_papers()
+
+
+@pytest.fixture(scope="module")
+def baseline():
+    with np.load(BASELINE_PATH) as data:
+        return data["X"]
+
+
+@pytest.mark.parametrize("query_index", range(len(QUERIES)))
+def test_batch_matches_baseline(papers, baseline, query_index):
+    X = make_features_batch(QUERIES[query_index], papers, LMS)
+    assert X.shape == (len(papers), len(FEATURE_NAMES))
+    np.testing.assert_allclose(X, baseline[query_index], rtol=1e-12)
+
+
+@pytest.mark.parametrize("query_index", range(len(QUERIES)))
+def test_per_paper_matches_baseline(papers, baseline, query_index):
+    query = PreparedQuery(QUERIES[query_index], LMS)
+    X = np.array([make_features(query, paper, LMS) for paper in papers], dtype=float)
+    np.testing.assert_allclose(X, baseline[query_index], rtol=1e-12)
+
+
+def test_batch_of_no_papers():
+    assert make_features_batch("bert", [], LMS).shape == (0, len(FEATURE_NAMES))
+
+
+@pytest.mark.parametrize("texts", [
+    ["graph  neural (networks)", "", " neural graph ", "neural", None, "a graph of the graph"],
+    ["graph\nneural", "neural\tgraph ", "graph\xa0neural"],
+])
+def test_find_in_texts_matches_find_in_text(texts):
+    for query_ngrams in [QueryNgrams(["neural graph of the"]), QueryNgrams(["graph"], quotes=True)]:
+        found = query_ngrams.find_in_texts(TextBatch(texts))
+        for i, text in enumerate(texts):
+            match_spans, match_text, _ = query_ngrams.find_in_text(text or "")
+            assert found.get(i, ([], [])) == (match_spans, match_text)
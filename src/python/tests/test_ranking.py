@@ -0,0 +1,115 @@
+"""top_k_order and RankedPapers against sorting everything, the way the
+rerankers did before they only ranked up to the requested page. Keys are
+drawn from few values, so there are many ties, whose order has to stay
+the same as with sorted(..., reverse=True).
+"""
+import os
+import subprocess
+import sys
+from os.path import dirname
+
+import numpy as np
+import pytest
+
+from app.utils.candidates import CandidateSet
+from app.utils.ranking import RankedPapers, top_k_order
+
+
+def make_papers(years, citations):
+    return [{
+        "neo4jID": f"4:p:{i}",
+        "title": f"title {i}",
+        "abstract": "",
+        "venue": "ACL" if i % 2 else "",
+        "authors": (),
+        "year": int(year),
+        "n_citations": int(n_citations),
+        "n_key_citations": int(n_citations) // 2,
+        "field_list": ("NLP",),
+        "publication_date": f"{year}-01-01",
+    } for i, (year, n_citations) in enumerate(zip(years, citations))]
+
+
+def sorted_order(keys):
+    return sorted(range(len(keys)), key=lambda i: keys[i], reverse=True)
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_top_k_order_matches_sorted_with_ties(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(0, 60))
+    keys = rng.integers(0, int(rng.integers(1, 8)), size=n)
+    if seed % 3 == 0:
+        keys = keys.astype(np.float64) / 4
+    expected = sorted_order(keys.tolist())
+    for k in {0, 1, int(rng.integers(0, n + 1)), n, n + 5}:
+        assert top_k_order(keys, k).tolist() == expected[:k]
+
+
+def test_top_k_order_all_equal():
+    keys = np.zeros(10)
+    assert top_k_order(keys, 4).tolist() == [0, 1, 2, 3]
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_pages_match_sorted(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(1, 120))
+    papers = CandidateSet(make_papers(rng.integers(2000, 2005, size=n), rng.integers(0, 4, size=n)))
+    expected = [papers[i] for i in sorted_order(papers.n_citations.tolist())]
+
+    ranking = RankedPapers(papers, papers.n_citations)
+    offset = 0
+    while offset < n + 10:
+        limit = int(rng.integers(1, 15))
+        assert ranking.page(papers, offset, limit) == expected[offset:offset + limit]
+        assert ranking.n_sorted >= min(offset + limit, n)
+        offset += limit
+    # pages can be asked for in any order
+    assert ranking.page(papers, 0, n) == expected
+
+
+def test_ranking_only_sorts_as_far_as_asked():
+    papers = CandidateSet(make_papers([2000] * 100, range(100)))
+    ranking = RankedPapers(papers, papers.n_citations)
+    assert ranking.n_sorted == 0
+    ranking.page(papers, 0, 10)
+    assert ranking.n_sorted == 10
+    # grows at least twofold
+    ranking.page(papers, 10, 5)
+    assert ranking.n_sorted == 20
+    assert ranking.page(papers, 95, 10) == [papers[4], papers[3], papers[2], papers[1], papers[0]]
+    assert ranking.page(papers, 100, 10) == []
+
+
+def test_ranking_of_another_candidate_set():
+    papers = CandidateSet(make_papers([2000, 2001, 2002], [1, 2, 3]))
+    other = CandidateSet(make_papers([2000, 2001], [1, 2]))
+    ranking = RankedPapers(papers, papers.n_citations)
+    with pytest.raises(ValueError):
+        ranking.page(other, 0, 2)
+    # an equal set, e.g. one read back from a shared cache, is fine
+    same = CandidateSet(make_papers([2000, 2001, 2002], [1, 2, 3]))
+    assert ranking.page(same, 0, 1) == [same[2]]
+
+
+def test_candidate_set_identity():
+    papers = make_papers([2001, 2000], [3, 4])
+    candidates = CandidateSet(papers)
+    assert candidates == CandidateSet(papers) and hash(candidates) == hash(CandidateSet(papers))
+    assert candidates != CandidateSet(papers[::-1])
+    assert {candidates: 1}[CandidateSet(papers)] == 1
+    assert candidates.date_rank.tolist() == [1, 0]
+    assert candidates.facets["year"] == {2000: 1, 2001: 1}
+
+
+def test_candidate_set_hash_is_the_same_in_every_process():
+    script = ("from app.utils.candidates import CandidateSet; "
+              "print(hash(CandidateSet([{'neo4jID': 'a', 'year': 2000, 'n_citations': 0, 'n_key_citations': 0, "
+              "'publication_date': '2000'}])))")
+    hashes = {
+        subprocess.run([sys.executable, "-c", script], cwd=dirname(dirname(__file__)), check=True,
+                       capture_output=True, text=True, env={**os.environ, "PYTHONHASHSEED": seed}).stdout
+        for seed in ("1", "2")
+    }
+    assert len(hashes) == 1